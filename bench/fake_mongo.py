@@ -0,0 +1,647 @@
+import copy
+import asyncio
+import bisect
+import itertools
+from collections import Counter
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# In-process stand-in for the part of Motor's API that main.py uses.
+# Every operation is atomic (it never awaits half-way), optionally after a simulated round-trip latency,
+# and counted per collection so benchmarks can report how many Mongo operations a workload costs.
+
+_MISSING = object()
+_ids = itertools.count(1)
+
+
+class Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _resolve(doc, path):
+    # All values reachable by a dotted path, fanning out through arrays like MongoDB does
+    values = [doc]
+    for part in path.split("."):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    next_values.append(value[part])
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict) and part in item:
+                        next_values.append(item[part])
+        values = next_values
+    flattened = []
+    for value in values:
+        flattened.append(value)
+        if isinstance(value, list):
+            flattened.extend(value)
+    return flattened
+
+
+def _compare(values, arg, op):
+    for value in values:
+        if value is None or isinstance(value, (list, dict)):
+            continue
+        try:
+            if op(value, arg):
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+def _equals(values, arg):
+    if arg is None:
+        return not values or None in values
+    return arg in values
+
+
+def _is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond)
+
+
+def match(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(match(doc, sub) for sub in cond):
+                return False
+            continue
+        if key == "$and":
+            if not all(match(doc, sub) for sub in cond):
+                return False
+            continue
+        values = _resolve(doc, key)
+        if _is_operator_dict(cond):
+            for op, arg in cond.items():
+                if op == "$exists":
+                    ok = bool(values) == bool(arg)
+                elif op == "$ne":
+                    ok = not _equals(values, arg)
+                elif op == "$in":
+                    ok = any(_equals(values, item) for item in arg)
+                elif op == "$nin":
+                    ok = not any(_equals(values, item) for item in arg)
+                elif op == "$gt":
+                    ok = _compare(values, arg, lambda a, b: a > b)
+                elif op == "$gte":
+                    ok = _compare(values, arg, lambda a, b: a >= b)
+                elif op == "$lt":
+                    ok = _compare(values, arg, lambda a, b: a < b)
+                elif op == "$lte":
+                    ok = _compare(values, arg, lambda a, b: a <= b)
+                else:
+                    raise NotImplementedError(f"Query operator {op}")
+                if not ok:
+                    return False
+        elif not _equals(values, cond):
+            return False
+    return True
+
+
+def _set_path(doc, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _get_path(doc, path, default=None):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return default
+        doc = doc[part]
+    return doc
+
+
+def _unset_path(doc, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == "$set":
+                _set_path(doc, path, copy.deepcopy(value))
+            elif op == "$setOnInsert":
+                if inserting:
+                    _set_path(doc, path, copy.deepcopy(value))
+            elif op == "$unset":
+                _unset_path(doc, path)
+            elif op == "$inc":
+                _set_path(doc, path, _get_path(doc, path, 0) + value)
+            elif op == "$max":
+                current = _get_path(doc, path, _MISSING)
+                if current is _MISSING or value > current:
+                    _set_path(doc, path, value)
+            elif op == "$min":
+                current = _get_path(doc, path, _MISSING)
+                if current is _MISSING or value < current:
+                    _set_path(doc, path, value)
+            elif op == "$push":
+                items = _get_path(doc, path, None)
+                if items is None:
+                    items = []
+                    _set_path(doc, path, items)
+                if isinstance(value, dict) and "$each" in value:
+                    items.extend(copy.deepcopy(value["$each"]))
+                    if "$slice" in value:
+                        limit = value["$slice"]
+                        items[:] = items[limit:] if limit < 0 else items[:limit]
+                else:
+                    items.append(copy.deepcopy(value))
+            elif op == "$addToSet":
+                items = _get_path(doc, path, None)
+                if items is None:
+                    items = []
+                    _set_path(doc, path, items)
+                if value not in items:
+                    items.append(copy.deepcopy(value))
+            elif op == "$pull":
+                items = _get_path(doc, path, None)
+                if isinstance(items, list):
+                    if isinstance(value, dict):
+                        items[:] = [item for item in items if not (isinstance(item, dict) and match(item, value))]
+                    else:
+                        items[:] = [item for item in items if item != value]
+            else:
+                raise NotImplementedError(f"Update operator {op}")
+
+
+def project(doc, projection):
+    if doc is None:
+        return None
+    if not projection:
+        return copy.deepcopy(doc)
+    include_id = projection.get("_id", 1)
+    fields = [k for k, v in projection.items() if k != "_id" and v]
+    if not fields:
+        result = {k: copy.deepcopy(v) for k, v in doc.items() if k != "_id" or include_id}
+        for k, v in projection.items():
+            if not v:
+                result.pop(k, None)
+        return result
+    result = {k: copy.deepcopy(doc[k]) for k in fields if k in doc}
+    if include_id and "_id" in doc:
+        result["_id"] = doc["_id"]
+    return result
+
+
+def evaluate(expr, doc):
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _get_path(doc, expr[1:])
+    if isinstance(expr, dict):
+        (op, arg), = expr.items()
+        if op == "$size":
+            return len(evaluate(arg, doc) or [])
+        if op == "$ifNull":
+            value = evaluate(arg[0], doc)
+            return evaluate(arg[1], doc) if value is None else value
+        if op == "$add":
+            return sum(evaluate(item, doc) or 0 for item in arg)
+        if op == "$subtract":
+            return (evaluate(arg[0], doc) or 0) - (evaluate(arg[1], doc) or 0)
+        raise NotImplementedError(f"Expression {op}")
+    return expr
+
+
+class FakeCursor:
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query or {}
+        self._projection = projection
+        self._sort = None
+        self._limit = 0
+        self._skip = 0
+
+    def sort(self, key, direction=1):
+        self._sort = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def _results(self):
+        docs = self._collection._scan(self._query, self._sort, self._skip + self._limit if self._limit else 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [project(doc, self._projection) for doc in docs]
+
+    async def to_list(self, length=None):
+        await self._collection._tick("find")
+        results = self._results()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await self._collection._tick("find")
+        for doc in self._results():
+            yield doc
+
+
+class FakeAggregateCursor:
+    def __init__(self, collection, pipeline):
+        self._collection = collection
+        self._pipeline = pipeline
+
+    def _run(self):
+        docs = list(self._collection._docs.values())
+        for stage in self._pipeline:
+            (op, arg), = stage.items()
+            if op == "$match":
+                docs = [doc for doc in docs if match(doc, arg)]
+            elif op == "$group":
+                groups = {}
+                for doc in docs:
+                    if isinstance(arg["_id"], dict):
+                        key = tuple(sorted((k, evaluate(v, doc)) for k, v in arg["_id"].items()))
+                    else:
+                        key = evaluate(arg["_id"], doc)
+                    out = groups.get(key)
+                    if out is None:
+                        out = groups[key] = {"_id": dict(key) if isinstance(arg["_id"], dict) else key}
+                    for field, acc in arg.items():
+                        if field == "_id":
+                            continue
+                        (acc_op, acc_expr), = acc.items()
+                        value = evaluate(acc_expr, doc)
+                        if acc_op == "$sum":
+                            out[field] = out.get(field, 0) + (value or 0)
+                        elif acc_op == "$max":
+                            out[field] = value if field not in out else max(out[field], value)
+                        elif acc_op == "$min":
+                            out[field] = value if field not in out else min(out[field], value)
+                        elif acc_op == "$first":
+                            out.setdefault(field, value)
+                        else:
+                            raise NotImplementedError(f"Accumulator {acc_op}")
+                docs = list(groups.values())
+            elif op == "$sort":
+                for field, direction in reversed(list(arg.items())):
+                    docs.sort(key=lambda d: (_get_path(d, field) is None, _get_path(d, field)), reverse=direction < 0)
+            elif op == "$limit":
+                docs = docs[:arg]
+            elif op == "$project":
+                docs = [{k: (evaluate(v, doc) if not isinstance(v, int) else _get_path(doc, k)) for k, v in arg.items()} for doc in docs]
+            else:
+                raise NotImplementedError(f"Pipeline stage {op}")
+        return docs
+
+    async def to_list(self, length=None):
+        await self._collection._tick("aggregate")
+        results = self._run()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await self._collection._tick("aggregate")
+        for doc in self._run():
+            yield doc
+
+
+class FakeCollection:
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.op_counts = Counter()
+        self._docs = {} # _id -> document, insertion ordered
+        self._unique = {} # index name -> (fields, {key tuple: _id})
+        self._indexes = {"_id_": [("_id", 1)]}
+        self._sorted = {} # field -> (version, sorted [(value, _id)])
+        self._version = 0
+
+    async def _tick(self, op):
+        self.op_counts[op] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    # Indexes
+
+    def _index_key(self, doc, fields):
+        key = []
+        for field in fields:
+            values = _resolve(doc, field)
+            key.append(values[0] if values else None)
+        return tuple(key)
+
+    def _check_unique(self, doc, ignore_id=None):
+        for name, (fields, entries) in self._unique.items():
+            owner = entries.get(self._index_key(doc, fields))
+            if owner is not None and owner != ignore_id:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name}")
+
+    def _index_add(self, doc):
+        for fields, entries in self._unique.values():
+            entries[self._index_key(doc, fields)] = doc["_id"]
+
+    def _index_remove(self, doc):
+        for fields, entries in self._unique.values():
+            key = self._index_key(doc, fields)
+            if entries.get(key) == doc["_id"]:
+                del entries[key]
+
+    async def create_index(self, keys, name=None, unique=False, **kwargs):
+        await self._tick("create_index")
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        self._indexes[name] = list(keys)
+        if unique:
+            fields = [field for field, _ in keys]
+            entries = {}
+            for doc in self._docs.values():
+                key = self._index_key(doc, fields)
+                if key in entries:
+                    raise DuplicateKeyError(f"E11000 duplicate key error building index {name}")
+                entries[key] = doc["_id"]
+            self._unique[name] = (fields, entries)
+        return name
+
+    async def index_information(self):
+        await self._tick("index_information")
+        return {name: {"key": keys} for name, keys in self._indexes.items()}
+
+    async def drop_index(self, name):
+        await self._tick("drop_index")
+        self._indexes.pop(name, None)
+        self._unique.pop(name, None)
+
+    # Lookups
+
+    def _candidates(self, query):
+        if "_id" in query and not _is_operator_dict(query["_id"]):
+            doc = self._docs.get(query["_id"])
+            return [doc] if doc is not None else []
+        for fields, entries in self._unique.values():
+            if all(field in query and not _is_operator_dict(query[field]) for field in fields):
+                _id = entries.get(tuple(query[field] for field in fields))
+                return [self._docs[_id]] if _id is not None else []
+        return self._docs.values()
+
+    def _sorted_by(self, field):
+        cached = self._sorted.get(field)
+        if cached and cached[0] == self._version:
+            return cached[1]
+        entries = sorted(
+            ((_get_path(doc, field), _id) for _id, doc in self._docs.items() if _get_path(doc, field) is not None),
+            key=lambda entry: entry[0]
+        )
+        self._sorted[field] = (self._version, entries)
+        return entries
+
+    def _scan(self, query, sort=None, wanted=0):
+        if sort and len(sort) == 1 and sort[0][1] == 1:
+            # Keyset pagination fast path: walk a cached sorted list from the range start instead of sorting everything
+            field = sort[0][0]
+            entries = self._sorted_by(field)
+            cond = query.get(field)
+            start = 0
+            if _is_operator_dict(cond):
+                if "$gt" in cond:
+                    start = bisect.bisect_right(entries, cond["$gt"], key=lambda entry: entry[0])
+                elif "$gte" in cond:
+                    start = bisect.bisect_left(entries, cond["$gte"], key=lambda entry: entry[0])
+            docs = []
+            for value, _id in itertools.islice(entries, start, None):
+                doc = self._docs[_id]
+                if match(doc, query):
+                    docs.append(doc)
+                    if wanted and len(docs) >= wanted:
+                        break
+            return docs
+        docs = [doc for doc in self._candidates(query) if match(doc, query)]
+        if sort:
+            for field, direction in reversed(sort):
+                docs.sort(key=lambda d: (_get_path(d, field) is None, _get_path(d, field)), reverse=direction < 0)
+        return docs
+
+    def _find_first(self, query, sort=None):
+        docs = self._scan(query, sort, 1)
+        return docs[0] if docs else None
+
+    # Writes
+
+    def _insert(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", next(_ids))
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+        self._check_unique(doc)
+        self._docs[doc["_id"]] = doc
+        self._index_add(doc)
+        self._version += 1
+        return doc
+
+    def _update_doc(self, doc, update):
+        before = copy.deepcopy(doc)
+        self._index_remove(doc)
+        apply_update(doc, update)
+        try:
+            self._check_unique(doc, doc["_id"])
+        except DuplicateKeyError:
+            doc.clear()
+            doc.update(before)
+            self._index_add(doc)
+            raise
+        self._index_add(doc)
+        self._version += 1
+        return doc != before
+
+    def _upsert(self, query, update):
+        doc = {k: copy.deepcopy(v) for k, v in query.items() if not k.startswith("$") and not _is_operator_dict(v)}
+        doc = self._insert_prepared(doc, update)
+        return doc
+
+    def _insert_prepared(self, doc, update):
+        apply_update(doc, update, inserting=True)
+        return self._insert(doc)
+
+    def load(self, docs):
+        # Fixture bulk-load: no copies and no op counting, for seeding hundreds of thousands of documents quickly
+        for doc in docs:
+            doc.setdefault("_id", next(_ids))
+            self._check_unique(doc)
+            self._docs[doc["_id"]] = doc
+            self._index_add(doc)
+        self._version += 1
+
+    async def insert_one(self, doc):
+        await self._tick("insert_one")
+        inserted = self._insert(doc)
+        doc.setdefault("_id", inserted["_id"])
+        return Result(inserted_id=inserted["_id"])
+
+    async def insert_many(self, docs, ordered=True):
+        await self._tick("insert_many")
+        ids = []
+        for doc in docs:
+            inserted = self._insert(doc)
+            doc.setdefault("_id", inserted["_id"])
+            ids.append(inserted["_id"])
+        return Result(inserted_ids=ids)
+
+    def _update_one(self, query, update, upsert=False):
+        doc = self._find_first(query)
+        if doc is None:
+            if not upsert:
+                return Result(matched_count=0, modified_count=0, upserted_id=None)
+            doc = self._upsert(query, update)
+            return Result(matched_count=0, modified_count=0, upserted_id=doc["_id"])
+        modified = self._update_doc(doc, update)
+        return Result(matched_count=1, modified_count=int(modified), upserted_id=None)
+
+    async def update_one(self, query, update, upsert=False):
+        await self._tick("update_one")
+        return self._update_one(query, update, upsert)
+
+    async def update_many(self, query, update, upsert=False):
+        await self._tick("update_many")
+        docs = self._scan(query)
+        if not docs and upsert:
+            doc = self._upsert(query, update)
+            return Result(matched_count=0, modified_count=0, upserted_id=doc["_id"])
+        modified = sum(self._update_doc(doc, update) for doc in docs)
+        return Result(matched_count=len(docs), modified_count=modified, upserted_id=None)
+
+    async def find_one_and_update(self, query, update, projection=None, sort=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE, **kwargs):
+        await self._tick("find_one_and_update")
+        doc = self._find_first(query, sort)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = self._upsert(query, update)
+            return project(doc, projection) if return_document == ReturnDocument.AFTER else None
+        before = project(doc, projection)
+        self._update_doc(doc, update)
+        return project(doc, projection) if return_document == ReturnDocument.AFTER else before
+
+    async def find_one_and_delete(self, query, projection=None, sort=None, **kwargs):
+        await self._tick("find_one_and_delete")
+        doc = self._find_first(query, sort)
+        if doc is None:
+            return None
+        self._delete(doc)
+        return project(doc, projection)
+
+    def _delete(self, doc):
+        self._index_remove(doc)
+        del self._docs[doc["_id"]]
+        self._version += 1
+
+    async def delete_one(self, query):
+        await self._tick("delete_one")
+        doc = self._find_first(query)
+        if doc is not None:
+            self._delete(doc)
+        return Result(deleted_count=int(doc is not None))
+
+    async def delete_many(self, query):
+        await self._tick("delete_many")
+        docs = self._scan(query)
+        for doc in docs:
+            self._delete(doc)
+        return Result(deleted_count=len(docs))
+
+    async def bulk_write(self, requests, ordered=True):
+        await self._tick("bulk_write")
+        inserted = matched = modified = upserted = deleted = 0
+        for request in requests:
+            kind = type(request).__name__
+            try:
+                if kind == "InsertOne":
+                    self._insert(request._doc)
+                    inserted += 1
+                elif kind in ("UpdateOne", "UpdateMany"):
+                    if kind == "UpdateOne":
+                        result = self._update_one(request._filter, request._doc, request._upsert)
+                        results = [result]
+                    else:
+                        docs = self._scan(request._filter)
+                        results = [Result(matched_count=1, modified_count=int(self._update_doc(doc, request._doc)), upserted_id=None) for doc in docs]
+                        if not docs and request._upsert:
+                            results = [Result(matched_count=0, modified_count=0, upserted_id=self._upsert(request._filter, request._doc)["_id"])]
+                    for result in results:
+                        matched += result.matched_count
+                        modified += result.modified_count
+                        upserted += int(result.upserted_id is not None)
+                elif kind == "DeleteOne":
+                    doc = self._find_first(request._filter)
+                    if doc is not None:
+                        self._delete(doc)
+                        deleted += 1
+                else:
+                    raise NotImplementedError(f"Bulk operation {kind}")
+            except DuplicateKeyError:
+                if ordered:
+                    raise
+        return Result(inserted_count=inserted, matched_count=matched, modified_count=modified,
+                      upserted_count=upserted, deleted_count=deleted)
+
+    # Reads
+
+    async def find_one(self, query=None, projection=None, sort=None):
+        await self._tick("find_one")
+        return project(self._find_first(query or {}, sort), projection)
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(self, query, projection)
+
+    def aggregate(self, pipeline):
+        return FakeAggregateCursor(self, pipeline)
+
+    async def count_documents(self, query):
+        await self._tick("count_documents")
+        return len(self._scan(query)) if query else len(self._docs)
+
+    async def estimated_document_count(self):
+        await self._tick("estimated_document_count")
+        return len(self._docs)
+
+    async def distinct(self, field, query=None):
+        await self._tick("distinct")
+        seen = []
+        for doc in self._scan(query or {}):
+            for value in _resolve(doc, field):
+                if value not in seen:
+                    seen.append(value)
+        return seen
+
+
+class FakeDatabase:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name, self.latency)
+        return self._collections[name]
+
+    async def command(self, name, *args, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return {"ok": 1.0}
+
+    def op_counts(self):
+        return {name: dict(collection.op_counts) for name, collection in self._collections.items() if collection.op_counts}
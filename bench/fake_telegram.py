@@ -0,0 +1,234 @@
+import random
+import asyncio
+import itertools
+from collections import Counter
+from types import SimpleNamespace
+from pyrogram import enums
+from pyrogram.errors import FloodWait
+
+# Duck-typed stand-in for the Pyrogram Client, Message and CallbackQuery surface that main.py's handlers touch.
+# Every API method goes through FakeTelegram._api, which builds a stand-in raw query and passes it to invoke(),
+# like Pyrogram's methods do, so main.OutboundScheduler.install() can wrap it. invoke() counts the call, sleeps
+# the configured latency and, if asked to, answers every Nth call with FloodWait.
+
+_message_ids = itertools.count(1000)
+
+# Fake method name -> the raw function Pyrogram would invoke for it (what the outbound scheduler classifies by)
+RAW_FUNCTIONS = {
+    "send_message": "SendMessage",
+    "send_photo": "SendMedia",
+    "copy_message": "SendMedia",
+    "send_multi_media": "SendMultiMedia",
+    "edit_message_text": "EditMessage",
+    "edit_message_caption": "EditMessage",
+    "edit_message_reply_markup": "EditMessage",
+    "delete_messages": "DeleteMessages",
+    "answer_callback_query": "SetBotCallbackAnswer",
+}
+_query_types = {}
+
+
+def raw_query(method, chat_id=None):
+    name = RAW_FUNCTIONS.get(method) or "".join(part.title() for part in method.split("_"))
+    query_type = _query_types.get(name) or _query_types.setdefault(name, type(name, (), {}))
+    query = query_type()
+    query.method = method
+    query.peer = None
+    if chat_id is not None:
+        query.peer = SimpleNamespace(user_id=chat_id) if chat_id > 0 else SimpleNamespace(channel_id=-chat_id)
+    return query
+
+
+class FakeUser:
+    def __init__(self, user_id, first_name="User", username=None):
+        self.id = user_id
+        self.first_name = first_name
+        self.username = username or f"user{user_id}"
+        self.is_bot = False
+
+    @property
+    def mention(self):
+        return f"[{self.first_name}](tg://user?id={self.id})"
+
+
+class FakeChat:
+    def __init__(self, chat_id, chat_type=enums.ChatType.PRIVATE, title=None, invite_link=None):
+        self.id = chat_id
+        self.type = chat_type
+        self.title = title or f"Chat {chat_id}"
+        self.invite_link = invite_link
+
+
+class FakeMessage:
+    def __init__(self, client, chat, from_user=None, text=None, caption=None, media=None, reply_markup=None, message_id=None, media_group_id=None):
+        self._client = client
+        self.id = message_id or next(_message_ids)
+        self.chat = chat
+        self.from_user = from_user
+        self.text = text
+        self.caption = caption
+        self.reply_markup = reply_markup
+        self.empty = False
+        self.photo = SimpleNamespace(file_id=f"fake-photo-{self.id}") if media == "photo" else None
+        self.video = SimpleNamespace(file_id=f"fake-video-{self.id}") if media == "video" else None
+        self.document = SimpleNamespace(file_id=f"fake-document-{self.id}") if media == "document" else None
+        self.animation = self.audio = None
+        self.media_group_id = media_group_id
+        self.forward_from_chat = None
+        self.reply_to_message = None
+        self.command = text[1:].split(" ") if text and text.startswith("/") else None
+
+    async def reply_text(self, text, **kwargs):
+        return await self._client.send_message(self.chat.id, text, **kwargs)
+
+    async def reply_photo(self, photo, caption=None, **kwargs):
+        return await self._client.send_photo(self.chat.id, photo, caption=caption, **kwargs)
+
+    async def edit_reply_markup(self, reply_markup=None):
+        await self._client._api("edit_message_reply_markup", self.chat.id)
+        self.reply_markup = reply_markup
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        await self._client._api("edit_message_text", self.chat.id)
+        self.text = text
+        return self
+
+    async def edit_caption(self, caption, **kwargs):
+        await self._client._api("edit_message_caption", self.chat.id)
+        self.caption = caption
+        return self
+
+    async def delete(self):
+        await self._client._api("delete_messages", self.chat.id)
+        return True
+
+    async def copy(self, chat_id, caption=None, reply_markup=None, **kwargs):
+        return await self._client.copy_message(chat_id, self.chat.id, self.id, caption=caption, reply_markup=reply_markup)
+
+
+class FakeCallbackQuery:
+    def __init__(self, client, data, from_user, message):
+        self._client = client
+        self.id = str(next(_message_ids))
+        self.data = data
+        self.from_user = from_user
+        self.message = message
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        await self._client._api("answer_callback_query")
+        self.answers.append(text)
+        return True
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, jitter=0.0, flood_every=0, flood_wait=1, bot_id=999000, sleep_threshold=10):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_every = flood_every
+        self.flood_wait = flood_wait
+        self.me = FakeUser(bot_id, "Bench Bot", "bench_bot")
+        self.me.is_bot = True
+        self.calls = Counter()
+        self.flood_waits = 0
+        self.messages = {} # (chat_id, message_id) -> FakeMessage
+        self.admin_in = None # None = admin everywhere, else a set of channel ids
+        self.is_connected = True
+        self.sleep_threshold = sleep_threshold
+        self._n = 0
+
+    async def _api(self, method, chat_id=None):
+        await self.invoke(raw_query(method, chat_id))
+
+    async def invoke(self, query, *args, sleep_threshold=None, **kwargs):
+        self.calls[query.method] += 1
+        self._n += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        if self.flood_every and self._n % self.flood_every == 0:
+            self.flood_waits += 1
+            raise FloodWait(value=self.flood_wait)
+
+    def new_message(self, chat, **kwargs):
+        message = FakeMessage(self, chat, **kwargs)
+        self.messages[(chat.id, message.id)] = message
+        return message
+
+    async def get_me(self):
+        await self._api("get_me")
+        return self.me
+
+    async def get_chat(self, chat_id):
+        await self._api("get_chat", chat_id)
+        return FakeChat(chat_id, enums.ChatType.CHANNEL, invite_link=f"https://t.me/+bench{abs(chat_id)}")
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._api("get_chat_member", chat_id)
+        is_admin = self.admin_in is None or chat_id in self.admin_in
+        return SimpleNamespace(
+            user=FakeUser(user_id),
+            status=enums.ChatMemberStatus.ADMINISTRATOR if is_admin else enums.ChatMemberStatus.MEMBER,
+            privileges=SimpleNamespace(can_post_messages=True, can_edit_messages=True, can_invite_users=True) if is_admin else None
+        )
+
+    async def export_chat_invite_link(self, chat_id):
+        await self._api("export_chat_invite_link", chat_id)
+        return f"https://t.me/+bench{abs(chat_id)}"
+
+    async def get_messages(self, chat_id, message_ids):
+        await self._api("get_messages", chat_id)
+        if isinstance(message_ids, list):
+            return [self.messages.get((chat_id, message_id)) for message_id in message_ids]
+        message = self.messages.get((chat_id, message_ids))
+        if message is None:
+            message = FakeMessage(self, FakeChat(chat_id), message_id=message_ids)
+            message.empty = True
+        return message
+
+    async def get_media_group(self, chat_id, message_id):
+        await self._api("get_media_group", chat_id)
+        anchor = self.messages.get((chat_id, message_id))
+        if anchor is None or not anchor.media_group_id:
+            raise ValueError("The message doesn't belong to a media group")
+        group = [m for (c, _), m in self.messages.items() if c == chat_id and m.media_group_id == anchor.media_group_id]
+        return sorted(group, key=lambda m: m.id)
+
+    async def copy_media_group(self, chat_id, from_chat_id, message_id, captions=None, **kwargs):
+        group = await self.get_media_group(from_chat_id, message_id)
+        await self._api("send_multi_media", chat_id)
+        group_id = f"copy-{next(_message_ids)}"
+        copies = []
+        for i, source in enumerate(group):
+            caption = captions[i] if isinstance(captions, list) and i < len(captions) and captions[i] else source.caption
+            media = "photo" if source.photo else "video" if source.video else "document"
+            copies.append(self.new_message(FakeChat(chat_id, enums.ChatType.CHANNEL), caption=caption, media=media, media_group_id=group_id))
+        return copies
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self._api("send_message", chat_id)
+        return self.new_message(FakeChat(chat_id), from_user=self.me, text=text, reply_markup=reply_markup)
+
+    async def send_photo(self, chat_id, photo, caption=None, reply_markup=None, **kwargs):
+        await self._api("send_photo", chat_id)
+        return self.new_message(FakeChat(chat_id), from_user=self.me, caption=caption, media="photo", reply_markup=reply_markup)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, caption=None, reply_markup=None, **kwargs):
+        await self._api("copy_message", chat_id)
+        source = self.messages.get((from_chat_id, message_id))
+        media = "photo" if source is None or source.photo else "video"
+        return self.new_message(FakeChat(chat_id, enums.ChatType.CHANNEL), caption=caption, media=media, reply_markup=reply_markup)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self._api("edit_message_text", chat_id)
+        message = self.messages.get((chat_id, message_id))
+        if message:
+            message.text = text
+        return message
+
+    async def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None, **kwargs):
+        await self._api("edit_message_reply_markup", chat_id)
+        message = self.messages.get((chat_id, message_id))
+        if message:
+            message.reply_markup = reply_markup
+        return message
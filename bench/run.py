@@ -0,0 +1,420 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import subprocess
+
+# main.py builds its Mongo and Pyrogram clients at import time; neither connects until used,
+# but the Mongo URL must at least parse.
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+
+from pyrogram import enums
+from pyrogram.types import InlineKeyboardMarkup
+
+import main
+from bench.fake_mongo import FakeDatabase, FakeCollection
+from bench.fake_telegram import FakeTelegram, FakeChat, FakeUser, FakeCallbackQuery
+
+# Offline benchmarks for main.py's hot paths: the real handlers run against FakeTelegram and an in-memory Mongo.
+# Usage: python -m bench.run [--quick] [--only reaction_storm,media_handler] [--output results.json]
+# Every workload prints one JSON object; compare them between commits to spot regressions.
+
+
+def install_fakes(args):
+    # Swap every Mongo collection main.py holds for an in-memory one and reset in-process state
+    from motor.motor_asyncio import AsyncIOMotorCollection
+    fake_db = FakeDatabase(args.mongo_latency)
+    for name, value in list(vars(main).items()):
+        if isinstance(value, (AsyncIOMotorCollection, FakeCollection)):
+            setattr(main, name, fake_db[value.name])
+    main.db = fake_db
+    main.REQUIRED_INDEXES = {
+        name: (fake_db[collection.name], keys, options)
+        for name, (collection, keys, options) in main.REQUIRED_INDEXES.items()
+    }
+    main.OBSOLETE_INDEXES = [(fake_db[collection.name], name) for collection, name in main.OBSOLETE_INDEXES]
+    for value in vars(main).values():
+        if isinstance(value, main.TTLCache):
+            value.clear()
+        elif isinstance(value, main.TapThrottle):
+            value._current.clear()
+            value._previous.clear()
+    main.bot_me = None
+    return fake_db
+
+
+def new_bot(args, **overrides):
+    options = {
+        "latency": args.tg_latency,
+        "jitter": args.tg_jitter,
+        "flood_every": args.flood_every,
+        "flood_wait": args.flood_wait,
+    }
+    options.update(overrides)
+    return FakeTelegram(**options)
+
+
+def install_scheduler(bot):
+    # A fresh outbound scheduler per workload, so its buckets and pauses don't leak between runs
+    scheduler = main.OutboundScheduler(
+        main.OUTBOUND_GLOBAL_RATE, main.OUTBOUND_ANSWER_RATE, main.OUTBOUND_PRIVATE_RATE, main.OUTBOUND_GROUP_RATE, main.OUTBOUND_CHAT_BURST,
+    )
+    scheduler.install(bot)
+    return scheduler
+
+
+def summarize(name, latencies, seconds, ops, **extra):
+    ordered = sorted(latencies)
+
+    def percentile(q):
+        if not ordered:
+            return 0.0
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {
+        "workload": name,
+        "ops": ops,
+        "seconds": round(seconds, 4),
+        "throughput_per_s": round(ops / seconds, 1) if seconds else None,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        **extra,
+    }
+
+
+async def reaction_storm(args):
+    # Many users hammering 👍/❤️ on one channel post
+    fake_db = install_fakes(args)
+    await main.ensure_indexes()
+    bot = new_bot(args)
+    scheduler = install_scheduler(bot)
+    main.reaction_editor.window = args.edit_window
+    main.REACTION_WRITE_BEHIND = args.write_behind
+    if args.write_behind:
+        main.reaction_buffer = main.ReactionBuffer(args.flush_interval, args.flush_max_ops, main.REACTION_BUFFER_LIMIT)
+        main.reaction_buffer.start()
+
+    channel = FakeChat(-1001000000001, enums.ChatType.CHANNEL, "Storm Channel")
+    source_id = 42
+    post = bot.new_message(channel, caption="storm", media="photo", reply_markup=InlineKeyboardMarkup([main.build_reaction_row(source_id)]))
+    await main.init_post_reactions(channel.id, post.id)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, errors = [], 0
+    handle_tap = main.throttled_handler(main.callback_handler) # As instrument_handlers registers it
+
+    async def tap(i):
+        nonlocal errors
+        user = FakeUser(10_000 + i % args.storm_users)
+        # Old posts still carry "react_<id>_<type>" strings; --legacy-callbacks exercises that path instead
+        data = f"react_{source_id}_{'like' if i % 3 else 'love'}" if args.legacy_callbacks else main.encode_callback(main.OP_REACT, source_id, 0 if i % 3 else 1)
+        cq = FakeCallbackQuery(bot, data, user, post)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await handle_tap(bot, cq)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(tap(i) for i in range(args.taps)))
+    elapsed = time.perf_counter() - started
+
+    if args.write_behind:
+        await main.reaction_buffer.close()
+    # Let the coalescer send its trailing edit before counting API calls
+    while main.reaction_editor._tasks:
+        await asyncio.sleep(args.edit_window)
+    await scheduler.close()
+
+    counts = (await main.reactions_collection.find_one({"channel_id": channel.id, "message_id": post.id})) or {}
+    tally = {"like": 0, "love": 0}
+    async for vote in main.reaction_votes.find({"channel_id": channel.id, "message_id": post.id}):
+        tally[vote["reaction"]] += 1
+    flushes = [histogram for _, histogram in main.metrics.histograms("reaction_flush_batch_size")]
+    flush_seconds = [histogram for _, histogram in main.metrics.histograms("reaction_flush_seconds")]
+    return summarize(
+        "reaction_storm", latencies, elapsed, args.taps,
+        errors=errors,
+        write_behind=args.write_behind,
+        flushes=sum(h.count for h in flushes),
+        flush_batch_p50=round(flushes[0].quantile(0.5), 1) if flushes else None,
+        flush_p95_ms=round(flush_seconds[0].quantile(0.95) * 1000, 2) if flush_seconds else None,
+        users=args.storm_users,
+        counts=counts.get("counts"),
+        consistent=counts.get("counts") == tally,
+        telegram_calls=dict(bot.calls),
+        mongo_ops=fake_db.op_counts(),
+    )
+
+
+async def lanes(args):
+    # A reaction storm with /help commands mixed in, fed through a pool of --concurrency workers like Pyrogram's
+    # dispatcher. The pool hands each update to its inbound lane; --no-lanes runs the handlers in the pool instead.
+    fake_db = install_fakes(args)
+    await main.ensure_indexes()
+    bot = new_bot(args)
+    scheduler = install_scheduler(bot)
+    main.reaction_editor.window = args.edit_window
+
+    channel = FakeChat(-1001000000002, enums.ChatType.CHANNEL, "Lanes Channel")
+    source_id = 43
+    post = bot.new_message(channel, caption="lanes", media="photo", reply_markup=InlineKeyboardMarkup([main.build_reaction_row(source_id)]))
+    await main.init_post_reactions(channel.id, post.id)
+
+    command_latencies, tap_latencies = [], []
+    handle_tap = main.throttled_handler(main.callback_handler)
+
+    async def command(client, msg):
+        await main.help_command_handler(client, msg)
+        command_latencies.append(time.perf_counter() - msg.arrived)
+
+    async def tap(client, cq):
+        await handle_tap(client, cq)
+        tap_latencies.append(time.perf_counter() - cq.arrived)
+
+    updates = []
+    for i in range(args.taps):
+        data = main.encode_callback(main.OP_REACT, source_id, i % 2)
+        updates.append((tap, FakeCallbackQuery(bot, data, FakeUser(10_000 + i % args.storm_users), post)))
+        if i % args.command_every == 0:
+            user = FakeUser(20_000 + i)
+            updates.append((command, bot.new_message(FakeChat(user.id), from_user=user, text="/help")))
+    commands = sum(1 for handler, _ in updates if handler is command)
+
+    def dropped():
+        return sum(value for labels, value in main.metrics.counters("inbound_dropped_total") if labels.get("lane") == "reactions")
+
+    dropped_before = dropped()
+    if not args.no_lanes:
+        main.start_inbound_lanes()
+        routed = {handler: main.laned_handler(handler) for handler in (tap, command)}
+    queue = asyncio.Queue()
+
+    async def dispatcher_worker():
+        while True:
+            handler, update = await queue.get()
+            try:
+                await (handler if args.no_lanes else routed[handler])(bot, update)
+            except Exception:
+                pass
+            queue.task_done()
+
+    workers = [asyncio.create_task(dispatcher_worker()) for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for handler, update in updates:
+        update.arrived = time.perf_counter()
+        queue.put_nowait((handler, update))
+    await queue.join()
+    while len(command_latencies) < commands or len(tap_latencies) + dropped() - dropped_before < args.taps:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.cancel()
+    if not args.no_lanes:
+        await main.close_inbound_lanes()
+    while main.reaction_editor._tasks:
+        await asyncio.sleep(args.edit_window)
+    await scheduler.close()
+
+    ordered_taps = sorted(tap_latencies)
+    return summarize(
+        "lanes", command_latencies, elapsed, len(updates),
+        lanes=not args.no_lanes,
+        commands=commands,
+        taps=args.taps,
+        taps_handled=len(tap_latencies),
+        taps_dropped=dropped() - dropped_before,
+        tap_p95_ms=round(ordered_taps[int(0.95 * (len(ordered_taps) - 1))] * 1000, 3) if ordered_taps else None,
+        telegram_calls=dict(bot.calls),
+        mongo_ops=fake_db.op_counts(),
+    )
+
+
+async def media_handler(args):
+    # One user with N channels sending photos; the first call runs with cold caches
+    fake_db = install_fakes(args)
+    await main.ensure_indexes()
+    bot = new_bot(args, flood_every=0)
+
+    user_id = 5000
+    channels = [{"id": -1002000000000 - i, "title": f"Channel {i}"} for i in range(args.channels)]
+    await main.users.insert_one({"user_id": user_id, "channels": channels, "custom_caption": None, "custom_buttons": []})
+    chat, user = FakeChat(user_id), FakeUser(user_id)
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.media_iterations):
+        msg = bot.new_message(chat, from_user=user, media="photo")
+        call_started = time.perf_counter()
+        await main.media_handler(bot, msg)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return summarize(
+        "media_handler", latencies, elapsed, args.media_iterations,
+        channels=args.channels,
+        cold_ms=round(latencies[0] * 1000, 3),
+        telegram_calls=dict(bot.calls),
+        mongo_ops=fake_db.op_counts(),
+    )
+
+
+async def broadcast(args):
+    # /broadcast to N users; latency figures are per checkpointed batch
+    fake_db = install_fakes(args)
+    await main.ensure_indexes()
+    bot = new_bot(args)
+    main.users.load({"user_id": 1_000_000 + i, "channels": []} for i in range(args.broadcast_users))
+    main.BROADCAST_RATE = args.broadcast_rate
+    main.BROADCAST_PROGRESS_INTERVAL = 10 ** 9
+
+    progress = bot.new_message(FakeChat(main.OWNER_ID), from_user=bot.me, text="📣 Broadcast queued...")
+    result = await main.broadcasts.insert_one({
+        "text": "bench broadcast", "status": "running", "chat_id": progress.chat.id, "progress_msg_id": progress.id,
+        "last_user_id": None, "sent": 0, "failed": 0, "blocked": 0,
+    })
+
+    batch_latencies, last_checkpoint = [], time.perf_counter()
+    checkpoint = main.broadcasts.find_one_and_update
+
+    async def timed_checkpoint(*a, **kw):
+        nonlocal last_checkpoint
+        now = time.perf_counter()
+        batch_latencies.append(now - last_checkpoint)
+        last_checkpoint = now
+        return await checkpoint(*a, **kw)
+
+    main.broadcasts.find_one_and_update = timed_checkpoint
+    started = time.perf_counter()
+    await main.run_broadcast(bot, result.inserted_id)
+    elapsed = time.perf_counter() - started
+
+    job = await main.broadcasts.find_one({"_id": result.inserted_id})
+    return summarize(
+        "broadcast", batch_latencies, elapsed, args.broadcast_users,
+        batch_size=main.BROADCAST_BATCH_SIZE,
+        sent=job.get("sent"), failed=job.get("failed"), blocked=job.get("blocked"),
+        flood_waits=bot.flood_waits,
+        telegram_calls=dict(bot.calls),
+        mongo_ops=fake_db.op_counts(),
+    )
+
+
+async def stats(args):
+    # /stats over a large user base: the point read, plus one explicit recount
+    fake_db = install_fakes(args)
+    await main.ensure_indexes()
+    bot = new_bot(args, flood_every=0)
+    shared_channels = [[{"id": -1003000000000 - i, "title": f"Channel {i}"} for i in range(n)] for n in range(4)]
+    main.users.load({"user_id": i, "channels": shared_channels[i % 4]} for i in range(args.stats_users))
+
+    recount_started = time.perf_counter()
+    totals = await main.recount_counters()
+    recount_seconds = time.perf_counter() - recount_started
+
+    owner, chat = FakeUser(main.OWNER_ID), FakeChat(main.OWNER_ID)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.stats_iterations):
+        msg = bot.new_message(chat, from_user=owner, text="/stats")
+        call_started = time.perf_counter()
+        await main.stats_handler(bot, msg)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return summarize(
+        "stats", latencies, elapsed, args.stats_iterations,
+        users=totals.get("users"), channels=totals.get("channels"),
+        recount_seconds=round(recount_seconds, 4),
+        mongo_ops=fake_db.op_counts(),
+    )
+
+
+WORKLOADS = {
+    "reaction_storm": reaction_storm,
+    "lanes": lanes,
+    "media_handler": media_handler,
+    "broadcast": broadcast,
+    "stats": stats,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the bot's hot paths")
+    parser.add_argument("--only", default=",".join(WORKLOADS), help="Comma-separated workloads to run")
+    parser.add_argument("--quick", action="store_true", help="Small sizes for a smoke run")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tg-latency", type=float, default=0.002, help="Seconds per fake Telegram call")
+    parser.add_argument("--tg-jitter", type=float, default=0.003, help="Extra random seconds per fake Telegram call")
+    parser.add_argument("--mongo-latency", type=float, default=0.0005, help="Seconds per fake Mongo operation")
+    parser.add_argument("--flood-every", type=int, default=0, help="Answer every Nth Telegram call with FloodWait (0 = never)")
+    parser.add_argument("--flood-wait", type=int, default=1, help="FloodWait seconds")
+    parser.add_argument("--taps", type=int, default=5000)
+    parser.add_argument("--storm-users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--edit-window", type=float, default=0.2)
+    parser.add_argument("--write-behind", action="store_true", help="Buffer reaction taps and flush them in bulk")
+    parser.add_argument("--flush-interval", type=float, default=0.5)
+    parser.add_argument("--flush-max-ops", type=int, default=1000)
+    parser.add_argument("--legacy-callbacks", action="store_true", help="Tap with old string callback data")
+    parser.add_argument("--command-every", type=int, default=50, help="lanes: one /help per this many taps")
+    parser.add_argument("--no-lanes", action="store_true", help="lanes: run handlers in the dispatcher pool, without inbound lanes")
+    parser.add_argument("--channels", type=int, default=40)
+    parser.add_argument("--media-iterations", type=int, default=50)
+    parser.add_argument("--broadcast-users", type=int, default=100_000)
+    parser.add_argument("--broadcast-rate", type=float, default=10 ** 9, help="Messages per second budget")
+    parser.add_argument("--stats-users", type=int, default=1_000_000)
+    parser.add_argument("--stats-iterations", type=int, default=200)
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.taps, args.storm_users = 500, 200
+        args.broadcast_users, args.stats_users = 5_000, 20_000
+        args.media_iterations, args.stats_iterations = 10, 20
+    return args
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+async def run(args):
+    results = []
+    for name in args.only.split(","):
+        result = await WORKLOADS[name.strip()](args)
+        print(json.dumps(result, default=str), flush=True)
+        results.append(result)
+    return results
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+    # Same loop Pyrogram bound its dispatcher to at import, like app.run() would use
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("only", "output")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+    return report
+
+
+if __name__ == "__main__":
+    cli(sys.argv[1:])
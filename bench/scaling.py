@@ -0,0 +1,97 @@
+import re
+import sys
+import json
+import time
+import argparse
+import urllib.request
+
+# Measures how a CLUSTER_MODE deployment scales: scrapes /metrics from every instance at the start and end of
+# a window while real or replayed traffic runs, and reports handled updates per second per instance and in total.
+# Usage: python -m bench.scaling --interval 60 http://node1:8080 http://node2:8080 ...
+# Repeat with 1, 2, 4, ... instances under the same load; total_handled_per_s should grow with the node count
+# until Telegram or MongoDB becomes the bottleneck (watch mongo p95 and duplicate claims).
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? ([0-9.eE+-]+|NaN|[+-]Inf)$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+def scrape(url):
+    with urllib.request.urlopen(url.rstrip("/") + "/metrics", timeout=10) as response:
+        text = response.read().decode()
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples[(name, tuple(sorted(LABEL.findall(labels or ""))))] = float(value)
+    return samples
+
+
+def total(samples, name, **labels):
+    wanted = set(labels.items())
+    return sum(value for (n, sample_labels), value in samples.items() if n == name and wanted <= set(sample_labels))
+
+
+def histogram_quantile(before, after, name, q):
+    # Aggregates every label set of one histogram over the window, then interpolates like Histogram.quantile
+    buckets = {}
+    for (n, labels), value in after.items():
+        if n == f"{name}_bucket":
+            bound = dict(labels)["le"]
+            delta = value - before.get((n, labels), 0)
+            buckets[bound] = buckets.get(bound, 0) + delta
+    if not buckets or not buckets.get("+Inf"):
+        return None
+    bounds = sorted((float(b), count) for b, count in buckets.items() if b != "+Inf")
+    rank = q * buckets["+Inf"]
+    lower, below = 0.0, 0
+    for bound, cumulative in bounds:
+        if cumulative >= rank:
+            inside = cumulative - below
+            return round((lower + (bound - lower) * (rank - below) / inside if inside else bound) * 1000, 1)
+        lower, below = bound, cumulative
+    return round(bounds[-1][0] * 1000, 1) if bounds else None
+
+
+def measure(urls, interval):
+    before = {url: scrape(url) for url in urls}
+    started = time.monotonic()
+    time.sleep(interval)
+    after = {url: scrape(url) for url in urls}
+    seconds = time.monotonic() - started
+
+    nodes = []
+    for url in urls:
+        b, a = before[url], after[url]
+        handled = total(a, "handler_latency_seconds_count") - total(b, "handler_latency_seconds_count")
+        nodes.append({
+            "url": url,
+            "leader": total(a, "cluster_leader") == 1,
+            "handled_per_s": round(handled / seconds, 2),
+            "claimed": total(a, "cluster_updates_total", outcome="claimed") - total(b, "cluster_updates_total", outcome="claimed"),
+            "duplicates": total(a, "cluster_updates_total", outcome="duplicate") - total(b, "cluster_updates_total", outcome="duplicate"),
+            "handler_p95_ms": histogram_quantile(b, a, "handler_latency_seconds", 0.95),
+            "mongo_p95_ms": histogram_quantile(b, a, "mongo_command_latency_seconds", 0.95),
+            "floodwait_seconds": total(a, "telegram_floodwait_seconds_total") - total(b, "telegram_floodwait_seconds_total"),
+        })
+    return {
+        "instances": len(urls),
+        "seconds": round(seconds, 1),
+        "total_handled_per_s": round(sum(node["handled_per_s"] for node in nodes), 2),
+        "leaders": sum(1 for node in nodes if node["leader"]),
+        "nodes": nodes,
+    }
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Measure handled-update throughput across cluster instances")
+    parser.add_argument("urls", nargs="+", help="Base URL of each instance's health/metrics server")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between the two scrapes")
+    args = parser.parse_args(argv)
+    report = measure(args.urls, args.interval)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    cli(sys.argv[1:])
@@ -1,10 +1,29 @@
 import os
+import re
+import json
+import time
+import socket
+import zlib
+import math
+import bisect
+import itertools
+import contextlib
+import contextvars
+import functools
+import threading
+import asyncio
+import datetime
 import logging
-from pyrogram import Client, filters, enums
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from collections import OrderedDict, deque
+from pyrogram import Client, filters, enums, idle, StopPropagation, ContinuePropagation
+from pyrogram.errors import (
+    FloodWait, MessageNotModified, UserIsBlocked, InputUserDeactivated,
+    FileIdInvalid, FileReferenceExpired, FileReferenceInvalid, MediaEmpty
+)
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ChatMemberUpdated
 from motor.motor_asyncio import AsyncIOMotorClient
-from flask import Flask
-import threading
+from pymongo import ReturnDocument, UpdateOne, CursorType, monitoring
+from pymongo.errors import DuplicateKeyError, CollectionInvalid
 
 # 🔹 Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -18,50 +37,1201 @@ MONGO_URL = os.environ.get("MONGO_URL", "your_mongodb_url")
 REQUEST_GROUP_URL = os.environ.get("REQUEST_GROUP_URL", "https://t.me/Prime_Movie_Watch_Dawnload/71") # Make it configurable
 AUTH_CHANNEL = int(os.environ.get("AUTH_CHANNEL", "-1002245813234")) # Make it configurable and ensure int type
 OWNER_ID = int(os.environ.get("OWNER_ID", "5926160191")) # Make it configurable via env variable
+ADMIN_CACHE_TTL = int(os.environ.get("ADMIN_CACHE_TTL", "600")) # Seconds to trust a positive bot-admin check
+ADMIN_CACHE_NEGATIVE_TTL = int(os.environ.get("ADMIN_CACHE_NEGATIVE_TTL", "60")) # Seconds to trust a negative one
+ADMIN_CACHE_SIZE = int(os.environ.get("ADMIN_CACHE_SIZE", "10000"))
+SUB_CACHE_TTL = int(os.environ.get("SUB_CACHE_TTL", "900")) # Seconds to trust "user is subscribed"
+SUB_CACHE_NEGATIVE_TTL = int(os.environ.get("SUB_CACHE_NEGATIVE_TTL", "20")) # Kept short so Join -> Refresh feels instant
+SUB_CACHE_SIZE = int(os.environ.get("SUB_CACHE_SIZE", "100000"))
+AUTH_CHANNEL_INFO_TTL = int(os.environ.get("AUTH_CHANNEL_INFO_TTL", "21600")) # Seconds to reuse AUTH_CHANNEL title + invite link
+ADMIN_CHECK_CONCURRENCY = int(os.environ.get("ADMIN_CHECK_CONCURRENCY", "10")) # Parallel admin checks per media message
+ADMIN_CHECK_TIMEOUT = float(os.environ.get("ADMIN_CHECK_TIMEOUT", "3")) # Seconds a channel menu waits for all its admin checks; the rest show as unverified
+REACTION_EDIT_WINDOW = float(os.environ.get("REACTION_EDIT_WINDOW", "1.5")) # Seconds between keyboard edits of one post
+ALBUM_WINDOW = float(os.environ.get("ALBUM_WINDOW", "1.0")) # Seconds to wait for the rest of an album before offering one picker
+ALBUM_COMPANION_TEXT = os.environ.get("ALBUM_COMPANION_TEXT", "👆 React to this album") # Message that carries an album's keyboard
+REACTION_WRITE_BEHIND = os.environ.get("REACTION_WRITE_BEHIND", "false").lower() in ("1", "true", "yes") # Buffer taps, flush in bulk (single instance)
+REACTION_FLUSH_INTERVAL = float(os.environ.get("REACTION_FLUSH_INTERVAL", "0.5")) # Seconds between write-behind flushes
+REACTION_FLUSH_MAX_OPS = int(os.environ.get("REACTION_FLUSH_MAX_OPS", "1000")) # Buffered votes that trigger an early flush
+REACTION_BUFFER_LIMIT = int(os.environ.get("REACTION_BUFFER_LIMIT", "20000")) # Past this, new votes are written through instead of buffered
+USER_CACHE_ENABLED = os.environ.get("USER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes") # Safe with CLUSTER_MODE: writes invalidate other instances
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "300")) # Seconds a cached user settings document stays valid
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "50000"))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30")) # Sends and edits per second, bot-wide
+OUTBOUND_ANSWER_RATE = float(os.environ.get("OUTBOUND_ANSWER_RATE", "1000")) # Callback answers per second; their own budget, apart from sends
+OUTBOUND_PRIVATE_RATE = float(os.environ.get("OUTBOUND_PRIVATE_RATE", "1")) # New messages per second into one private chat
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", os.environ.get("POST_CHAT_RATE", "0.33"))) # Into one channel or group (~20/min)
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", "3")) # Messages a quiet chat may receive back to back
+OUTBOUND_MAX_FLOOD_WAIT = int(os.environ.get("OUTBOUND_MAX_FLOOD_WAIT", os.environ.get("POST_MAX_FLOOD_WAIT", "10"))) # Longer FloodWaits are raised instead of waited out
+POST_WORKERS = int(os.environ.get("POST_WORKERS", "4")) # Concurrent post queue workers
+POST_MAX_ATTEMPTS = int(os.environ.get("POST_MAX_ATTEMPTS", "5")) # Tries before a queued post is marked failed
+POST_RETRY_BASE = float(os.environ.get("POST_RETRY_BASE", "10")) # Seconds; doubles on every failed attempt
+POST_RETRY_MAX = float(os.environ.get("POST_RETRY_MAX", "900")) # Cap for the retry backoff
+POST_QUEUE_POLL = float(os.environ.get("POST_QUEUE_POLL", "5")) # Idle workers re-check for due jobs this often
+POST_JOB_STALE = float(os.environ.get("POST_JOB_STALE", "600")) # Seconds a running job may stay unfinished before it is claimed again
+LANE_REACTIONS_WORKERS = int(os.environ.get("LANE_REACTIONS_WORKERS", "16")) # Reaction taps handled at once
+LANE_REACTIONS_SIZE = int(os.environ.get("LANE_REACTIONS_SIZE", "2000")) # Queued taps past this are shed
+LANE_POSTING_WORKERS = int(os.environ.get("LANE_POSTING_WORKERS", "8")) # Picker, post and channel/button management callbacks
+LANE_POSTING_SIZE = int(os.environ.get("LANE_POSTING_SIZE", "500"))
+LANE_PRIVATE_WORKERS = int(os.environ.get("LANE_PRIVATE_WORKERS", "8")) # Private commands, media and menu buttons
+LANE_PRIVATE_SIZE = int(os.environ.get("LANE_PRIVATE_SIZE", "1000"))
+LANE_OWNER_WORKERS = int(os.environ.get("LANE_OWNER_WORKERS", "2")) # Everything the owner sends, so /stats and /perf answer mid-storm
+LANE_OWNER_SIZE = int(os.environ.get("LANE_OWNER_SIZE", "100"))
+LANE_SHED_TEXT = os.environ.get("LANE_SHED_TEXT", "⏳ Busy right now, tap again in a moment") # Answer to a shed reaction tap
+LANE_DROP_ANSWERS = int(os.environ.get("LANE_DROP_ANSWERS", "256")) # Answers to dropped taps in flight at once; past this they go unanswered
+CALLBACK_COOLDOWN = float(os.environ.get("CALLBACK_COOLDOWN", "1.0")) # Seconds before the same user's tap on the same button counts again
+CALLBACK_USER_LIMIT = int(os.environ.get("CALLBACK_USER_LIMIT", "20")) # Button taps per user per CALLBACK_USER_WINDOW
+CALLBACK_USER_WINDOW = float(os.environ.get("CALLBACK_USER_WINDOW", "10"))
+SUBMIT_DEDUP_WINDOW = float(os.environ.get("SUBMIT_DEDUP_WINDOW", "30")) # Seconds a post tap is remembered, so a re-tap can't post twice
+THROTTLE_MAX_KEYS = int(os.environ.get("THROTTLE_MAX_KEYS", "50000")) # Keys per throttle generation; memory stays bounded by twice this
+SLOW_CALL_THRESHOLD = float(os.environ.get("SLOW_CALL_THRESHOLD", "0")) # Seconds; log handlers/API/Mongo calls slower than this (0 = off)
+PORT = int(os.environ.get("PORT", 8080)) # Health check + /metrics HTTP port
+INDEX_STRICT = os.environ.get("INDEX_STRICT", "false").lower() in ("1", "true", "yes") # Refuse to start without required indexes
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25")) # Messages per second across the whole broadcast
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10")) # Sends in flight at once
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "200")) # Users per checkpoint
+BROADCAST_MAX_RETRIES = int(os.environ.get("BROADCAST_MAX_RETRIES", "3")) # FloodWait retries per user
+BROADCAST_PROGRESS_INTERVAL = int(os.environ.get("BROADCAST_PROGRESS_INTERVAL", "15")) # Seconds between progress edits
+BROADCAST_RETRY_MAX = float(os.environ.get("BROADCAST_RETRY_MAX", "60")) # Cap for the backoff when a Mongo read or write of a broadcast fails
+CLUSTER_MODE = os.environ.get("CLUSTER_MODE", "false").lower() in ("1", "true", "yes") # Several instances share one bot token and DB (see README)
+INSTANCE_ID = os.environ.get("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+SESSION_NAME = os.environ.get("SESSION_NAME", "ChannelPostBot") # Give each instance its own when they share a working directory
+LEASE_TTL = float(os.environ.get("LEASE_TTL", "30")) # Seconds the leader lease survives without renewal
+LEASE_RENEW_INTERVAL = float(os.environ.get("LEASE_RENEW_INTERVAL", "10")) # Must stay well below LEASE_TTL
+UPDATE_CLAIM_TTL = int(os.environ.get("UPDATE_CLAIM_TTL", "3600")) # Seconds an update claim is kept for deduplication
+ASSET_WARMUP_CHAT = int(os.environ.get("ASSET_WARMUP_CHAT", str(OWNER_ID))) # Chat used to upload new bot images once at startup (0 = off)
+CLUSTER_EVENTS_SIZE = int(os.environ.get("CLUSTER_EVENTS_SIZE", str(16 * 1024 * 1024))) # Bytes of the capped cluster_events collection
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", "10")) # Seconds between rollup writes
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", "5")) # Seconds between writes of the /stats totals
+ANALYTICS_HOURLY_RETENTION_DAYS = int(os.environ.get("ANALYTICS_HOURLY_RETENTION_DAYS", "7")) # Hourly rollups older than this are deleted
+ANALYTICS_DAILY_RETENTION_DAYS = int(os.environ.get("ANALYTICS_DAILY_RETENTION_DAYS", "365")) # Daily rollups older than this are deleted
+ANALYTICS_TOP_KEEP = int(os.environ.get("ANALYTICS_TOP_KEEP", "10")) # Posts kept per day once a daily rollup is compacted
+ANALYTICS_COMPACT_INTERVAL = float(os.environ.get("ANALYTICS_COMPACT_INTERVAL", "3600")) # Seconds between compaction runs (leader only)
+PENDING_MEDIA_TTL = int(os.environ.get("PENDING_MEDIA_TTL", "86400")) # Seconds a sent media stays postable from its picker
+PENDING_MEDIA_SIZE = int(os.environ.get("PENDING_MEDIA_SIZE", "100000")) # Pending media kept in memory, across all users
+PENDING_MEDIA_PERSIST = os.environ.get("PENDING_MEDIA_PERSIST", str(CLUSTER_MODE)).lower() in ("1", "true", "yes") # Mirror them to Mongo (on with CLUSTER_MODE)
+
+# 🔹 Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+class Histogram:
+    # Fixed buckets: observe() is a bisect and two additions, no per-call allocation
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Linear interpolation inside the bucket holding the q-th observation; the +Inf bucket reports the last bound
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative, lower = 0, 0.0
+        for i, count in enumerate(self.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+            if count and cumulative + count >= rank:
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = upper
+        return self.buckets[-1]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._meta = {} # name -> (type, help)
+        self._counters = {} # (name, labels) -> value
+        self._gauges = {}
+        self._histograms = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def histograms(self, name: str):
+        return [(dict(labels), histogram) for (n, labels), histogram in list(self._histograms.items()) if n == name]
+
+    def counters(self, name: str):
+        return [(dict(labels), value) for (n, labels), value in list(self._counters.items()) if n == name]
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines, seen = [], set()
+        def header(name):
+            if name not in seen and name in self._meta:
+                seen.add(name)
+                kind, help_text = self._meta[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), value in sorted(self._gauges.items()):
+            header(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+            header(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("telegram_updates_total", "counter", "Updates received from Telegram")
+metrics.describe("handler_latency_seconds", "histogram", "Time spent in each update handler")
+metrics.describe("telegram_api_calls_total", "counter", "Raw Telegram API calls by method")
+metrics.describe("telegram_floodwait_seconds_total", "counter", "Seconds of FloodWait returned by Telegram")
+metrics.describe("mongo_ping_seconds", "gauge", "Latency of a MongoDB ping at scrape time")
+metrics.describe("post_queue_pending", "gauge", "Post jobs waiting to be published")
+metrics.describe("last_update_age_seconds", "gauge", "Seconds since the last update was received")
+metrics.describe("handler_errors_total", "counter", "Update handlers that raised")
+metrics.describe("handlers_in_flight", "gauge", "Update handlers currently running")
+metrics.describe("telegram_api_latency_seconds", "histogram", "Raw Telegram API call latency by method")
+metrics.describe("telegram_api_errors_total", "counter", "Raw Telegram API calls that raised, by method and error")
+metrics.describe("telegram_api_in_flight", "gauge", "Raw Telegram API calls currently waiting for a response")
+metrics.describe("mongo_command_latency_seconds", "histogram", "MongoDB command latency by command name")
+metrics.describe("mongo_command_errors_total", "counter", "MongoDB commands that failed, by command name")
+metrics.describe("mongo_commands_in_flight", "gauge", "MongoDB commands currently running")
+metrics.describe("reaction_flush_seconds", "histogram", "Time to write one write-behind reaction batch to MongoDB")
+metrics.describe("reaction_flush_batch_size", "histogram", "Buffered votes written per write-behind flush")
+metrics.describe("reaction_flush_errors_total", "counter", "Write-behind reaction flushes that failed and were retried")
+metrics.describe("reaction_buffer_pending", "gauge", "Reaction votes buffered and not yet written to MongoDB")
+metrics.describe("cluster_updates_total", "counter", "Updates claimed by this instance or skipped as already claimed")
+metrics.describe("cluster_leader", "gauge", "1 while this instance holds the leader lease")
+metrics.describe("cluster_events_total", "counter", "Cache invalidations and wake-ups sent to or received from other instances")
+metrics.describe("inbound_lane_depth", "gauge", "Updates queued in each inbound lane")
+metrics.describe("inbound_lane_wait_seconds", "histogram", "Time updates waited in their inbound lane before a handler ran")
+metrics.describe("inbound_dropped_total", "counter", "Reaction taps shed by a full lane or merged into a newer tap")
+metrics.describe("inbound_drop_answers_skipped_total", "counter", "Dropped taps left unanswered because too many answers were already in flight")
+metrics.describe("callback_throttled_total", "counter", "Callback taps answered without any work: over the user limit, a repeated button or a duplicate post")
+metrics.describe("stats_flush_errors_total", "counter", "Flushes of the /stats totals that failed and were retried")
+metrics.describe("analytics_flush_errors_total", "counter", "Channel rollup flushes that failed and were retried")
+metrics.describe("outbound_queue_depth", "gauge", "Outbound Telegram calls waiting for a send slot, by priority class")
+metrics.describe("outbound_wait_seconds", "histogram", "Time outbound Telegram calls waited for a send slot, by priority class")
+metrics.describe("outbound_floodwait_pauses_total", "counter", "FloodWaits that paused one chat or a whole priority class")
+
+def log_slow_call(kind: str, name: str, seconds: float):
+    if SLOW_CALL_THRESHOLD and seconds >= SLOW_CALL_THRESHOLD:
+        logger.warning(f"Slow {kind} {name}: {seconds * 1000:.0f} ms")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    # Driver-level hook, so every Motor operation (including cursor getMores) is measured without wrapping collections.
+    # pymongo calls it from Motor's worker threads; the lock keeps the read-modify-write updates exact.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def started(self, event):
+        with self._lock:
+            self._in_flight += 1
+            metrics.set("mongo_commands_in_flight", self._in_flight)
+
+    def _finished(self, event, failed: bool):
+        seconds = event.duration_micros / 1e6
+        with self._lock:
+            self._in_flight -= 1
+            metrics.set("mongo_commands_in_flight", self._in_flight)
+            metrics.observe("mongo_command_latency_seconds", seconds, command=event.command_name)
+            if failed:
+                metrics.inc("mongo_command_errors_total", command=event.command_name)
+        log_slow_call("mongo command", event.command_name, seconds)
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
 
 # 🔹 MongoDB
-mongo_client = AsyncIOMotorClient(MONGO_URL)
+mongo_client = AsyncIOMotorClient(MONGO_URL, event_listeners=[MongoCommandMetrics()])
 db = mongo_client["postbot"]
 users = db["users"]
-reactions_collection = db["reactions"]
+reactions_collection = db["reactions"] # One counter document per post: {"channel_id", "message_id", "counts": {"like", "love"}}
+reaction_votes = db["reaction_votes"] # One document per (post, user): {"channel_id", "message_id", "user_id", "reaction"}
+counters = db["counters"] # Single {"_id": "global"} document with running totals for /stats
+broadcasts = db["broadcasts"] # One document per broadcast job, with its checkpoint and counters
+broadcast_failures = db["broadcast_failures"] # One document per failed delivery: {"job_id", "user_id", "error"}
+post_jobs = db["post_jobs"] # Post queue: one document per (source message, channel) with status, run_at and attempts
+update_claims = db["update_claims"] # Cluster mode: one document per handled update, so only one instance handles it
+leases = db["leases"] # Cluster mode: {"_id": lease name, "owner": instance id, "expires_at"}
+media_assets = db["media_assets"] # One document per static bot image: {"_id": asset name, "url", "file_id"}
+channel_rollups = db["channel_rollups"] # {"channel_id", "period": "hour"|"day", "start", "posts", "counts", "post_reactions" (day only)}
+pending_media = db["pending_media"] # With PENDING_MEDIA_PERSIST: {"_id": "user_id:msg_id", "at"} per media offered a channel picker
+cluster_events = db["cluster_events"] # Cluster mode: capped log of cache invalidations and wake-ups, tailed by every instance
 
 # 🔹 Pyrogram Bot
-app = Client("ChannelPostBot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+app = Client(SESSION_NAME, api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, sleep_threshold=OUTBOUND_MAX_FLOOD_WAIT)
+
+# 🔹 Instrumentation
+last_update_at = None # monotonic time of the last update, for liveness
+
+@app.on_raw_update(group=-1)
+async def update_counter(bot, update, users_, chats):
+    global last_update_at
+    last_update_at = time.monotonic()
+    metrics.inc("telegram_updates_total")
+
+def instrument_handlers(client: Client):
+    # Wraps every registered handler callback with a latency histogram; run once after handlers are registered
+    # and before the client starts.
+    # Pyrogram's workers only sort the update into its inbound lane; the lane's own workers claim (in cluster mode)
+    # and run it, so instances that lose the claim skip it without timing it. Callback taps are throttled before
+    # the claim, so a hammered button costs no claim insert either.
+    for group in client.dispatcher.groups.values():
+        for handler in group:
+            if handler.callback is update_counter or getattr(handler.callback, "__wrapped__", None):
+                continue
+            callback = timed_handler(handler.callback)
+            if CLUSTER_MODE:
+                callback = claimed_handler(callback)
+            if handler.callback is callback_handler:
+                callback = throttled_handler(callback)
+            handler.callback = laned_handler(callback)
+
+def timed_handler(func):
+    name = func.__name__
+    in_flight = 0
+
+    @functools.wraps(func)
+    async def wrapper(client, *args):
+        nonlocal in_flight
+        in_flight += 1
+        metrics.set("handlers_in_flight", in_flight, handler=name)
+        started = time.perf_counter()
+        try:
+            return await func(client, *args)
+        except (StopPropagation, ContinuePropagation):
+            raise # Control flow, not failures
+        except Exception:
+            metrics.inc("handler_errors_total", handler=name)
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            in_flight -= 1
+            metrics.set("handlers_in_flight", in_flight, handler=name)
+            metrics.observe("handler_latency_seconds", seconds, handler=name)
+            log_slow_call("handler", name, seconds)
+    return wrapper
+
+def instrument_api_calls(client: Client):
+    # Every high-level Pyrogram method goes through Client.invoke, so counting there covers all API calls
+    raw_invoke = client.invoke
+    in_flight = 0
+
+    async def invoke(query, *args, **kwargs):
+        nonlocal in_flight
+        method = type(query).__name__
+        metrics.inc("telegram_api_calls_total", method=method)
+        in_flight += 1
+        metrics.set("telegram_api_in_flight", in_flight)
+        started = time.perf_counter()
+        try:
+            return await raw_invoke(query, *args, **kwargs)
+        except FloodWait as e:
+            metrics.inc("telegram_floodwait_seconds_total", e.value, method=method)
+            metrics.inc("telegram_api_errors_total", method=method, error="FloodWait")
+            raise
+        except Exception as e:
+            metrics.inc("telegram_api_errors_total", method=method, error=type(e).__name__)
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            in_flight -= 1
+            metrics.set("telegram_api_in_flight", in_flight)
+            metrics.observe("telegram_api_latency_seconds", seconds, method=method)
+            log_slow_call("Telegram call", method, seconds)
+
+    client.invoke = invoke
+
+# 🔹 Inbound lanes
+# Pyrogram's worker pool runs updates in arrival order, so a reaction storm on a big channel used to hold /start
+# and picker taps behind thousands of react callbacks. Each update now goes to a lane with its own bounded queue
+# and workers; only the reaction lane sheds, the others push back on Pyrogram's workers when full.
+class InboundLane:
+    def __init__(self, name: str, workers: int, size: int, shed: bool = False):
+        self.name = name
+        self.workers = workers
+        self.shed = shed
+        self._queue = asyncio.Queue(size)
+        self._keyed = {} # key -> entry still queued, so a newer tap for the same key replaces it
+        self._tasks = []
+        self._answers = set() # Background answers to dropped taps
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _drop(self, update, reason: str):
+        # Runs in Pyrogram's dispatcher worker, so the answer goes to a background task instead of being awaited
+        metrics.inc("inbound_dropped_total", lane=self.name, reason=reason)
+        if not hasattr(update, "data"):
+            return
+        if len(self._answers) >= LANE_DROP_ANSWERS:
+            metrics.inc("inbound_drop_answers_skipped_total", lane=self.name)
+            return
+        task = asyncio.create_task(self._answer(update, LANE_SHED_TEXT if reason == "shed" else None))
+        self._answers.add(task)
+        task.add_done_callback(self._answers.discard)
+
+    async def _answer(self, update, text):
+        try:
+            await update.answer(text)
+        except Exception:
+            pass
+
+    async def submit(self, callback, client, update, key=None):
+        queued = self._keyed.get(key) if key is not None else None
+        if queued is not None:
+            # Reactions are last-tap-wins, so the queued tap can simply take the newer one's place
+            old, queued[2] = queued[2], update
+            return self._drop(old, "merged")
+        entry = [callback, client, update, time.monotonic(), key]
+        if self.shed:
+            try:
+                self._queue.put_nowait(entry)
+            except asyncio.QueueFull:
+                return self._drop(update, "shed")
+        else:
+            await self._queue.put(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        metrics.set("inbound_lane_depth", self._queue.qsize(), lane=self.name)
+
+    async def _work(self):
+        while True:
+            entry = await self._queue.get()
+            callback, client, update, enqueued_at, key = entry
+            if key is not None and self._keyed.get(key) is entry:
+                del self._keyed[key]
+            metrics.set("inbound_lane_depth", self._queue.qsize(), lane=self.name)
+            metrics.observe("inbound_lane_wait_seconds", time.monotonic() - enqueued_at, lane=self.name)
+            try:
+                await callback(client, update)
+            except (StopPropagation, ContinuePropagation):
+                pass
+            except Exception as e:
+                logger.exception(f"Unhandled error in {self.name} lane: {e}")
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._answers, return_exceptions=True)
+        self._tasks.clear()
+
+INBOUND_LANES = {
+    "reactions": InboundLane("reactions", LANE_REACTIONS_WORKERS, LANE_REACTIONS_SIZE, shed=True),
+    "posting": InboundLane("posting", LANE_POSTING_WORKERS, LANE_POSTING_SIZE),
+    "private": InboundLane("private", LANE_PRIVATE_WORKERS, LANE_PRIVATE_SIZE),
+    "owner": InboundLane("owner", LANE_OWNER_WORKERS, LANE_OWNER_SIZE),
+}
+
+def route_inbound(update):
+    # -> (lane, merge key or None). Only callback queries carry .data; checked by duck type so bench fakes route too
+    if hasattr(update, "data"):
+        op, _ = parse_callback(update.data)
+        if op == OP_REACT and update.message:
+            return INBOUND_LANES["reactions"], (update.from_user.id, update.message.chat.id, update.message.id)
+        if update.from_user and update.from_user.id == OWNER_ID:
+            return INBOUND_LANES["owner"], None
+        return INBOUND_LANES["posting" if op in POSTING_OPS else "private"], None
+    if isinstance(update, ChatMemberUpdated):
+        return INBOUND_LANES["posting"], None
+    from_user = getattr(update, "from_user", None)
+    if from_user and from_user.id == OWNER_ID:
+        return INBOUND_LANES["owner"], None
+    return INBOUND_LANES["private"], None
+
+def laned_handler(func):
+    @functools.wraps(func)
+    async def wrapper(client, update):
+        lane, key = route_inbound(update)
+        await lane.submit(func, client, update, key)
+    return wrapper
+
+def start_inbound_lanes():
+    for lane in INBOUND_LANES.values():
+        lane.start()
+
+async def close_inbound_lanes():
+    await asyncio.gather(*(lane.close() for lane in INBOUND_LANES.values()))
+
+# 🔹 Health & metrics HTTP server
+async def collect_health() -> dict:
+    health = {"telegram_connected": app.is_connected, "mongo_ok": False}
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), 5)
+        health["mongo_ok"] = True
+        health["mongo_ping_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        metrics.set("mongo_ping_seconds", time.perf_counter() - started)
+        health["pending_posts"] = await post_jobs.count_documents({"status": "pending"})
+        metrics.set("post_queue_pending", health["pending_posts"])
+    except Exception as e:
+        health["mongo_error"] = str(e)
+    if last_update_at is not None:
+        health["last_update_age_seconds"] = round(time.monotonic() - last_update_at, 1)
+        metrics.set("last_update_age_seconds", health["last_update_age_seconds"])
+    health["inbound_queued"] = {name: lane.depth() for name, lane in INBOUND_LANES.items()}
+    health["outbound_queued"] = outbound.depth()
+    if CLUSTER_MODE:
+        health["instance"] = INSTANCE_ID
+        health["leader"] = is_leader
+    health["status"] = "ok" if health["telegram_connected"] and health["mongo_ok"] else "degraded"
+    return health
+
+async def route_http(path: str):
+    if path == "/":
+        return 200, "text/plain", "Bot is running!"
+    if path == "/health":
+        health = await collect_health()
+        return (200 if health["status"] == "ok" else 503), "application/json", json.dumps(health)
+    if path == "/metrics":
+        await collect_health() # Refreshes the scrape-time gauges
+        return 200, "text/plain; version=0.0.4", metrics.render()
+    return 404, "text/plain", "Not found"
+
+async def handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Just enough HTTP/1.0 for health checks and Prometheus scrapes, on the bot's own event loop
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass # Headers are not needed
+        parts = request_line.decode("latin-1").split()
+        path = parts[1].split("?", 1)[0] if len(parts) > 1 else "/"
+        status, content_type, body = await route_http(path)
+        payload = body.encode()
+        reason = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}.get(status, "OK")
+        writer.write(
+            f"HTTP/1.0 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"HTTP request failed: {e}")
+    finally:
+        writer.close()
+
+async def start_http_server():
+    server = await asyncio.start_server(handle_http, "0.0.0.0", PORT)
+    logger.info(f"Health/metrics server listening on port {PORT}")
+    return server
+
+# 🔹 Caches
+_MISSING = object()
+
+class TTLCache:
+    # Bounded LRU mapping whose entries expire after a per-entry TTL; cheap enough to sit on every hot path
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=_MISSING):
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+bot_admin_cache = TTLCache(ADMIN_CACHE_SIZE, ADMIN_CACHE_TTL) # channel_id -> bool
+subscription_cache = TTLCache(SUB_CACHE_SIZE, SUB_CACHE_TTL) # (channel_id, user_id) -> bool
+auth_channel_cache = TTLCache(1, AUTH_CHANNEL_INFO_TTL) # AUTH_CHANNEL -> (title, invite_link, missing_invite_rights)
+auth_channel_lock = asyncio.Lock()
+bot_me = None # Resolved once at startup
+
+async def get_bot_me(bot: Client):
+    global bot_me
+    if bot_me is None:
+        bot_me = await bot.get_me()
+    return bot_me
+
+# 🔹 Outbound scheduler
+# Every send and edit waits here for a slot: one bot-wide token bucket, one bucket per chat for new messages, and
+# three priority classes served strictly in order, so a broadcast never delays a reply. Callback answers only draw
+# on a budget of their own, so a storm of reaction taps can't hold up /start either.
+PRIORITY_INTERACTIVE, PRIORITY_EDIT, PRIORITY_BULK = range(3)
+PRIORITY_NAMES = ("interactive", "edit", "bulk")
+SCHEDULED_METHODS = {"SendMessage", "SendMedia", "SendMultiMedia", "ForwardMessages", "EditMessage", "DeleteMessages"}
+ANSWER_METHODS = {"SetBotCallbackAnswer"} # Not messages: paced by their own bucket and never queued behind sends
+CHAT_LIMITED_METHODS = {"SendMessage", "SendMedia", "SendMultiMedia", "ForwardMessages"} # Per-chat limits count new messages
+outbound_priority = contextvars.ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+@contextlib.contextmanager
+def outbound_class(priority: int):
+    # Calls made inside, and in tasks created inside, queue in this class
+    token = outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        outbound_priority.reset(token)
+
+def outbound_chat(query):
+    # ("user", id) or ("chat", id) for the peer a raw query writes to, or None
+    for field in ("peer", "to_peer", "channel"):
+        peer = getattr(query, field, None)
+        if peer is None:
+            continue
+        if getattr(peer, "user_id", None) is not None:
+            return "user", peer.user_id
+        for attr in ("channel_id", "chat_id"):
+            if getattr(peer, attr, None) is not None:
+                return "chat", getattr(peer, attr)
+    return None
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def ready_at(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self.ready_at(now)
+        self.tokens -= 1
+
+class OutboundScheduler:
+    def __init__(self, global_rate: float, answer_rate: float, private_rate: float, group_rate: float, chat_burst: float, scan_depth: int = 64):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.answer_bucket = TokenBucket(answer_rate, max(1.0, answer_rate))
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.scan_depth = scan_depth # Entries looked at per class, so one flooded chat doesn't block the others behind it
+        self._buckets = TTLCache(100000, 3600) # chat -> TokenBucket
+        self._paused = TTLCache(100000, 3600) # chat -> monotonic time its FloodWait ends
+        self._class_paused = [0.0] * len(PRIORITY_NAMES)
+        self._queues = [deque() for _ in PRIORITY_NAMES] # (future, chat, limited, enqueued_at)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def depth(self) -> dict:
+        return {name: len(queue) for name, queue in zip(PRIORITY_NAMES, self._queues)}
+
+    def _bucket(self, chat) -> TokenBucket:
+        bucket = self._buckets.get(chat)
+        if bucket is _MISSING:
+            bucket = TokenBucket(self.private_rate if chat[0] == "user" else self.group_rate, self.chat_burst)
+        self._buckets.set(chat, bucket) # Refreshes the TTL of chats that keep sending
+        return bucket
+
+    def _ready_at(self, chat, limited: bool, now: float) -> float:
+        ready = self.global_bucket.ready_at(now)
+        if chat is not None:
+            ready = max(ready, self._paused.get(chat, 0.0))
+            if limited:
+                ready = max(ready, self._bucket(chat).ready_at(now))
+        return ready
+
+    def _grant(self, priority: int, future, chat, limited: bool, enqueued_at: float, now: float):
+        self.global_bucket.take(now)
+        if limited:
+            self._bucket(chat).take(now)
+        metrics.observe("outbound_wait_seconds", now - enqueued_at, priority=PRIORITY_NAMES[priority])
+        if future is not None:
+            future.set_result(None)
+
+    async def acquire(self, chat, limited: bool, priority: int):
+        now = time.monotonic()
+        if not any(self._queues) and self._class_paused[priority] <= now and self._ready_at(chat, limited, now) <= now:
+            return self._grant(priority, None, chat, limited, now, now) # Idle fast path, nothing to overtake
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues[priority]
+        queue.append((future, chat, limited, now))
+        metrics.set("outbound_queue_depth", len(queue), priority=PRIORITY_NAMES[priority])
+        self._wakeup.set()
+        await future
+
+    async def acquire_answer(self):
+        # Reserves the next answer slot (tokens may go negative), so concurrent answers queue up in arrival order
+        now = time.monotonic()
+        ready = self.answer_bucket.ready_at(now)
+        self.answer_bucket.take(now)
+        metrics.observe("outbound_wait_seconds", ready - now, priority="answer")
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+    def _dispatch(self) -> float:
+        # Grants everything that may go now, highest class first; returns seconds until the next entry could go
+        now = time.monotonic()
+        next_at = math.inf
+        for priority, queue in enumerate(self._queues):
+            if not queue:
+                continue
+            if self._class_paused[priority] > now:
+                next_at = min(next_at, self._class_paused[priority])
+                continue
+            budget_spent = False
+            for entry in list(itertools.islice(queue, self.scan_depth)):
+                future, chat, limited, enqueued_at = entry
+                if future.done(): # The caller was cancelled while queued
+                    queue.remove(entry)
+                    continue
+                ready = self._ready_at(chat, limited, now)
+                if ready > now:
+                    global_at = self.global_bucket.ready_at(now)
+                    next_at = min(next_at, ready, global_at if global_at > now else math.inf)
+                    budget_spent = global_at > now
+                    if budget_spent:
+                        break
+                    continue
+                queue.remove(entry)
+                self._grant(priority, future, chat, limited, enqueued_at, now)
+            metrics.set("outbound_queue_depth", len(queue), priority=PRIORITY_NAMES[priority])
+            if budget_spent:
+                break # Lower classes wait for the bot-wide budget too
+        return next_at - now
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = self._dispatch()
+            except Exception as e:
+                logger.error(f"Outbound scheduler dispatch failed: {e}")
+                delay = 1.0
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if delay == math.inf else max(delay, 0.001))
+            except asyncio.TimeoutError:
+                pass
+
+    def flood_wait(self, chat, priority: int, seconds: float) -> bool:
+        # A flood on a private chat during bulk sends means the bot-wide budget is gone (a broadcast writes to each
+        # user once), so the whole class backs off; otherwise only the chat does and everything else keeps flowing.
+        # Returns False when nothing was paused: a call with no chat outside bulk sends waits out its own flood.
+        until = time.monotonic() + seconds
+        if priority == PRIORITY_BULK and (chat is None or chat[0] == "user"):
+            self._class_paused[priority] = max(self._class_paused[priority], until)
+            metrics.inc("outbound_floodwait_pauses_total", scope="class", priority=PRIORITY_NAMES[priority])
+        elif chat is not None:
+            self._paused.set(chat, until, ttl=seconds)
+            metrics.inc("outbound_floodwait_pauses_total", scope="chat", priority=PRIORITY_NAMES[priority])
+        else:
+            metrics.inc("outbound_floodwait_pauses_total", scope="call", priority=PRIORITY_NAMES[priority])
+            return False
+        self._wakeup.set()
+        return True
+
+    def install(self, client: Client):
+        # Wraps Client.invoke outside the API metrics, so time spent queued isn't counted as Telegram latency.
+        # Short FloodWaits are waited out here rather than inside Pyrogram's session, where they'd hold no pause.
+        inner = client.invoke
+
+        async def invoke(query, *args, sleep_threshold=None, **kwargs):
+            method = type(query).__name__
+            if method not in SCHEDULED_METHODS and method not in ANSWER_METHODS:
+                return await inner(query, *args, sleep_threshold=sleep_threshold, **kwargs)
+            answer = method in ANSWER_METHODS
+            chat = None if answer else outbound_chat(query)
+            limited = chat is not None and method in CHAT_LIMITED_METHODS
+            priority = outbound_priority.get()
+            threshold = client.sleep_threshold if sleep_threshold is None else sleep_threshold
+            while True:
+                if answer:
+                    await self.acquire_answer()
+                else:
+                    await self.acquire(chat, limited, priority)
+                try:
+                    return await inner(query, *args, sleep_threshold=0, **kwargs)
+                except FloodWait as e:
+                    paused = self.flood_wait(chat, priority, e.value)
+                    if e.value > threshold:
+                        raise
+                    if not paused:
+                        await asyncio.sleep(e.value) # Only this call waits
+
+        client.invoke = invoke
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+outbound = OutboundScheduler(OUTBOUND_GLOBAL_RATE, OUTBOUND_ANSWER_RATE, OUTBOUND_PRIVATE_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_CHAT_BURST)
+
+# 🔹 User settings
+# Projection of the fields handlers actually read; cached documents are shared, so callers must not mutate them
+USER_SETTINGS_PROJECTION = {"_id": 0, "user_id": 1, "channels": 1, "custom_caption": 1, "custom_buttons": 1, "blocked": 1}
+user_settings_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL) # user_id -> settings document (or None for unknown users)
+post_templates = TTLCache(USER_CACHE_SIZE, 86400) # user_id -> PostTemplate, dropped by every settings write
+
+async def get_user_settings(user_id: int):
+    if USER_CACHE_ENABLED:
+        cached = user_settings_cache.get(user_id)
+        if cached is not _MISSING:
+            return cached
+    user = await users.find_one({"user_id": user_id}, USER_SETTINGS_PROJECTION)
+    if USER_CACHE_ENABLED:
+        user_settings_cache.set(user_id, user)
+    return user
+
+async def update_user_settings(user_id: int, update: dict, extra_filter: dict = None):
+    # Applies the update and writes the resulting document through to the cache in the same round-trip.
+    # Returns None when no document matched (unknown user or extra_filter not satisfied).
+    user = await users.find_one_and_update(
+        {"user_id": user_id, **(extra_filter or {})},
+        update,
+        projection=USER_SETTINGS_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if user is not None:
+        post_templates.pop(user_id) # Caption or buttons may have changed
+        if USER_CACHE_ENABLED:
+            user_settings_cache.set(user_id, user)
+        await publish_cluster_event("user_settings", user_id)
+    return user
+
+async def create_user(user_id: int):
+    result = await users.update_one(
+        {"user_id": user_id},
+        {"$setOnInsert": {"channels": [], "custom_caption": None, "custom_buttons": []}},
+        upsert=True
+    )
+    user_settings_cache.pop(user_id) # Drop a cached "unknown user"
+    if result.upserted_id is not None:
+        await publish_cluster_event("user_settings", user_id)
+        stats_counters.bump(users=1)
+
+# 🔹 Cluster mode
+# Several instances can run against the same bot token and database:
+#   • every update is claimed in update_claims first, so exactly one instance handles it
+#   • the leader lease decides which instance runs the singletons (post queue workers, broadcasts)
+#   • cache invalidations and wake-ups go through the capped cluster_events collection, which every instance tails
+LEADER_LEASE = "leader"
+is_leader = not CLUSTER_MODE # A single instance is always its own leader
+lease_valid_until = 0.0 # monotonic time until which the last renewal is known to hold
+cluster_tasks = []
+CLUSTER_CACHES = {
+    "user_settings": (user_settings_cache, post_templates),
+    "bot_admin": (bot_admin_cache,),
+    "subscription": (subscription_cache,),
+    "auth_channel": (auth_channel_cache,),
+}
+
+def update_claim_key(update):
+    if isinstance(update, CallbackQuery):
+        return f"cq:{update.id}"
+    if isinstance(update, Message):
+        return f"msg:{update.chat.id}:{update.id}"
+    if isinstance(update, ChatMemberUpdated):
+        member = update.new_chat_member or update.old_chat_member
+        user_id = member.user.id if member and member.user else 0
+        return f"member:{update.chat.id}:{user_id}:{int(update.date.timestamp())}"
+    return None
+
+async def claim_update(update) -> bool:
+    key = update_claim_key(update)
+    if key is None:
+        return True
+    return await claim_key(key)
+
+async def claim_key(key: str) -> bool:
+    # True for exactly one instance per key (and always outside cluster mode)
+    if not CLUSTER_MODE:
+        return True
+    try:
+        await update_claims.insert_one({"_id": key, "instance": INSTANCE_ID, "at": utcnow()})
+    except DuplicateKeyError:
+        metrics.inc("cluster_updates_total", outcome="duplicate")
+        return False
+    except Exception as e:
+        # Without the claim store, a duplicate reply beats dropping the update
+        logger.warning(f"Could not claim update {key}, handling it anyway: {e}")
+    metrics.inc("cluster_updates_total", outcome="claimed")
+    return True
 
-# 🔹 Flask health check
-flask_app = Flask(__name__)
-@flask_app.route("/")
-def index():
-    return "Bot is running!", 200
+def claimed_handler(func):
+    @functools.wraps(func)
+    async def wrapper(client, update, *args):
+        if await claim_update(update):
+            return await func(client, update, *args)
+    return wrapper
 
-def run_flask():
+async def publish_cluster_event(topic: str, key=None):
+    # key None means "clear the whole cache"; tuple keys travel as lists
+    if not CLUSTER_MODE:
+        return
     try:
-        flask_app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
+        await cluster_events.insert_one({
+            "topic": topic,
+            "key": list(key) if isinstance(key, tuple) else key,
+            "instance": INSTANCE_ID,
+            "at": utcnow()
+        })
+        metrics.inc("cluster_events_total", topic=topic, direction="sent")
     except Exception as e:
-        logger.error(f"Flask app crashed: {e}")
+        # The other instances' entries still expire by TTL
+        logger.warning(f"Could not publish {topic} event for {key}: {e}")
+
+def apply_cluster_event(event: dict):
+    if event.get("instance") == INSTANCE_ID:
+        return
+    topic, key = event.get("topic"), event.get("key")
+    metrics.inc("cluster_events_total", topic=topic, direction="received")
+    if topic == "post_queue":
+        post_queue_wakeup.set()
+    elif topic == "broadcasts":
+        if is_leader:
+            asyncio.ensure_future(resume_broadcasts(app))
+    elif topic in CLUSTER_CACHES:
+        for cache in CLUSTER_CACHES[topic]:
+            if key is None:
+                cache.clear()
+            else:
+                cache.pop(tuple(key) if isinstance(key, list) else key)
+
+async def init_cluster():
+    # A capped collection keeps insertion order and supports tailable cursors on any deployment, replica set or not
+    if "cluster_events" not in await db.list_collection_names():
+        try:
+            await db.create_collection("cluster_events", capped=True, size=CLUSTER_EVENTS_SIZE)
+        except CollectionInvalid:
+            pass # Another instance created it first
+    if not (await cluster_events.options()).get("capped"):
+        raise RuntimeError("cluster_events exists but is not capped; drop it so it can be recreated")
+
+async def follow_cluster_events():
+    # Only events published after startup matter; anything older is already covered by the caches starting empty
+    last = await cluster_events.find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+    last_id = last["_id"] if last else None
+    while True:
+        try:
+            cursor = cluster_events.find({"_id": {"$gt": last_id}} if last_id else {}, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for event in cursor:
+                    last_id = event["_id"]
+                    apply_cluster_event(event)
+        except Exception as e:
+            logger.warning(f"Cluster event cursor failed, reopening: {e}")
+        await asyncio.sleep(1) # A tailable cursor on an empty collection dies right away
+
+async def acquire_lease(name: str) -> bool:
+    # Renews our own lease or takes over an expired one; a live lease held by another instance fails the upsert
+    now = utcnow()
+    try:
+        await leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": INSTANCE_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": INSTANCE_ID, "expires_at": now + datetime.timedelta(seconds=LEASE_TTL)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
 
-threading.Thread(target=run_flask).start()
+async def release_lease(name: str):
+    await leases.delete_one({"_id": name, "owner": INSTANCE_ID})
+
+async def start_singletons(bot: Client):
+    await resume_broadcasts(bot)
+    await start_post_workers(bot)
+    analytics_tasks.append(asyncio.create_task(run_rollup_compaction()))
+
+async def stop_singletons():
+    await stop_post_workers()
+    for task in analytics_tasks:
+        task.cancel()
+    await asyncio.gather(*analytics_tasks, return_exceptions=True)
+    analytics_tasks.clear()
+    tasks = list(broadcast_tasks.values())
+    for task in tasks:
+        task.cancel() # Progress is checkpointed per batch; the job resumes on the next start or leader
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def lead(bot: Client):
+    global is_leader, lease_valid_until
+    while True:
+        started = time.monotonic()
+        try:
+            held = await acquire_lease(LEADER_LEASE)
+            if held:
+                lease_valid_until = started + LEASE_TTL
+        except Exception as e:
+            # Can't reach the lease store: keep leading only while the last renewal is certainly still valid
+            logger.warning(f"Leader lease renewal failed: {e}")
+            held = time.monotonic() < lease_valid_until - LEASE_RENEW_INTERVAL
+        try:
+            if held and not is_leader:
+                is_leader = True
+                logger.info(f"Instance {INSTANCE_ID} is now the leader")
+                await start_singletons(bot)
+            elif held:
+                await resume_broadcasts(bot) # Picks up broadcasts created on other instances
+            elif is_leader:
+                is_leader = False
+                logger.warning(f"Instance {INSTANCE_ID} lost the leader lease, stopping singletons")
+                await stop_singletons()
+        except Exception as e:
+            logger.error(f"Leader duties failed, retrying at the next renewal: {e}")
+        metrics.set("cluster_leader", int(is_leader))
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+
+# 🔹 Stats counters
+STATS_COUNTER_ID = "global"
+
+class PeriodicFlusher:
+    # Base for in-memory $inc buffers: subclasses add up changes and implement flush(), which runs every
+    # interval and once more on close. $inc is additive, so every cluster instance flushes its own share.
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+class StatsCounters(PeriodicFlusher):
+    # Keeps /stats a point read instead of a collection scan. Bumps are summed in memory and written as one $inc
+    # every interval, so votes, posts and broadcast sends don't all queue on the single counters document.
+    # _pending: field -> change
+    def bump(self, **inc):
+        for field, n in inc.items():
+            self._pending[field] = self._pending.get(field, 0) + n
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await counters.update_one({"_id": STATS_COUNTER_ID}, {"$inc": batch}, upsert=True)
+            except Exception as e:
+                logger.error(f"Stats counter flush failed, will retry: {e}")
+                metrics.inc("stats_flush_errors_total")
+                self.bump(**batch)
+
+stats_counters = StatsCounters(STATS_FLUSH_INTERVAL)
+
+async def recount_counters():
+    # Server-side recount of the fields that can be derived from the data, to reconcile any drift.
+    # posts and broadcasts_sent are history, not state, so they are left as they are.
+    await stats_counters.flush() # Otherwise bumps from before the recount would be added on top of it
+    pipeline = [{"$group": {
+        "_id": None,
+        "users": {"$sum": 1},
+        "channels": {"$sum": {"$size": {"$ifNull": ["$channels", []]}}}
+    }}]
+    totals = {"users": 0, "channels": 0}
+    async for row in users.aggregate(pipeline):
+        totals = {"users": row["users"], "channels": row["channels"]}
+    totals["reactions"] = await reaction_votes.count_documents({})
+    await counters.update_one(
+        {"_id": STATS_COUNTER_ID},
+        {"$set": {**totals, "recounted_at": datetime.datetime.now(datetime.timezone.utc)}},
+        upsert=True
+    )
+    return await counters.find_one({"_id": STATS_COUNTER_ID})
+
+async def init_counters():
+    if not await counters.find_one({"_id": STATS_COUNTER_ID}, {"_id": 1}):
+        logger.info("No stats counters yet, seeding them with a recount")
+        await recount_counters()
+
+# 🔹 Channel analytics
+# Per-channel rollups by hour and by day: posts published, net 👍/❤️ changes, and (daily) net new votes per post
+# for top-post lists. /channelstats reads a handful of these documents instead of scanning reactions.
+def rollup_buckets(when: datetime.datetime):
+    hour = when.replace(minute=0, second=0, microsecond=0)
+    return ("hour", hour), ("day", hour.replace(hour=0))
+
+class ChannelRollups(PeriodicFlusher):
+    # Increments are summed in memory and written as one $inc upsert per (channel, period, bucket) every interval,
+    # so a tap or a post adds no Mongo write of its own.
+    # _pending: (channel_id, period, start) -> {field: change}
+    def _add(self, channel_id: int, changes: dict, daily: dict = None):
+        for period, start in rollup_buckets(utcnow()):
+            fields = self._pending.setdefault((channel_id, period, start), {})
+            for field, n in list(changes.items()) + list((daily or {}).items() if period == "day" else []):
+                fields[field] = fields.get(field, 0) + n
+
+    def post(self, channel_id: int, message_id: int):
+        self._add(channel_id, {"posts": 1}, {f"post_reactions.{message_id}": 0})
+
+    def reaction(self, channel_id: int, message_id: int, deltas: dict):
+        # deltas: {reaction: change}; a switched vote is -1/+1, so only new votes move the post's score
+        changes = {f"counts.{r_type}": n for r_type, n in deltas.items() if n}
+        if changes:
+            self._add(channel_id, changes, {f"post_reactions.{message_id}": sum(deltas.values())})
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await channel_rollups.bulk_write([
+                    UpdateOne({"channel_id": c, "period": period, "start": start}, {"$inc": fields}, upsert=True)
+                    for (c, period, start), fields in batch.items()
+                ], ordered=False)
+            except Exception as e:
+                # A partly applied batch can over-count a little on retry; for analytics that beats losing it
+                logger.error(f"Channel rollup flush of {len(batch)} buckets failed, will retry: {e}")
+                metrics.inc("analytics_flush_errors_total")
+                for key, fields in batch.items():
+                    merged = self._pending.setdefault(key, {})
+                    for field, n in fields.items():
+                        merged[field] = merged.get(field, 0) + n
+
+channel_analytics = ChannelRollups(ANALYTICS_FLUSH_INTERVAL)
+analytics_tasks = []
+
+async def compact_rollups():
+    # Hourly buckets only feed the last-24h view and daily ones the trends; past the detail window a day keeps only
+    # its top posts, so a document's size no longer grows with the number of posts that day
+    now = utcnow()
+    hourly = await channel_rollups.delete_many({"period": "hour", "start": {"$lt": now - datetime.timedelta(days=ANALYTICS_HOURLY_RETENTION_DAYS)}})
+    daily = await channel_rollups.delete_many({"period": "day", "start": {"$lt": now - datetime.timedelta(days=ANALYTICS_DAILY_RETENTION_DAYS)}})
+    trimmed = 0
+    query = {"period": "day", "start": {"$lt": now - datetime.timedelta(days=ANALYTICS_HOURLY_RETENTION_DAYS + 1)}, "compacted": {"$ne": True}}
+    async for doc in channel_rollups.find(query, {"post_reactions": 1}):
+        top = sorted((doc.get("post_reactions") or {}).items(), key=lambda item: item[1], reverse=True)[:ANALYTICS_TOP_KEEP]
+        await channel_rollups.update_one({"_id": doc["_id"]}, {"$set": {"post_reactions": dict(top), "compacted": True}})
+        trimmed += 1
+    if hourly.deleted_count or daily.deleted_count or trimmed:
+        logger.info(f"Compacted rollups: {hourly.deleted_count} hourly and {daily.deleted_count} daily removed, {trimmed} days trimmed")
+
+async def run_rollup_compaction():
+    while True:
+        try:
+            await compact_rollups()
+        except Exception as e:
+            logger.error(f"Rollup compaction failed, retrying next run: {e}")
+        await asyncio.sleep(ANALYTICS_COMPACT_INTERVAL)
 
 # 🔹 Helpers
 async def is_subscribed(bot, user_id, channels):
     if isinstance(channels, int): 
         channels = [channels]
     for channel in channels:
+        cached = subscription_cache.get((channel, user_id))
+        if cached is True:
+            return True
+        if cached is False:
+            continue
         try:
             member = await bot.get_chat_member(channel, user_id)
             # User is considered subscribed if they are a member, administrator, or owner.
-            if member.status in [
+            subscribed = member.status in [
                 enums.ChatMemberStatus.MEMBER,
                 enums.ChatMemberStatus.ADMINISTRATOR,
                 enums.ChatMemberStatus.OWNER
-            ]:
-                return True
+            ]
         except Exception as e:
             # If get_chat_member raises an error (e.g., UserNotParticipant), they are not subscribed.
             logger.debug(f"Subscription check failed for user {user_id} in channel {channel}: {e}")
-            pass # Continue to check other channels if multiple are provided, though in this case it's usually one auth channel.
+            subscribed = False
+        subscription_cache.set((channel, user_id), subscribed, None if subscribed else SUB_CACHE_NEGATIVE_TTL)
+        if subscribed:
+            return True
+        # Continue to check other channels if multiple are provided, though in this case it's usually one auth channel.
     return False
 
+async def get_auth_channel_info(bot):
+    # Title and invite link of AUTH_CHANNEL, fetched once and shared by every /start.
+    # export_chat_invite_link revokes the previous primary link, so it must not run per user.
+    cached = auth_channel_cache.get(AUTH_CHANNEL)
+    if cached is not _MISSING:
+        return cached
+    async with auth_channel_lock:
+        cached = auth_channel_cache.get(AUTH_CHANNEL)
+        if cached is not _MISSING:
+            return cached
+        title, missing_rights, ttl = "Channel", False, None
+        try:
+            chat = await bot.get_chat(AUTH_CHANNEL)
+            title = chat.title or title
+            invite_link = chat.invite_link
+            if not invite_link:
+                # Bot needs to be admin with 'can_invite_users' privilege to export link
+                is_bot_admin = await ensure_bot_admin_rights(bot, AUTH_CHANNEL) # This is a partial check, ideally needs can_invite_users
+                if is_bot_admin:
+                    invite_link = await bot.export_chat_invite_link(AUTH_CHANNEL)
+                else:
+                    invite_link = "https://t.me/PrimeXBots" # Fallback to a general link if invite link cannot be obtained
+                    # None means the check itself failed: retry soon, and don't claim rights are missing
+                    missing_rights = is_bot_admin is False
+                    ttl = None if missing_rights else SUB_CACHE_NEGATIVE_TTL
+            info = (title, invite_link, missing_rights)
+            auth_channel_cache.set(AUTH_CHANNEL, info, ttl)
+        except Exception as e:
+            logger.error(f"Could not get invite link for AUTH_CHANNEL {AUTH_CHANNEL}: {e}")
+            info = (title, "https://t.me/PrimeXBots", False) # Fallback if chat itself cannot be accessed
+            auth_channel_cache.set(AUTH_CHANNEL, info, SUB_CACHE_NEGATIVE_TTL)
+        return info
+
 async def is_admin(bot, user_id: int, chat_id: int):
     try:
         member = await bot.get_chat_member(chat_id, user_id)
@@ -70,66 +1240,759 @@ async def is_admin(bot, user_id: int, chat_id: int):
         logger.error(f"Error checking if user {user_id} is admin in {chat_id}: {e}")
         return False
 
-async def ensure_bot_admin_rights(bot: Client, channel_id: int) -> bool:
+def bot_member_has_post_rights(member) -> bool:
+    if member.status == enums.ChatMemberStatus.OWNER:
+        return True
+    if member.status == enums.ChatMemberStatus.ADMINISTRATOR:
+        # Check for specific necessary privileges
+        if hasattr(member, "privileges") and member.privileges:
+            # We need to post messages and ideally manage messages for reactions
+            return bool(member.privileges.can_post_messages and member.privileges.can_edit_messages)
+        # Fallback for older Pyrogram versions or if privileges not directly available
+        if hasattr(member, "can_post_messages") and hasattr(member, "can_edit_messages"):
+            return bool(member.can_post_messages and member.can_edit_messages)
+    return False
+
+async def ensure_bot_admin_rights(bot: Client, channel_id: int, fresh: bool = False) -> bool:
+    # fresh=True skips the cache, for flows where the user just changed the bot's rights and asks us to re-check
+    if not fresh:
+        cached = bot_admin_cache.get(channel_id)
+        if cached is not _MISSING:
+            return cached
     try:
-        me = await bot.get_me()
+        me = await get_bot_me(bot)
         member = await bot.get_chat_member(channel_id, me.id)
-        if member.status == enums.ChatMemberStatus.OWNER:
-            return True
-        if member.status == enums.ChatMemberStatus.ADMINISTRATOR:
-            # Check for specific necessary privileges
-            if hasattr(member, "privileges") and member.privileges:
-                # We need to post messages and ideally manage messages for reactions
-                return member.privileges.can_post_messages and member.privileges.can_edit_messages
-            # Fallback for older Pyrogram versions or if privileges not directly available
-            if hasattr(member, "can_post_messages") and hasattr(member, "can_edit_messages"):
-                return member.can_post_messages and member.can_edit_messages
-        return False
+        allowed = bot_member_has_post_rights(member)
+        bot_admin_cache.set(channel_id, allowed, None if allowed else ADMIN_CACHE_NEGATIVE_TTL)
+        if fresh:
+            await publish_cluster_event("bot_admin", channel_id)
+        return allowed
     except Exception as e:
+        # Errors are not cached: they are often transient and the next call should retry.
+        # None (still falsy) tells callers the rights are unknown rather than missing.
         logger.error(f"Bot admin check failed for channel {channel_id}: {e}")
-        return False
+        return None
+
+async def check_channels_admin_rights(bot: Client, channels: list) -> list:
+    # Returns True / False per channel, or None when the check failed or the whole menu didn't finish within
+    # ADMIN_CHECK_TIMEOUT. A check keeps its permit until it really ends, so late ones still bound the concurrency.
+    semaphore = asyncio.Semaphore(ADMIN_CHECK_CONCURRENCY)
+
+    async def check(channel_id):
+        async with semaphore:
+            return await ensure_bot_admin_rights(bot, channel_id)
+
+    if not channels:
+        return []
+    # Not cancelled at the deadline, so a late answer still lands in the admin cache for the next message
+    tasks = [asyncio.ensure_future(check(ch["id"])) for ch in channels]
+    _, pending = await asyncio.wait(tasks, timeout=ADMIN_CHECK_TIMEOUT)
+    if pending:
+        logger.warning(f"Admin checks for {len(pending)} of {len(tasks)} channels did not finish within {ADMIN_CHECK_TIMEOUT}s")
+    return [None if task in pending or task.cancelled() or task.exception() else task.result() for task in tasks]
 
 async def save_channel(user_id: int, channel_id: int, channel_title: str):
-    user = await users.find_one({"user_id": user_id})
+    user = await get_user_settings(user_id)
     if not user:
-        await users.insert_one({"user_id": user_id, "channels": [], "custom_caption": None, "custom_buttons": []})
+        await create_user(user_id)
         user = {"user_id": user_id, "channels": [], "custom_caption": None, "custom_buttons": []}
     
     # Check if channel already exists in the list
-    if any(ch["id"] == channel_id for ch in user["channels"]):
+    if any(ch["id"] == channel_id for ch in user.get("channels", [])):
         return False
     
     # Check bot's admin rights before saving
     if not await ensure_bot_admin_rights(app, channel_id):
         raise ValueError("Bot does not have sufficient admin rights in the channel (post messages, edit messages).")
 
-    user["channels"].append({"id": channel_id, "title": channel_title})
-    await users.update_one({"user_id": user_id}, {"$set": {"channels": user["channels"]}})
+    # Conditional push so two concurrent saves of the same channel can't both add it
+    user = await update_user_settings(
+        user_id,
+        {"$push": {"channels": {"id": channel_id, "title": channel_title}}},
+        {"channels.id": {"$ne": channel_id}}
+    )
+    if user is None:
+        return False
+    stats_counters.bump(channels=1)
     return True
 
+# 🔹 Callback data
+# callback_data is [version byte][opcode][zigzag varint args...]. 0xF8 can never start UTF-8 text, so Pyrogram hands
+# new callbacks over as bytes and they can't be confused with the old "prefix_arg_arg" strings on published posts.
+CALLBACK_VERSION = 0xF8
+OP_NOOP, OP_HELP, OP_ABOUT, OP_START_MENU, OP_REFRESH = 0, 1, 2, 3, 4
+OP_DELCH, OP_DELBTN = 5, 6
+OP_SENDTO, OP_SELCH, OP_SENDALL, OP_SENDSEL = 7, 8, 9, 10
+OP_REACT = 11
+POSTING_OPS = {OP_DELCH, OP_DELBTN, OP_SENDTO, OP_SELCH, OP_SENDALL, OP_SENDSEL} # Served by the "posting" inbound lane
+
+def encode_callback(op: int, *args: int) -> bytes:
+    out = bytearray((CALLBACK_VERSION, op))
+    for n in args:
+        n = (n << 1) ^ (n >> 63) # zigzag: channel ids are negative
+        while n > 0x7F:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+    return bytes(out)
+
+def decode_callback(data: bytes):
+    if len(data) < 2 or data[0] != CALLBACK_VERSION:
+        return None, ()
+    args, n, shift = [], 0, 0
+    for byte in data[2:]:
+        n |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            args.append((n >> 1) ^ -(n & 1))
+            n, shift = 0, 0
+    return data[1], tuple(args)
+
+def button_checksum(text: str) -> int:
+    # Identifies a custom button without putting its text (up to any length) into callback_data
+    return zlib.crc32(text.encode())
+
+# Old string callbacks, keyed by the part before the first "_"; each turns the rest into the new opcode + args
+LEGACY_CALLBACKS = {
+    "react": lambda rest: (OP_REACT, (int(rest.split("_")[0]), REACTION_TYPES.index(rest.split("_")[1]))),
+    "sendto": lambda rest: (OP_SENDTO, tuple(int(part) for part in rest.split("_"))),
+    "selch": lambda rest: (OP_SELCH, tuple(int(part) for part in rest.split("_"))),
+    "sendall": lambda rest: (OP_SENDALL, (int(rest),)),
+    "sendsel": lambda rest: (OP_SENDSEL, (int(rest),)),
+    "delch": lambda rest: (OP_DELCH, (int(rest),)),
+    "delbtn": lambda rest: (OP_DELBTN, (-1, button_checksum(rest))),
+    "help": lambda rest: (OP_HELP, ()),
+    "about": lambda rest: (OP_ABOUT, ()),
+    "start": lambda rest: (OP_START_MENU, ()),
+    "refresh": lambda rest: (OP_REFRESH, ()),
+    "dummy": lambda rest: (OP_NOOP, ()),
+}
+
+def parse_callback(data):
+    # -> (opcode, args), or (None, ()) for anything unrecognised
+    if isinstance(data, bytes):
+        return decode_callback(data)
+    if not data:
+        return None, ()
+    prefix, _, rest = data.partition("_")
+    legacy = LEGACY_CALLBACKS.get(prefix)
+    if legacy is None:
+        return None, ()
+    try:
+        return legacy(rest)
+    except (ValueError, IndexError):
+        return None, ()
+
+# 🔹 Callback throttling
+class TapThrottle:
+    # Fixed-window counters kept in two generations of dicts that swap every window, or early once the current one
+    # holds maxsize keys. No per-key timers or sweeps, and memory stays under 2 * maxsize entries however many users
+    # appear; an early swap only forgets some counts, so it fails open.
+    def __init__(self, window: float, limit: int, maxsize: int):
+        self.window = window
+        self.limit = limit
+        self.maxsize = maxsize
+        self._current = {} # key -> [window start, taps]
+        self._previous = {}
+        self._rotated_at = time.monotonic()
+
+    def _rotate(self, now: float):
+        if now - self._rotated_at >= 2 * self.window:
+            self._previous, self._current = {}, {}
+        elif now - self._rotated_at >= self.window or len(self._current) >= self.maxsize:
+            self._previous, self._current = self._current, {}
+        else:
+            return
+        self._rotated_at = now
+
+    def hit(self, key) -> bool:
+        # Counts a tap; True once the key is over its limit in the current window
+        now = time.monotonic()
+        self._rotate(now)
+        entry = self._current.get(key) or self._previous.pop(key, None)
+        if entry is None or now - entry[0] >= self.window:
+            entry = [now, 0]
+        entry[1] += 1
+        self._current[key] = entry
+        return entry[1] > self.limit
+
+    def forget(self, key):
+        self._current.pop(key, None)
+        self._previous.pop(key, None)
+
+callback_user_throttle = TapThrottle(CALLBACK_USER_WINDOW, CALLBACK_USER_LIMIT, THROTTLE_MAX_KEYS) # user_id
+callback_button_throttle = TapThrottle(CALLBACK_COOLDOWN, 1, THROTTLE_MAX_KEYS) # (user_id, chat_id, message_id, data)
+submit_guard = TapThrottle(SUBMIT_DEDUP_WINDOW, 1, THROTTLE_MAX_KEYS) # post taps already acted on
+
+def tap_rejection(cq: CallbackQuery):
+    # -> None to handle the tap, "" to answer silently (a repeat of a tap just handled) or a text to answer with
+    if callback_user_throttle.hit(cq.from_user.id):
+        metrics.inc("callback_throttled_total", reason="user")
+        return "⏳ Too many taps, slow down a little."
+    if cq.message and callback_button_throttle.hit((cq.from_user.id, cq.message.chat.id, cq.message.id, cq.data)):
+        metrics.inc("callback_throttled_total", reason="button")
+        return ""
+    return None
+
+def is_duplicate_submit(key) -> bool:
+    if submit_guard.hit(key):
+        metrics.inc("callback_throttled_total", reason="duplicate")
+        return True
+    return False
+
+def throttled_handler(func):
+    # Hammered buttons stop here, before the cluster claim, any Mongo read or Telegram edit. Every instance sees
+    # every tap, so each throttle reaches the same verdict; only a tap that gets a text is claimed, to pick the
+    # instance that answers. In cluster mode a silent repeat is left unanswered, its first tap already was.
+    @functools.wraps(func)
+    async def wrapper(client, cq, *args):
+        rejection = tap_rejection(cq)
+        if rejection is None:
+            return await func(client, cq, *args)
+        if rejection == "" and CLUSTER_MODE:
+            return
+        if await claim_update(cq):
+            await cq.answer(rejection or None)
+    return wrapper
+
+# 🔹 Index & schema bootstrap
+# name -> (collection, keys, options). Names are pinned so the strict check can look them up.
+REQUIRED_INDEXES = {
+    "users_user_id": (users, [("user_id", 1)], {"unique": True}),
+    "reactions_post": (reactions_collection, [("channel_id", 1), ("message_id", 1)], {"unique": True}),
+    "reaction_votes_post_user": (reaction_votes, [("channel_id", 1), ("message_id", 1), ("user_id", 1)], {"unique": True}),
+    "broadcasts_status": (broadcasts, [("status", 1)], {}),
+    "broadcast_failures_job": (broadcast_failures, [("job_id", 1)], {}),
+    "post_jobs_due": (post_jobs, [("status", 1), ("run_at", 1)], {}),
+    "post_jobs_user": (post_jobs, [("user_id", 1), ("status", 1), ("created_at", -1)], {}),
+    "update_claims_ttl": (update_claims, [("at", 1)], {"expireAfterSeconds": UPDATE_CLAIM_TTL}),
+    "pending_media_ttl": (pending_media, [("at", 1)], {"expireAfterSeconds": PENDING_MEDIA_TTL}),
+    "channel_rollups_key": (channel_rollups, [("channel_id", 1), ("period", 1), ("start", 1)], {"unique": True}),
+    "channel_rollups_age": (channel_rollups, [("period", 1), ("start", 1)], {}),
+}
+# Indexes from the message_id-only reaction key, superseded by the composite ones above
+OBSOLETE_INDEXES = [(reaction_votes, "message_id_1_user_id_1"), (reactions_collection, "message_id_1")]
+
+async def ensure_indexes():
+    for collection, name in OBSOLETE_INDEXES:
+        if name in await collection.index_information():
+            await collection.drop_index(name)
+            logger.info(f"Dropped obsolete index {collection.name}.{name}")
+
+    missing = []
+    for name, (collection, keys, options) in REQUIRED_INDEXES.items():
+        started = time.monotonic()
+        try:
+            await collection.create_index(keys, name=name, **options)
+            logger.info(f"Index {collection.name}.{name} ready in {(time.monotonic() - started) * 1000:.0f} ms")
+        except Exception as e:
+            # Typically duplicate keys left behind by the old read-modify-write code
+            logger.error(f"Could not build index {collection.name}.{name}: {e}")
+            missing.append(f"{collection.name}.{name}")
+
+    if missing and INDEX_STRICT:
+        raise RuntimeError(f"Required indexes missing (INDEX_STRICT is on): {', '.join(missing)}")
+
+async def backfill_reaction_channel_ids(batch_size: int = 1000):
+    # Reaction documents written before the composite key have no channel_id. The channel can't be recovered
+    # offline, so they get channel_id=None and are adopted by their channel on the first tap (see adopt_legacy_post).
+    for collection in (reactions_collection, reaction_votes):
+        migrated = 0
+        while True:
+            ids = [doc["_id"] async for doc in collection.find({"channel_id": {"$exists": False}}, {"_id": 1}).limit(batch_size)]
+            if not ids:
+                break
+            result = await collection.update_many({"_id": {"$in": ids}}, {"$set": {"channel_id": None}})
+            migrated += result.modified_count
+        if migrated:
+            logger.info(f"Backfilled channel_id on {migrated} {collection.name} documents")
+
+# 🔹 Reaction store
+REACTION_TYPES = ("like", "love")
+legacy_reactions_pending = False # Set at startup when posts without a known channel still exist
+legacy_adoptions = TTLCache(50000, 86400) # (channel_id, message_id) -> adoption task, so each post is checked once
+
+async def migrate_legacy_reactions(batch_size: int = 500):
+    # Old posts keep voter ids in reactions.like / reactions.love arrays; move them to vote documents + counters
+    migrated = 0
+    async for post in reactions_collection.find({"reactions": {"$exists": True}}):
+        legacy = post.get("reactions") or {}
+        voters = {}
+        for r_type in REACTION_TYPES:
+            for uid in legacy.get(r_type, []):
+                voters[uid] = r_type # Last reaction wins if a user somehow ended up in both arrays
+
+        channel_id = post.get("channel_id")
+        ops = [
+            UpdateOne(
+                {"channel_id": channel_id, "message_id": post["message_id"], "user_id": uid},
+                {"$setOnInsert": {"reaction": r_type}},
+                upsert=True
+            )
+            for uid, r_type in voters.items()
+        ]
+        for i in range(0, len(ops), batch_size):
+            await reaction_votes.bulk_write(ops[i:i + batch_size], ordered=False)
+
+        counts = {r_type: 0 for r_type in REACTION_TYPES}
+        for r_type in voters.values():
+            counts[r_type] += 1
+        await reactions_collection.update_one(
+            {"_id": post["_id"], "reactions": {"$exists": True}},
+            {"$set": {"counts": counts, "channel_id": channel_id}, "$unset": {"reactions": ""}}
+        )
+        migrated += 1
+    if migrated:
+        logger.info(f"Migrated {migrated} legacy reaction documents to per-user votes")
+
+async def init_reaction_store():
+    global legacy_reactions_pending
+    await migrate_legacy_reactions()
+    await backfill_reaction_channel_ids()
+    legacy_reactions_pending = bool(await reactions_collection.find_one({"channel_id": None}, {"_id": 1}))
+
+async def _adopt_legacy_post(channel_id: int, message_id: int, legacy_id: int):
+    try:
+        if await reactions_collection.find_one({"channel_id": channel_id, "message_id": message_id}, {"_id": 1}):
+            return
+        # Old posts were keyed by the id in their callback data (the user's source message), without a channel
+        claimed = await reactions_collection.find_one_and_update(
+            {"channel_id": None, "message_id": legacy_id},
+            {"$set": {"channel_id": channel_id, "message_id": message_id}}
+        )
+        if claimed:
+            result = await reaction_votes.update_many(
+                {"channel_id": None, "message_id": legacy_id},
+                {"$set": {"channel_id": channel_id, "message_id": message_id}}
+            )
+            logger.info(f"Adopted legacy reactions {legacy_id} as ({channel_id}, {message_id}) with {result.modified_count} votes")
+    except Exception as e:
+        logger.error(f"Failed to adopt legacy reactions {legacy_id} for ({channel_id}, {message_id}): {e}")
+
+async def adopt_legacy_post(channel_id: int, message_id: int, legacy_id: int):
+    # Costs nothing once no legacy posts are left, and one lookup per post per process until then.
+    # Concurrent taps on the same post share one adoption task.
+    if not legacy_reactions_pending:
+        return
+    key = (channel_id, message_id)
+    task = legacy_adoptions.get(key)
+    if task is _MISSING:
+        task = asyncio.ensure_future(_adopt_legacy_post(channel_id, message_id, legacy_id))
+        legacy_adoptions.set(key, task)
+    await task
+
+async def init_post_reactions(channel_id: int, message_id: int):
+    await reactions_collection.update_one(
+        {"channel_id": channel_id, "message_id": message_id},
+        {"$setOnInsert": {"counts": {r_type: 0 for r_type in REACTION_TYPES}}},
+        upsert=True
+    )
+
+async def read_reaction_counts(channel_id: int, message_id: int):
+    post = await reactions_collection.find_one({"channel_id": channel_id, "message_id": message_id}, {"_id": 0, "counts": 1})
+    counts = (post or {}).get("counts", {})
+    return counts.get("like", 0), counts.get("love", 0)
+
+async def record_reaction(channel_id: int, message_id: int, user_id: int, reaction: str):
+    post_key = {"channel_id": channel_id, "message_id": message_id}
+    # Swap the user's vote atomically and learn what it was before, so counters can be adjusted without reading the post
+    try:
+        prev = await reaction_votes.find_one_and_update(
+            {**post_key, "user_id": user_id},
+            {"$set": {"reaction": reaction}},
+            projection={"_id": 0, "reaction": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race against the same user's other tap; the vote exists now, so retry as a plain update
+        prev = await reaction_votes.find_one_and_update(
+            {**post_key, "user_id": user_id},
+            {"$set": {"reaction": reaction}},
+            projection={"_id": 0, "reaction": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+    prev_reaction = prev.get("reaction") if prev else None
+
+    if prev_reaction == reaction:
+        post = await reactions_collection.find_one(post_key, {"_id": 0, "counts": 1})
+    else:
+        inc = {f"counts.{reaction}": 1}
+        if prev_reaction:
+            inc[f"counts.{prev_reaction}"] = -1
+        try:
+            post = await reactions_collection.find_one_and_update(
+                post_key,
+                {"$inc": inc},
+                projection={"_id": 0, "counts": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            post = await reactions_collection.find_one_and_update(
+                post_key,
+                {"$inc": inc},
+                projection={"_id": 0, "counts": 1},
+                return_document=ReturnDocument.AFTER
+            )
+        # Only once the counter write went through, so /stats and the rollups never count a vote that wasn't stored
+        if not prev_reaction:
+            stats_counters.bump(reactions=1)
+        channel_analytics.reaction(channel_id, message_id, {field.split(".", 1)[1]: n for field, n in inc.items()})
+
+    counts = (post or {}).get("counts", {})
+    return counts.get("like", 0), counts.get("love", 0)
+
+reaction_keyboard_tails = TTLCache(10000, 3600) # (chat_id, message_id) -> keyboard rows below the reaction row
+
+def build_reaction_row(msg_id: int, like_count: int = None, love_count: int = None) -> list:
+    return [
+        InlineKeyboardButton("👍" if like_count is None else f"👍 {like_count}", callback_data=encode_callback(OP_REACT, msg_id, 0)),
+        InlineKeyboardButton("❤️" if love_count is None else f"❤️ {love_count}", callback_data=encode_callback(OP_REACT, msg_id, 1))
+    ]
+
+def keyboard_tail(key: tuple, markup) -> tuple:
+    # Custom + fixed rows of a channel post, cut out of its keyboard once; posts made here are seeded with their template rows
+    tail = reaction_keyboard_tails.get(key)
+    if tail is _MISSING:
+        rows = markup.inline_keyboard if markup else []
+        # remove first row if it was reaction row
+        if rows and all(parse_callback(btn.callback_data)[0] == OP_REACT for btn in rows[0]):
+            rows = rows[1:]
+        tail = tuple(rows)
+        reaction_keyboard_tails.set(key, tail)
+    return tail
+
+def build_reaction_keyboard(tail: tuple, msg_id: int, like_count: int, love_count: int):
+    # Only the count row is new; the rows below it are reused as they are
+    return InlineKeyboardMarkup([build_reaction_row(msg_id, like_count, love_count), *tail])
+
+# 🔹 Reaction keyboard edit coalescer
+class ReactionEditCoalescer:
+    # Keeps only the latest counts per channel message and edits its keyboard at most once per window,
+    # so a burst of taps costs one edit_reply_markup instead of one per tap.
+    def __init__(self, window: float, max_tracked: int = 10000):
+        self.window = window
+        self.max_tracked = max_tracked
+        self._pending = {} # (chat_id, message_id) -> (message, msg_id, counts)
+        self._tasks = {}
+        self._shown = OrderedDict() # (chat_id, message_id) -> counts currently on the keyboard
+        self.edits = 0
+        self.skipped = 0
+        self.flood_waits = 0
+
+    def submit(self, message: Message, msg_id: int, counts: tuple):
+        key = (message.chat.id, message.id)
+        self._pending[key] = (message, msg_id, counts)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    def _remember(self, key, counts):
+        self._shown[key] = counts
+        self._shown.move_to_end(key)
+        while len(self._shown) > self.max_tracked:
+            self._shown.popitem(last=False)
+
+    async def _run(self, key):
+        outbound_priority.set(PRIORITY_EDIT) # Task-local: reaction edits queue behind interactive replies
+        try:
+            while key in self._pending:
+                await asyncio.sleep(self.window)
+                message, msg_id, counts = self._pending.pop(key)
+                if CLUSTER_MODE:
+                    # Other instances edit this keyboard too; show what the store holds now, not what this instance saw
+                    counts = await read_reaction_counts(*key)
+                if self._shown.get(key) == counts:
+                    self.skipped += 1
+                    continue
+                try:
+                    await message.edit_reply_markup(
+                        reply_markup=build_reaction_keyboard(keyboard_tail(key, message.reply_markup), msg_id, *counts)
+                    )
+                    self.edits += 1
+                    self._remember(key, counts)
+                except MessageNotModified:
+                    self._remember(key, counts)
+                except FloodWait as e:
+                    # Only this message's task waits; newer counts that arrive meanwhile replace the retried ones
+                    self.flood_waits += 1
+                    logger.warning(f"FloodWait {e.value}s editing reactions of {key}, backing off")
+                    self._pending.setdefault(key, (message, msg_id, counts))
+                    await asyncio.sleep(e.value)
+                except Exception as e:
+                    logger.error(f"Failed to edit reaction keyboard for {key}: {e}")
+        finally:
+            self._tasks.pop(key, None)
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+reaction_editor = ReactionEditCoalescer(REACTION_EDIT_WINDOW)
+
+# 🔹 Reaction write-behind buffer
+async def recount_post_reactions(keys: list):
+    # Rebuilds counters from the votes, for posts whose last flush may have been only partly written
+    counts = {key: dict.fromkeys(REACTION_TYPES, 0) for key in keys}
+    pipeline = [
+        {"$match": {"$or": [{"channel_id": c, "message_id": m} for c, m in keys]}},
+        {"$group": {"_id": {"c": "$channel_id", "m": "$message_id", "r": "$reaction"}, "n": {"$sum": 1}}}
+    ]
+    async for row in reaction_votes.aggregate(pipeline):
+        key = (row["_id"]["c"], row["_id"]["m"])
+        if key in counts and row["_id"]["r"] in REACTION_TYPES:
+            counts[key][row["_id"]["r"]] = row["n"]
+    await reactions_collection.bulk_write([
+        UpdateOne({"channel_id": c, "message_id": m}, {"$set": {"counts": counts[(c, m)]}}, upsert=True)
+        for c, m in keys
+    ], ordered=False)
+
+class ReactionBuffer:
+    # REACTION_WRITE_BEHIND: a tap only updates in-memory state and is answered at once. Every flush interval (or
+    # max_ops buffered votes) the batch costs one vote read, two bulk_writes and one counter read, however many taps it holds.
+    # Shown counts are optimistic until then: a vote whose earlier state isn't known yet counts as new until its flush.
+    # Flushes from several instances could race on the same vote, so keep this off in cluster mode.
+    def __init__(self, interval: float, max_ops: int, limit: int):
+        self.interval = interval
+        self.max_ops = max_ops
+        self.limit = limit
+        self._pending = {} # (channel_id, message_id) -> {user_id: reaction}
+        self._flushing = {} # The batch being written right now, same shape
+        self._deltas = {} # (channel_id, message_id) -> {reaction: change not yet in _base}
+        self._flushing_deltas = {} # The deltas of the batch being written, until _base includes them
+        self._base = TTLCache(10000, 3600) # (channel_id, message_id) -> counts as last read from Mongo
+        self._known = TTLCache(200000, 3600) # (channel_id, message_id, user_id) -> reaction stored in Mongo
+        self._dirty = set() # Posts whose counters need a recount after a failed flush
+        self._size = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _counts(self, key) -> tuple:
+        base, delta, flushing = self._base.get(key, None) or {}, self._deltas.get(key, {}), self._flushing_deltas.get(key, {})
+        return tuple(base.get(r_type, 0) + delta.get(r_type, 0) + flushing.get(r_type, 0) for r_type in REACTION_TYPES)
+
+    async def record(self, channel_id: int, message_id: int, user_id: int, reaction: str) -> tuple:
+        key = (channel_id, message_id)
+        votes = self._pending.get(key, {})
+        if user_id not in votes and self._size >= self.limit and user_id not in self._flushing.get(key, {}):
+            # Flushes are failing or can't keep up: write through rather than grow without bound. A vote whose
+            # previous one is being flushed right now stays buffered, or the flush could overwrite the newer vote.
+            counts = await record_reaction(channel_id, message_id, user_id, reaction)
+            self._known.set((channel_id, message_id, user_id), reaction)
+            self._base.pop(key)
+            return counts
+        if self._base.get(key) is _MISSING:
+            self._base.set(key, dict(zip(REACTION_TYPES, await read_reaction_counts(channel_id, message_id))))
+
+        votes = self._pending.setdefault(key, {})
+        prev = votes.get(user_id) or self._flushing.get(key, {}).get(user_id) or self._known.get((channel_id, message_id, user_id), None)
+        if prev != reaction:
+            delta = self._deltas.setdefault(key, dict.fromkeys(REACTION_TYPES, 0))
+            delta[reaction] += 1
+            if prev:
+                delta[prev] -= 1
+        if user_id not in votes:
+            self._size += 1
+        votes[user_id] = reaction
+        metrics.set("reaction_buffer_pending", self._size)
+        if self._size >= self.max_ops:
+            self._wakeup.set()
+        return self._counts(key)
+
+    async def _write(self, batch: dict):
+        prev = {}
+        query = {"$or": [{"channel_id": c, "message_id": m, "user_id": {"$in": list(votes)}} for (c, m), votes in batch.items()]}
+        async for doc in reaction_votes.find(query, {"_id": 0, "channel_id": 1, "message_id": 1, "user_id": 1, "reaction": 1}):
+            prev[(doc["channel_id"], doc["message_id"], doc["user_id"])] = doc["reaction"]
+
+        vote_ops, counter_ops, new_votes = [], [], 0
+        for (c, m), votes in batch.items():
+            inc = {}
+            for user_id, reaction in votes.items():
+                before = prev.get((c, m, user_id))
+                if before == reaction:
+                    continue
+                vote_ops.append(UpdateOne({"channel_id": c, "message_id": m, "user_id": user_id}, {"$set": {"reaction": reaction}}, upsert=True))
+                inc[f"counts.{reaction}"] = inc.get(f"counts.{reaction}", 0) + 1
+                if before:
+                    inc[f"counts.{before}"] = inc.get(f"counts.{before}", 0) - 1
+                else:
+                    new_votes += 1
+            inc = {field: n for field, n in inc.items() if n}
+            if inc:
+                counter_ops.append(UpdateOne({"channel_id": c, "message_id": m}, {"$inc": inc}, upsert=True))
+                channel_analytics.reaction(c, m, {field.split(".", 1)[1]: n for field, n in inc.items()})
+        if vote_ops:
+            await reaction_votes.bulk_write(vote_ops, ordered=False)
+        if counter_ops:
+            await reactions_collection.bulk_write(counter_ops, ordered=False)
+        if new_votes:
+            stats_counters.bump(reactions=new_votes)
+        if self._dirty:
+            await recount_post_reactions(list(self._dirty))
+            self._dirty.clear()
+
+        for (c, m), votes in batch.items():
+            for user_id, reaction in votes.items():
+                self._known.set((c, m, user_id), reaction)
+        query = {"$or": [{"channel_id": c, "message_id": m} for c, m in batch]}
+        async for post in reactions_collection.find(query, {"_id": 0, "channel_id": 1, "message_id": 1, "counts": 1}):
+            key = (post["channel_id"], post["message_id"])
+            self._base.set(key, post.get("counts") or {})
+            self._flushing_deltas.pop(key, None) # Now part of _base
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            self._flushing, self._flushing_deltas = self._pending, self._deltas
+            batch = self._pending
+            self._pending, self._deltas, self._size = {}, {}, 0
+            size = sum(len(votes) for votes in batch.values())
+            started = time.perf_counter()
+            try:
+                await self._write(batch)
+            except Exception as e:
+                # Put the batch back under anything newer so the next flush retries it; its posts get a recount then,
+                # since part of this one may have been written
+                logger.error(f"Reaction flush of {size} votes failed, will retry: {e}")
+                metrics.inc("reaction_flush_errors_total")
+                for key, votes in batch.items():
+                    self._pending[key] = {**votes, **self._pending.get(key, {})}
+                    merged = self._deltas.setdefault(key, dict.fromkeys(REACTION_TYPES, 0))
+                    for r_type, n in self._flushing_deltas.get(key, {}).items(): # Less any already refreshed into _base
+                        merged[r_type] += n
+                    self._dirty.add(key)
+                self._size = sum(len(votes) for votes in self._pending.values())
+                return
+            finally:
+                self._flushing, self._flushing_deltas = {}, {}
+                metrics.set("reaction_buffer_pending", self._size)
+            seconds = time.perf_counter() - started
+            metrics.observe("reaction_flush_seconds", seconds)
+            metrics.observe("reaction_flush_batch_size", size, buckets=SIZE_BUCKETS)
+            log_slow_call("reaction flush", f"{size} votes", seconds)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def close(self):
+        # Whatever is still buffered is written before shutdown
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+reaction_buffer = ReactionBuffer(REACTION_FLUSH_INTERVAL, REACTION_FLUSH_MAX_OPS, REACTION_BUFFER_LIMIT)
+
+# 🔹 Bot membership changes
+@app.on_chat_member_updated()
+async def chat_member_updated_handler(bot, update):
+    member = update.new_chat_member or update.old_chat_member
+    if not member or not member.user:
+        return
+    if update.chat.id == AUTH_CHANNEL:
+        # Someone joined or left the auth channel: their next /start must see the new state
+        subscription_cache.pop((AUTH_CHANNEL, member.user.id))
+        await publish_cluster_event("subscription", (AUTH_CHANNEL, member.user.id))
+    if bot_me and member.user.id == bot_me.id:
+        # The bot was promoted, demoted or removed: drop the cached verdict right away
+        bot_admin_cache.pop(update.chat.id)
+        await publish_cluster_event("bot_admin", update.chat.id)
+        if update.chat.id == AUTH_CHANNEL:
+            auth_channel_cache.clear() # Invite rights may have changed too
+            await publish_cluster_event("auth_channel")
+        logger.info(f"Bot membership changed in chat {update.chat.id}, admin cache invalidated")
+
+# 🔹 Media assets
+# Static images are sent by Telegram file_id once known, so Telegram doesn't re-fetch them from the image host on every send
+MEDIA_ASSETS = {
+    "join": "https://i.postimg.cc/xdkd1h4m/IMG-20250715-153124-952.jpg",
+    "start": "https://i.postimg.cc/fyrXmg6S/file-000000004e7461faaef2bd964cbbd408.png",
+    "notice": "https://i.postimg.cc/q7M6tQhy/IMG-20250918-053921-379.jpg",
+}
+STALE_FILE_ID_ERRORS = (FileIdInvalid, FileReferenceExpired, FileReferenceInvalid, MediaEmpty, ValueError)
+asset_file_ids = {} # asset name -> file_id
+
+async def load_media_assets():
+    # A stored file_id only counts while its URL is still the one in MEDIA_ASSETS, so changing an image re-uploads it
+    async for doc in media_assets.find({"_id": {"$in": list(MEDIA_ASSETS)}}):
+        if doc.get("file_id") and doc.get("url") == MEDIA_ASSETS[doc["_id"]]:
+            asset_file_ids[doc["_id"]] = doc["file_id"]
+
+async def remember_media_asset(name: str, sent: Message):
+    if not sent or not sent.photo:
+        return
+    asset_file_ids[name] = sent.photo.file_id
+    try:
+        await media_assets.update_one(
+            {"_id": name},
+            {"$set": {"url": MEDIA_ASSETS[name], "file_id": sent.photo.file_id, "updated_at": utcnow()}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning(f"Could not store file_id of media asset {name}: {e}")
+
+async def reply_asset_photo(msg: Message, name: str, **kwargs):
+    file_id = asset_file_ids.get(name)
+    if file_id:
+        try:
+            return await msg.reply_photo(file_id, **kwargs)
+        except STALE_FILE_ID_ERRORS as e:
+            # Fall back to the URL once; the fresh file_id replaces the stale one
+            logger.warning(f"file_id of media asset {name} no longer works ({type(e).__name__}), re-resolving")
+            asset_file_ids.pop(name, None)
+    sent = await msg.reply_photo(MEDIA_ASSETS[name], **kwargs)
+    await remember_media_asset(name, sent)
+    return sent
+
+async def warm_up_media_assets(bot: Client):
+    # The first send after a deploy should not be the one that waits for the image host
+    await load_media_assets()
+    missing = [name for name in MEDIA_ASSETS if name not in asset_file_ids]
+    if not missing or not ASSET_WARMUP_CHAT:
+        return
+    for name in missing:
+        try:
+            sent = await bot.send_photo(ASSET_WARMUP_CHAT, MEDIA_ASSETS[name], disable_notification=True)
+            await remember_media_asset(name, sent)
+            await sent.delete()
+            logger.info(f"Media asset {name} uploaded and cached")
+        except Exception as e:
+            logger.warning(f"Could not warm up media asset {name}, it will be resolved on first use: {e}")
+
 # 🟢 /start
 @app.on_message(filters.private & filters.command("start"))
 async def start_handler(bot, msg: Message):
     subscribed = await is_subscribed(bot, msg.from_user.id, AUTH_CHANNEL)
+    # A user who comes back after blocking the bot should receive broadcasts again. Checked on the cached
+    # settings, so only a /start from a user the broadcast marked blocked costs a write.
+    user = await get_user_settings(msg.from_user.id)
+    if user and user.get("blocked"):
+        await update_user_settings(msg.from_user.id, {"$unset": {"blocked": ""}})
     if not subscribed:
-        try:
-            chat = await bot.get_chat(AUTH_CHANNEL)
-            invite_link = chat.invite_link
-            if not invite_link:
-                # Bot needs to be admin with 'can_invite_users' privilege to export link
-                if await ensure_bot_admin_rights(bot, AUTH_CHANNEL): # This is a partial check, ideally needs can_invite_users
-                    invite_link = await bot.export_chat_invite_link(AUTH_CHANNEL)
-                else:
-                    invite_link = "https://t.me/PrimeXBots" # Fallback to a general link if invite link cannot be obtained
-                    await msg.reply_text("⚠️ Bot needs 'Invite Users' privilege in Auth Channel to generate invite link automatically. Using a fallback link.")
-        except Exception as e:
-            logger.error(f"Could not get invite link for AUTH_CHANNEL {AUTH_CHANNEL}: {e}")
-            invite_link = "https://t.me/PrimeXBots" # Fallback if chat itself cannot be accessed
-        
-        btns = [[InlineKeyboardButton(f"✇ Join {chat.title if chat else 'Channel'} ✇", url=invite_link)],
-                [InlineKeyboardButton("🔄 Refresh", callback_data="refresh_check")]]
-        await msg.reply_photo(
-            photo="https://i.postimg.cc/xdkd1h4m/IMG-20250715-153124-952.jpg",
+        title, invite_link, missing_rights = await get_auth_channel_info(bot)
+        if missing_rights:
+            await msg.reply_text("⚠️ Bot needs 'Invite Users' privilege in Auth Channel to generate invite link automatically. Using a fallback link.")
+
+        btns = [[InlineKeyboardButton(f"✇ Join {title} ✇", url=invite_link)],
+                [InlineKeyboardButton("🔄 Refresh", callback_data=encode_callback(OP_REFRESH))]]
+        await reply_asset_photo(
+            msg, "join",
             caption=f"👋 Hello {msg.from_user.mention},\n\nJoin our channel to use the bot.",
             reply_markup=InlineKeyboardMarkup(btns)
         )
@@ -143,13 +2006,13 @@ async def start_handler(bot, msg: Message):
         ],
         [InlineKeyboardButton("〄 ᴜᴘᴅᴀᴛᴇs ᴄʜᴀɴɴᴇʟ 〄", url="https://t.me/PrimeXBots")],
         [
-            InlineKeyboardButton("〆 ʜᴇʟᴘ 〆", callback_data="help_btn"),
-            InlineKeyboardButton("〆 ᴀʙᴏᴜᴛ 〆", callback_data="about_btn")
+            InlineKeyboardButton("〆 ʜᴇʟᴘ 〆", callback_data=encode_callback(OP_HELP)),
+            InlineKeyboardButton("〆 ᴀʙᴏᴜᴛ 〆", callback_data=encode_callback(OP_ABOUT))
         ],
         [InlineKeyboardButton("✧ ᴄʀᴇᴀᴛᴏʀ ✧", url="https://t.me/Prime_Nayem")]
     ]
-    await msg.reply_photo(
-        photo="https://i.postimg.cc/fyrXmg6S/file-000000004e7461faaef2bd964cbbd408.png",
+    await reply_asset_photo(
+        msg, "start",
         caption=(
             f"👋 Hello {msg.from_user.mention},\n\n"
             "✨ Welcome to **Post Generator Prime Bot** 🤖\n\n"
@@ -157,7 +2020,7 @@ async def start_handler(bot, msg: Message):
             "➕ Add & manage your channels\n"
             "✍️ Set custom captions\n"
             "🔘 Create your own buttons\n"
-            "📤 Post photos & videos directly\n"
+            "📤 Post photos, videos, albums & files directly\n"
             "👍 Get reactions (Like ❤️ Love) on your posts\n\n"
             "━━━━━━━━━━━━━━━\n"
             "⚡ Use the buttons below to navigate and get started!"
@@ -175,20 +2038,22 @@ async def help_command_handler(bot, msg: Message):
         "📌 Forward a post → Save channel automatically\n"
         "📂 `/mychannels` → See saved channels\n"
         "🗑 `/delchannel` → Delete channel\n\n"
-        "✍️ `/setcap Your caption` → Set custom caption\n"
+        "✍️ `/setcap Your caption` → Set custom caption (`{channel}`, `{date}`, `{time}` allowed)\n"
         "👀 `/seecap` → View caption\n"
         "❌ `/delcap` → Delete caption\n\n"
         "🔘 `/addbutton text | url` → Add custom button (Note: Use `|` as separator)\n"
         "📂 `/mybuttons` → View custom buttons\n"
         "🗑 `/delbutton` → Delete a button\n"
         "♻️ `/clearbuttons` → Clear all buttons\n\n"
-        "📤 Send photo/video → Select channel to post\n"
+        "📤 Send photo/video/album/file → Select channel to post\n"
+        "🕒 Reply `/schedule 2h` to a photo/video/file → Post later\n"
+        "📋 `/queue` → See pending & failed posts\n"
+        "📈 `/channelstats` → Posts, reactions & top posts per channel\n"
         "👍 React to posts with Like ❤️ Love"
     )
     await msg.reply_text(help_text)
 
-# 🟢 /about callback button
-@app.on_callback_query(filters.regex("about_btn"))
+# 🟢 /about callback button (routed by callback_handler)
 async def about_callback(bot, cq: CallbackQuery):
     about_text = (
         "<b>✦✗✦ <a href='https://t.me/PrimeXBots'>ᴍy ᴅᴇᴛᴀɪʟꜱ ʙy ᴘʀɪᴍᴇXʙᴏᴛs</a> ✦✗✦</b>\n\n"
@@ -207,12 +2072,11 @@ async def about_callback(bot, cq: CallbackQuery):
         about_text,
         disable_web_page_preview=True,
         parse_mode=enums.ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⌫ Back", callback_data="start_menu")]])
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⌫ Back", callback_data=encode_callback(OP_START_MENU))]])
     )
     await cq.answer()
 
-# 🟢 /help callback button
-@app.on_callback_query(filters.regex("help_btn"))
+# 🟢 /help callback button (routed by callback_handler)
 async def help_callback(bot, cq: CallbackQuery):
     help_text = (
         "📚 **Help Menu**\n\n"
@@ -220,24 +2084,26 @@ async def help_callback(bot, cq: CallbackQuery):
         "📌 Forward a post → Save channel automatically\n"
         "📂 `/mychannels` → See saved channels\n"
         "🗑 `/delchannel` → Delete channel\n\n"
-        "✍️ `/setcap your caption text` → Set custom caption\n"
+        "✍️ `/setcap your caption text` → Set custom caption (`{channel}`, `{date}`, `{time}` allowed)\n"
         "👀 `/seecap` → View caption\n"
         "❌ `/delcap` → Delete caption\n\n"
         "🔘 `/addbutton Your button text | Your button url` → Add custom button (Note: Use `|` as separator)\n"
         "📂 `/mybuttons` → View custom buttons\n"
         "🗑 `/delbutton` → Delete a button\n"
         "♻️ `/clearbuttons` → Clear all buttons\n\n"
-        "📤 Send photo/video → Select channel to post\n"
+        "📤 Send photo/video/album/file → Select channel to post\n"
+        "🕒 Reply `/schedule 2h` to a photo/video/file → Post later\n"
+        "📋 `/queue` → See pending & failed posts\n"
+        "📈 `/channelstats` → Posts, reactions & top posts per channel\n"
         "👍 React to posts with Like ❤️ Love"
     )
     await cq.message.edit_text(
         help_text,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⌫ Back", callback_data="start_menu")]]) # Added back button
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⌫ Back", callback_data=encode_callback(OP_START_MENU))]]) # Added back button
     )
     await cq.answer()
 
 # 🟢 Back to start menu
-@app.on_callback_query(filters.regex("start_menu"))
 async def back_to_start_menu(bot, cq: CallbackQuery):
     buttons = [
         [
@@ -246,8 +2112,8 @@ async def back_to_start_menu(bot, cq: CallbackQuery):
         ],
         [InlineKeyboardButton("〄 ᴜᴘᴅᴀᴛᴇs ᴄʜᴀɴɴᴇʟ 〄", url="https://t.me/PrimeXBots")],
         [
-            InlineKeyboardButton("〆 ʜᴇʟᴘ 〆", callback_data="help_btn"),
-            InlineKeyboardButton("〆 ᴀʙᴏᴜᴛ 〆", callback_data="about_btn")
+            InlineKeyboardButton("〆 ʜᴇʟᴘ 〆", callback_data=encode_callback(OP_HELP)),
+            InlineKeyboardButton("〆 ᴀʙᴏᴜᴛ 〆", callback_data=encode_callback(OP_ABOUT))
         ],
         [InlineKeyboardButton("✧ ᴄʀᴇᴀᴛᴏʀ ✧", url="https://t.me/Prime_Nayem")]
     ]
@@ -277,7 +2143,7 @@ async def add_channel_cmd(bot, msg: Message):
         return await msg.reply_text(f"❌ Could not find channel with ID {channel_id}. Make sure the bot is in the channel.")
 
     try:
-        if not await ensure_bot_admin_rights(bot, channel_id):
+        if not await ensure_bot_admin_rights(bot, channel_id, fresh=True):
             return await msg.reply_text("❌ Please give me **Admin Rights** in that channel first! I need 'Post Messages' and 'Edit Messages' privileges.")
     except Exception as e:
         logger.error(f"Failed to check bot's admin rights for {channel_id}: {e}")
@@ -308,7 +2174,7 @@ async def forward_handler(bot, msg: Message):
 
     try:
         # Check bot's admin rights here as well
-        if not await ensure_bot_admin_rights(bot, channel.id):
+        if not await ensure_bot_admin_rights(bot, channel.id, fresh=True):
             return await msg.reply_text(f"❌ Please give me **Admin Rights** in channel **{channel.title}** first! I need 'Post Messages' and 'Edit Messages' privileges.")
     except Exception as e:
         logger.error(f"Failed to check bot's admin rights for forwarded channel {channel.id}: {e}")
@@ -328,18 +2194,18 @@ async def forward_handler(bot, msg: Message):
 
 @app.on_message(filters.private & filters.command("mychannels"))
 async def my_channels(bot, msg: Message):
-    user = await users.find_one({"user_id": msg.from_user.id})
+    user = await get_user_settings(msg.from_user.id)
     if not user or not user.get("channels"):
         return await msg.reply_text("📂 You don’t have any channels saved yet.")
-    buttons = [[InlineKeyboardButton(ch["title"], callback_data=f"dummy_{ch['id']}")] for ch in user["channels"]] # Dummy callback for listing
+    buttons = [[InlineKeyboardButton(ch["title"], callback_data=encode_callback(OP_NOOP))] for ch in user["channels"]] # Dummy callback for listing
     await msg.reply_text("📂 Your saved channels:", reply_markup=InlineKeyboardMarkup(buttons))
 
 @app.on_message(filters.private & filters.command("delchannel"))
 async def del_channel(bot, msg: Message):
-    user = await users.find_one({"user_id": msg.from_user.id})
+    user = await get_user_settings(msg.from_user.id)
     if not user or not user.get("channels"):
         return await msg.reply_text("📂 You don’t have any channels saved yet.")
-    buttons = [[InlineKeyboardButton(f"❌ {ch['title']}", callback_data=f"delch_{ch['id']}")] for ch in user["channels"]]
+    buttons = [[InlineKeyboardButton(f"❌ {ch['title']}", callback_data=encode_callback(OP_DELCH, ch["id"]))] for ch in user["channels"]]
     await msg.reply_text("🗑 Select a channel to delete:", reply_markup=InlineKeyboardMarkup(buttons))
 
 # 🟢 Custom Button Commands
@@ -364,26 +2230,22 @@ async def add_button(bot, msg: Message):
     if not text or not url:
         return await msg.reply_text("⚠️ Both text and URL are required!")
 
-    user = await users.find_one({"user_id": msg.from_user.id}) or {}
-    buttons = user.get("custom_buttons", [])
+    user = await get_user_settings(msg.from_user.id)
+    buttons = (user or {}).get("custom_buttons") or []
     
     # Optional: limit number of buttons
     if len(buttons) >= 10: # Example limit
         return await msg.reply_text("⚠️ You can add a maximum of 10 custom buttons.")
 
-    buttons.append({"text": text, "url": url})
-
-    await users.update_one(
-        {"user_id": msg.from_user.id},
-        {"$set": {"custom_buttons": buttons}},
-        upsert=True
-    )
+    if not user:
+        await create_user(msg.from_user.id)
+    await update_user_settings(msg.from_user.id, {"$push": {"custom_buttons": {"text": text, "url": url}}})
 
     await msg.reply_text(f"✅ Button **{text}** added successfully!")
     
 @app.on_message(filters.private & filters.command("mybuttons"))
 async def my_buttons(bot, msg: Message):
-    user = await users.find_one({"user_id": msg.from_user.id})
+    user = await get_user_settings(msg.from_user.id)
     if not user or not user.get("custom_buttons"):
         return await msg.reply_text("📂 You don’t have any custom buttons yet.")
     buttons = [[InlineKeyboardButton(b["text"], url=b["url"])] for b in user["custom_buttons"]]
@@ -391,62 +2253,125 @@ async def my_buttons(bot, msg: Message):
 
 @app.on_message(filters.private & filters.command("delbutton"))
 async def del_button(bot, msg: Message):
-    user = await users.find_one({"user_id": msg.from_user.id})
+    user = await get_user_settings(msg.from_user.id)
     if not user or not user.get("custom_buttons"):
         return await msg.reply_text("📂 You don’t have any custom buttons to delete.")
-    buttons = [[InlineKeyboardButton(f"❌ {b['text']}", callback_data=f"delbtn_{b['text']}")] for b in user["custom_buttons"]]
+    buttons = [
+        [InlineKeyboardButton(f"❌ {b['text']}", callback_data=encode_callback(OP_DELBTN, i, button_checksum(b["text"])))]
+        for i, b in enumerate(user["custom_buttons"])
+    ]
     await msg.reply_text("🗑 Select a button to delete:", reply_markup=InlineKeyboardMarkup(buttons))
 
 @app.on_message(filters.private & filters.command("clearbuttons"))
 async def clear_buttons(bot, msg: Message):
-    await users.update_one({"user_id": msg.from_user.id}, {"$set": {"custom_buttons": []}})
+    await update_user_settings(msg.from_user.id, {"$set": {"custom_buttons": []}})
     await msg.reply_text("🗑 All custom buttons cleared!")
 
 # 🟢 Caption Commands
 @app.on_message(filters.private & filters.command("setcap"))
 async def set_cap(bot, msg: Message):
     if len(msg.command) < 2:
-        return await msg.reply_text("⚠️ Usage: `/setcap your caption Here`")
+        return await msg.reply_text("⚠️ Usage: `/setcap your caption Here`\n\n💡 Placeholders: `{channel}`, `{date}`, `{time}`")
     caption = msg.text.split(" ", 1)[1]
-    await users.update_one({"user_id": msg.from_user.id}, {"$set": {"custom_caption": caption}}, upsert=True)
+    if not await get_user_settings(msg.from_user.id):
+        await create_user(msg.from_user.id)
+    await update_user_settings(msg.from_user.id, {"$set": {"custom_caption": caption}})
     await msg.reply_text("✅ Custom caption set successfully!")
 
 @app.on_message(filters.private & filters.command("seecap"))
 async def see_cap(bot, msg: Message):
-    user = await users.find_one({"user_id": msg.from_user.id})
+    user = await get_user_settings(msg.from_user.id)
     if not user or not user.get("custom_caption"):
         return await msg.reply_text("⚠️ You don’t have any custom caption set.")
     await msg.reply_text(f"📝 Your caption:\n\n{user['custom_caption']}")
 
 @app.on_message(filters.private & filters.command("delcap"))
 async def del_cap(bot, msg: Message):
-    await users.update_one({"user_id": msg.from_user.id}, {"$set": {"custom_caption": None}})
+    await update_user_settings(msg.from_user.id, {"$set": {"custom_caption": None}})
     await msg.reply_text("🗑 Custom caption deleted!")
 
 
+# 🔹 Pending media
+# Media a user has been offered a channel picker for. Each item is its own entry, so ten photos sent in a row can
+# each still be posted, and recording one no longer writes (and invalidates) the user's settings document.
+pending_media_cache = TTLCache(PENDING_MEDIA_SIZE, PENDING_MEDIA_TTL) # (user_id, msg_id) -> True
+
+async def remember_pending_media(user_id: int, msg_id: int):
+    pending_media_cache.set((user_id, msg_id), True)
+    if PENDING_MEDIA_PERSIST:
+        # So a picker tap handled by another instance (or after a restart) still finds it
+        try:
+            await pending_media.update_one({"_id": f"{user_id}:{msg_id}"}, {"$set": {"at": utcnow()}}, upsert=True)
+        except Exception as e:
+            logger.warning(f"Could not persist pending media {msg_id} of user {user_id}: {e}")
+
+async def has_pending_media(bot: Client, user_id: int, msg_id: int) -> bool:
+    if pending_media_cache.get((user_id, msg_id), False):
+        return True
+    if PENDING_MEDIA_PERSIST:
+        found = await pending_media.find_one({"_id": f"{user_id}:{msg_id}"}, {"_id": 1}) is not None
+    else:
+        # Memory only and forgotten (restart or eviction): the message itself is the source of truth
+        message = await bot.get_messages(user_id, msg_id)
+        found = bool(message and not message.empty and is_postable(message))
+    if found:
+        pending_media_cache.set((user_id, msg_id), True)
+    return found
+
 # 🟢 Media Handler
-@app.on_message(filters.private & (filters.photo | filters.video))
+POSTABLE_MEDIA = filters.photo | filters.video | filters.document | filters.animation | filters.audio
+album_parts = {} # (chat_id, media_group_id) -> items of an album that is still arriving
+album_tasks = set()
+
+def is_postable(msg: Message) -> bool:
+    return bool(msg.photo or msg.video or msg.document or msg.animation or msg.audio)
+
+@app.on_message(filters.private & POSTABLE_MEDIA)
 async def media_handler(bot, msg: Message):
-    user = await users.find_one({"user_id": msg.from_user.id})
+    if msg.media_group_id:
+        # An album arrives as one update per item: gather them briefly and offer one picker for the whole album
+        key = (msg.chat.id, msg.media_group_id)
+        if key in album_parts:
+            album_parts[key].append(msg)
+        else:
+            album_parts[key] = [msg]
+            task = asyncio.create_task(offer_album_picker(bot, key))
+            album_tasks.add(task)
+            task.add_done_callback(album_tasks.discard)
+        return
+    await offer_channel_picker(bot, msg)
+
+async def offer_album_picker(bot: Client, key: tuple):
+    await asyncio.sleep(ALBUM_WINDOW)
+    album = album_parts.pop(key, [])
+    # In cluster mode the items can land on different instances; only one of them answers
+    if not album or not await claim_key(f"album:{key[0]}:{key[1]}"):
+        return
+    try:
+        await offer_channel_picker(bot, min(album, key=lambda m: m.id), album=True)
+    except Exception as e:
+        logger.error(f"Failed to offer a channel picker for album {key}: {e}")
+
+async def offer_channel_picker(bot: Client, msg: Message, album: bool = False):
+    user = await get_user_settings(msg.from_user.id)
     
     # এইটা আগের মতোই থাকবে (চ্যানেল অ্যাড করা নেই)
     if not user or not user.get("channels"):
         return await msg.reply_text("⚠️ You have no channels set. Use /addchannel first.")
     
-    # Store the message ID of the media to be posted
-    await users.update_one({"user_id": msg.from_user.id}, {"$set": {"last_media_id": msg.id}})
+    # Remember the media to be posted
+    await remember_pending_media(msg.from_user.id, msg.id)
     
-    buttons = []
-    for ch in user["channels"]:
-        if await ensure_bot_admin_rights(bot, ch['id']):
-            buttons.append([InlineKeyboardButton(ch["title"], callback_data=f"sendto_{msg.id}_{ch['id']}")])
-        else:
+    verdicts = await check_channels_admin_rights(bot, user["channels"])
+    for ch, allowed in zip(user["channels"], verdicts):
+        if allowed is False:
             logger.warning(f"Bot lacks admin rights for channel {ch['title']} ({ch['id']}). Not listing for post.")
+    buttons = build_channel_picker(msg.id, user["channels"], verdicts, set())
     
     # এখানে আমরা আপনার চাওয়া সুন্দর নোটিস+ছবি দেব
     if not buttons:
-        return await msg.reply_photo(
-            "https://i.postimg.cc/q7M6tQhy/IMG-20250918-053921-379.jpg",
+        return await reply_asset_photo(
+            msg, "notice",
             caption=(
                 "⚠️ **নোটিস / Notice** ⚠️\n\n"
                 "বট আপনার চ্যানেলগুলিতে বর্তমানে অ্যাডমিন পারমিশন যাচাই করতে পারছে না।\n\n"
@@ -462,27 +2387,335 @@ async def media_handler(bot, msg: Message):
         )
     
     await msg.reply_text(
-        "📤 **Select a channel to post:**",
+        f"📤 **Select a channel to post{' this album' if album else ''}:**\n\nTap ☑️ to pick several channels, or post to all of them at once.",
         reply_markup=InlineKeyboardMarkup(buttons)
     )
     
+# 🟢 /schedule (reply to a photo/video/file/album)
+@app.on_message(filters.private & filters.command("schedule"))
+async def schedule_handler(bot, msg: Message):
+    media = msg.reply_to_message
+    if len(msg.command) < 2 or not media or not is_postable(media):
+        return await msg.reply_text("⚠️ Reply to a photo/video/file with `/schedule 30m`, `/schedule 2h` or `/schedule 1d2h`.")
+    delay = parse_schedule_delay(msg.command[1])
+    if delay is None:
+        return await msg.reply_text("⚠️ Invalid delay. Use minutes/hours/days like `45m`, `3h` or `1d12h`.")
+
+    user = await get_user_settings(msg.from_user.id)
+    if not user or not user.get("channels"):
+        return await msg.reply_text("⚠️ You have no channels set. Use /addchannel first.")
+    await remember_pending_media(msg.from_user.id, media.id)
+
+    publish_at = utcnow() + delay
+    verdicts = await check_channels_admin_rights(bot, user["channels"])
+    buttons = build_channel_picker(media.id, user["channels"], verdicts, set(), int(publish_at.timestamp()))
+    if not buttons:
+        return await msg.reply_text("❌ I am not admin in any of your channels.")
+    await msg.reply_text(
+        f"🕒 **Select a channel** — the post will be published at {publish_at:%Y-%m-%d %H:%M} UTC:",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+# 🟢 /queue
+@app.on_message(filters.private & filters.command("queue"))
+async def queue_handler(bot, msg: Message):
+    lines = []
+    for title, statuses in (("⏳ Pending", ["pending", "running"]), ("❌ Failed", ["failed"])):
+        query = {"user_id": msg.from_user.id, "status": {"$in": statuses}}
+        total = await post_jobs.count_documents(query)
+        lines.append(f"**{title}: {total}**")
+        async for job in post_jobs.find(query).sort("created_at", -1).limit(10):
+            when = job.get("publish_at") or job.get("run_at")
+            detail = f"at {when:%Y-%m-%d %H:%M} UTC" if job["status"] != "failed" else (job.get("last_error") or "unknown error")
+            lines.append(f"• {job['channel_title']} — {detail}")
+        lines.append("")
+    await msg.reply_text("📋 **Your post queue**\n\n" + "\n".join(lines).strip())
+
 # 🟢 /stats
 @app.on_message(filters.private & filters.command("stats"))
 async def stats_handler(bot, msg: Message):
     if msg.from_user.id != OWNER_ID:
         return await msg.reply_text("❌ You are not authorized to use this command!")
 
-    total_users = await users.count_documents({})
-    total_channels = 0
-    async for user in users.find({}):
-        total_channels += len(user.get("channels", []))
+    # `/stats recount` rebuilds the counters from the collections; plain /stats is a single point read
+    if len(msg.command) > 1 and msg.command[1].lower() == "recount":
+        stats = await recount_counters()
+    else:
+        await stats_counters.flush() # So this instance's last few seconds are included
+        stats = await counters.find_one({"_id": STATS_COUNTER_ID}) or {}
 
     await msg.reply_text(
         f"📊 Bot Stats:\n\n"
-        f"👤 Total Users: {total_users}\n"
-        f"📂 Total Channels Saved: {total_channels}"
+        f"👤 Total Users: {stats.get('users', 0)}\n"
+        f"📂 Total Channels Saved: {stats.get('channels', 0)}\n"
+        f"📤 Posts Made: {stats.get('posts', 0)}\n"
+        f"👍 Reactions Recorded: {stats.get('reactions', 0)}\n"
+        f"📣 Broadcast Messages Sent: {stats.get('broadcasts_sent', 0)}\n"
+        f"🗄 User Cache: {'on' if USER_CACHE_ENABLED else 'off'} "
+        f"({user_settings_cache.hits} hits / {user_settings_cache.misses} misses, {len(user_settings_cache)} entries)"
     )
 
+# 🟢 /channelstats
+def channel_post_link(channel_id: int, message_id: int) -> str:
+    # t.me/c/ links open the post for any member, private channel or not
+    internal_id = str(channel_id)[4:] if str(channel_id).startswith("-100") else abs(channel_id)
+    return f"https://t.me/c/{internal_id}/{message_id}"
+
+def format_trend(current: int, previous: int) -> str:
+    if not previous:
+        return "new" if current else "—"
+    change = (current - previous) * 100 / abs(previous)
+    return f"{'↑' if change >= 0 else '↓'} {abs(change):.0f}%"
+
+async def channel_stats_report(channels: list, days: int) -> str:
+    # Reads only rollup documents: at most 2 * days daily and 24 hourly ones per channel
+    now = utcnow()
+    window_start = now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=days - 1)
+    previous_start = window_start - datetime.timedelta(days=days)
+    ids = [ch["id"] for ch in channels]
+    empty = lambda: {"posts": 0, **dict.fromkeys(REACTION_TYPES, 0)}
+    stats = {ch_id: {"current": empty(), "previous": empty(), "day": empty(), "top": {}} for ch_id in ids}
+
+    daily = {"channel_id": {"$in": ids}, "period": "day", "start": {"$gte": previous_start}}
+    async for doc in channel_rollups.find(daily, {"_id": 0, "channel_id": 1, "start": 1, "posts": 1, "counts": 1, "post_reactions": 1}):
+        entry = stats[doc["channel_id"]]
+        start = doc["start"].replace(tzinfo=datetime.timezone.utc) if doc["start"].tzinfo is None else doc["start"]
+        totals = entry["current" if start >= window_start else "previous"]
+        totals["posts"] += doc.get("posts", 0)
+        for r_type in REACTION_TYPES:
+            totals[r_type] += (doc.get("counts") or {}).get(r_type, 0)
+        if start >= window_start:
+            for message_id, score in (doc.get("post_reactions") or {}).items():
+                entry["top"][message_id] = entry["top"].get(message_id, 0) + score
+
+    hourly = {"channel_id": {"$in": ids}, "period": "hour", "start": {"$gte": now - datetime.timedelta(hours=24)}}
+    async for doc in channel_rollups.find(hourly, {"_id": 0, "channel_id": 1, "posts": 1, "counts": 1}):
+        totals = stats[doc["channel_id"]]["day"]
+        totals["posts"] += doc.get("posts", 0)
+        for r_type in REACTION_TYPES:
+            totals[r_type] += (doc.get("counts") or {}).get(r_type, 0)
+
+    lines = [f"📈 **Channel stats** — last {days} day{'s' if days > 1 else ''} vs the {days} before (UTC)"]
+    for ch in channels:
+        entry = stats[ch["id"]]
+        current, previous, day = entry["current"], entry["previous"], entry["day"]
+        reactions_now = sum(current[r_type] for r_type in REACTION_TYPES)
+        reactions_before = sum(previous[r_type] for r_type in REACTION_TYPES)
+        lines.append(f"\n**{ch['title']}**")
+        lines.append(f"📝 Posts: {current['posts']} ({format_trend(current['posts'], previous['posts'])})")
+        lines.append(f"👍 {current['like']:+d}  ❤️ {current['love']:+d} ({format_trend(reactions_now, reactions_before)})")
+        lines.append(f"🕐 Last 24h: 📝 {day['posts']}  👍 {day['like']:+d}  ❤️ {day['love']:+d}")
+        top = sorted(((score, int(message_id)) for message_id, score in entry["top"].items() if score > 0), reverse=True)[:3]
+        if top:
+            lines.append("🏆 Top: " + " · ".join(
+                f"[#{rank}]({channel_post_link(ch['id'], message_id)}) {score}" for rank, (score, message_id) in enumerate(top, 1)
+            ))
+    return "\n".join(lines)[:4000]
+
+@app.on_message(filters.private & filters.command("channelstats"))
+async def channel_stats_handler(bot, msg: Message):
+    user = await get_user_settings(msg.from_user.id)
+    if not user or not user.get("channels"):
+        return await msg.reply_text("⚠️ You have no channels set. Use /addchannel first.")
+    max_days = max(1, ANALYTICS_DAILY_RETENTION_DAYS // 2)
+    days = 7
+    if len(msg.command) > 1:
+        if not msg.command[1].isdigit() or not 1 <= int(msg.command[1]) <= max_days:
+            return await msg.reply_text(f"⚠️ Use `/channelstats` for the last 7 days, or `/channelstats 30` (1–{max_days} days).")
+        days = int(msg.command[1])
+    await channel_analytics.flush() # So this instance's last few seconds are included
+    await msg.reply_text(await channel_stats_report(user["channels"], days), disable_web_page_preview=True)
+
+# 🟢 /perf
+PERF_SECTIONS = (
+    ("⚙️ Handlers", "handler_latency_seconds", "handler_errors_total", "handler"),
+    ("📡 Telegram API", "telegram_api_latency_seconds", "telegram_api_errors_total", "method"),
+    ("🗄 MongoDB", "mongo_command_latency_seconds", "mongo_command_errors_total", "command"),
+    ("🛣 Inbound lane wait", "inbound_lane_wait_seconds", "inbound_dropped_total", "lane"),
+    ("🚦 Outbound queue wait", "outbound_wait_seconds", "outbound_floodwait_pauses_total", "priority"),
+)
+
+def format_perf_report(limit: int = 12) -> str:
+    lines = ["⏱ **Performance** (p50 / p95 / p99 ms, calls, errors)"]
+    for title, histogram_name, error_name, label in PERF_SECTIONS:
+        errors = {}
+        for labels, value in metrics.counters(error_name):
+            errors[labels.get(label)] = errors.get(labels.get(label), 0) + value
+        rows = sorted(metrics.histograms(histogram_name), key=lambda row: row[1].count, reverse=True)[:limit]
+        lines.append(f"\n**{title}**")
+        if not rows:
+            lines.append("• no data yet")
+        for labels, histogram in rows:
+            name = labels.get(label, "?")
+            p50, p95, p99 = (histogram.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+            lines.append(f"• `{name}` {p50:.0f} / {p95:.0f} / {p99:.0f} — {histogram.count} calls, {int(errors.get(name, 0))} err")
+    if SLOW_CALL_THRESHOLD:
+        lines.append(f"\n🐢 Slow-call log threshold: {SLOW_CALL_THRESHOLD * 1000:.0f} ms")
+    return "\n".join(lines)[:4000]
+
+@app.on_message(filters.private & filters.command("perf"))
+async def perf_handler(bot, msg: Message):
+    if msg.from_user.id != OWNER_ID:
+        return await msg.reply_text("❌ You are not authorized to use this command!")
+    await msg.reply_text(format_perf_report())
+
+# 🔹 Broadcast engine
+class RateLimiter:
+    # Spaces acquisitions evenly at `rate` per second; pause() pushes every waiter back (e.g. after FloodWait)
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        self._next = max(self._next, time.monotonic() + seconds)
+
+broadcast_tasks = {} # job_id -> task running it on this instance
+
+def format_broadcast_progress(job: dict, total: int, finished: bool = False) -> str:
+    done = job.get("sent", 0) + job.get("failed", 0) + job.get("blocked", 0)
+    header = "✅ Broadcast completed!" if finished else "📣 Broadcast in progress..."
+    return (
+        f"{header}\n\n"
+        f"👥 Processed: {done} / ~{total}\n"
+        f"📤 Sent: {job.get('sent', 0)}\n"
+        f"❌ Failed: {job.get('failed', 0)}\n"
+        f"🚫 Blocked/Deactivated: {job.get('blocked', 0)}"
+    )
+
+async def deliver_broadcast(bot: Client, user_id: int, text: str, limiter: RateLimiter, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        for _ in range(BROADCAST_MAX_RETRIES + 1):
+            await limiter.acquire()
+            try:
+                await bot.send_message(user_id, text)
+                return "sent", None
+            except FloodWait as e:
+                # Flood limits are per bot, so the whole job backs off, not only this send
+                logger.warning(f"Broadcast FloodWait {e.value}s at user {user_id}")
+                limiter.pause(e.value)
+                await asyncio.sleep(e.value)
+            except (UserIsBlocked, InputUserDeactivated) as e:
+                return "blocked", str(e)
+            except Exception as e:
+                logger.error(f"Failed to send broadcast to user {user_id}: {e}")
+                return "failed", str(e)
+        return "failed", "FloodWait retries exhausted"
+
+async def update_broadcast_progress(bot: Client, job: dict, total: int, finished: bool = False):
+    try:
+        await bot.edit_message_text(job["chat_id"], job["progress_msg_id"], format_broadcast_progress(job, total, finished))
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not update broadcast progress for job {job['_id']}: {e}")
+
+async def retry_broadcast_step(job_id, what: str, step):
+    # A Mongo error mid-broadcast would otherwise end the task and leave the job "running" until a restart.
+    # Each step is retried on its own, so users already messaged in a batch are never messaged again.
+    delay = 1.0
+    while True:
+        try:
+            return await step()
+        except Exception as e:
+            logger.error(f"Broadcast {job_id} could not {what}, retrying in {delay:.0f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BROADCAST_RETRY_MAX)
+
+async def run_broadcast(bot: Client, job_id):
+    job = await retry_broadcast_step(job_id, "load the job", lambda: broadcasts.find_one({"_id": job_id}))
+    if not job or job.get("status") != "running":
+        return
+    outbound_priority.set(PRIORITY_BULK) # Runs in its own task, so this only affects the broadcast
+    limiter = RateLimiter(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    total = await retry_broadcast_step(job_id, "count users", users.estimated_document_count)
+    last_progress = time.monotonic()
+    logger.info(f"Broadcast {job_id} running from user_id > {job.get('last_user_id')}")
+
+    async def next_batch():
+        # Keyset pagination on user_id: memory stays flat and the checkpoint is just the last id of a finished batch
+        query = {"blocked": {"$ne": True}}
+        if job.get("last_user_id") is not None:
+            query["user_id"] = {"$gt": job["last_user_id"]}
+        cursor = users.find(query, {"_id": 0, "user_id": 1}).sort("user_id", 1).limit(BROADCAST_BATCH_SIZE)
+        return [doc["user_id"] async for doc in cursor]
+
+    while True:
+        batch = await retry_broadcast_step(job_id, "fetch users", next_batch)
+        if not batch:
+            break
+
+        results = await asyncio.gather(*(
+            deliver_broadcast(bot, user_id, job["text"], limiter, semaphore) for user_id in batch
+        ))
+
+        inc = {"sent": 0, "failed": 0, "blocked": 0}
+        failures, blocked = [], []
+        for user_id, (outcome, error) in zip(batch, results):
+            inc[outcome] += 1
+            if outcome == "blocked":
+                blocked.append(user_id)
+            if error:
+                failures.append({"job_id": job_id, "user_id": user_id, "outcome": outcome, "error": error})
+        if blocked:
+            await retry_broadcast_step(job_id, "mark blocked users", lambda: users.bulk_write(
+                [UpdateOne({"user_id": user_id}, {"$set": {"blocked": True}}) for user_id in blocked], ordered=False
+            ))
+            for user_id in blocked:
+                user_settings_cache.pop(user_id) # So a later /start sees the flag and clears it
+        if inc["sent"]:
+            stats_counters.bump(broadcasts_sent=inc["sent"])
+        if failures:
+            await retry_broadcast_step(job_id, "record failures", lambda: broadcast_failures.insert_many(failures, ordered=False))
+
+        job = await retry_broadcast_step(job_id, "save its checkpoint", lambda: broadcasts.find_one_and_update(
+            {"_id": job_id},
+            {"$set": {"last_user_id": batch[-1], "updated_at": datetime.datetime.now(datetime.timezone.utc)}, "$inc": inc},
+            return_document=ReturnDocument.AFTER
+        ))
+        if job is None:
+            logger.warning(f"Broadcast {job_id} was deleted, stopping")
+            return
+        if job.get("status") != "running":
+            logger.info(f"Broadcast {job_id} stopped with status {job.get('status')}")
+            return
+        if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await update_broadcast_progress(bot, job, total)
+
+    job = await retry_broadcast_step(job_id, "mark itself done", lambda: broadcasts.find_one_and_update(
+        {"_id": job_id},
+        {"$set": {"status": "done", "finished_at": datetime.datetime.now(datetime.timezone.utc)}},
+        return_document=ReturnDocument.AFTER
+    ))
+    if job is None:
+        logger.warning(f"Broadcast {job_id} was deleted before it finished")
+        return
+    await update_broadcast_progress(bot, job, total, finished=True)
+    logger.info(f"Broadcast {job_id} finished: sent={job.get('sent', 0)} failed={job.get('failed', 0)} blocked={job.get('blocked', 0)}")
+
+def start_broadcast_task(bot: Client, job_id):
+    task = broadcast_tasks.get(job_id)
+    if task is None:
+        task = broadcast_tasks[job_id] = asyncio.create_task(run_broadcast(bot, job_id))
+        task.add_done_callback(lambda _: broadcast_tasks.pop(job_id, None))
+    return task
+
+async def resume_broadcasts(bot: Client):
+    # Jobs still marked running were interrupted by a restart (or started on another instance); pick them up from their checkpoint
+    async for job in broadcasts.find({"status": "running"}, {"_id": 1}):
+        if job["_id"] in broadcast_tasks:
+            continue
+        logger.info(f"Resuming broadcast {job['_id']}")
+        start_broadcast_task(bot, job["_id"])
+
 # 🟢 /broadcast
 @app.on_message(filters.private & filters.command("broadcast"))
 async def broadcast_handler(bot, msg: Message):
@@ -494,27 +2727,25 @@ async def broadcast_handler(bot, msg: Message):
 
     broadcast_text = msg.text.split(" ", 1)[1]
 
-    sent_count = 0
-    failed_count = 0
-
-    user_ids = await users.distinct("user_id") # Get all unique user IDs
-    
-    for user_id in user_ids:
-        try:
-            await bot.send_message(user_id, broadcast_text)
-            sent_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to user {user_id}: {e}")
-            failed_count += 1
-
-    await msg.reply_text(
-        f"✅ Broadcast completed!\n\n"
-        f"📤 Sent: {sent_count}\n"
-        f"❌ Failed: {failed_count}"
-    )
+    progress = await msg.reply_text("📣 Broadcast queued...")
+    result = await broadcasts.insert_one({
+        "text": broadcast_text,
+        "status": "running",
+        "chat_id": progress.chat.id,
+        "progress_msg_id": progress.id,
+        "last_user_id": None,
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "created_at": datetime.datetime.now(datetime.timezone.utc)
+    })
+    # Runs in the background so the handler returns and other updates keep flowing; in cluster mode only on the leader
+    if is_leader:
+        start_broadcast_task(bot, result.inserted_id)
+    else:
+        await publish_cluster_event("broadcasts")
 
 # 🟢 Subscription refresh
-@app.on_callback_query(filters.regex("refresh_check"))
 async def refresh_callback(bot, cq: CallbackQuery):
     subscribed = await is_subscribed(bot, cq.from_user.id, AUTH_CHANNEL)
     if subscribed:
@@ -524,139 +2755,485 @@ async def refresh_callback(bot, cq: CallbackQuery):
     else:
         await cq.answer("❌ You have not joined yet. Please join first, then refresh.", show_alert=True)
 
-# 🟢 Callback Handler (Channel Delete, Button Delete, Media Post, Reactions)
-@app.on_callback_query()
-async def callback_handler(bot, cq: CallbackQuery):
-    data = cq.data
-
-    # Channel Delete
-    if data.startswith("delch_"):
-        ch_id = int(data.split("_")[1])
-        user = await users.find_one({"user_id": cq.from_user.id})
-        if user:
-            new_channels = [ch for ch in user["channels"] if ch["id"] != ch_id]
-            await users.update_one({"user_id": cq.from_user.id}, {"$set": {"channels": new_channels}})
-            await cq.answer("🗑 Channel deleted!", show_alert=True)
-        return
-
-    # Button Delete
-    if data.startswith("delbtn_"):
-        text = data.split("_", 1)[1]
-        user = await users.find_one({"user_id": cq.from_user.id})
-        if user:
-            new_buttons = [b for b in user["custom_buttons"] if b["text"] != text]
-            await users.update_one({"user_id": cq.from_user.id}, {"$set": {"custom_buttons": new_buttons}})
-            await cq.answer(f"🗑 Button '{text}' deleted!", show_alert=True)
-        return
+# 🔹 Post templates
+PLACEHOLDER_RE = re.compile(r"\{(channel|date|time)\}") # Anything else in braces is left as written
+
+class PostTemplate:
+    # A user's caption and buttons compiled once: the caption is pre-split around its placeholders and the
+    # custom button rows are built once, so a post only joins strings and puts a reaction row on top
+    def __init__(self, custom_caption: str, custom_buttons: list):
+        self.custom_caption = custom_caption
+        # re.split with a group alternates literal text (even indexes) and placeholder names (odd indexes)
+        self.parts = PLACEHOLDER_RE.split(custom_caption) if custom_caption else []
+        self.has_placeholders = len(self.parts) > 1
+        self.rows = tuple([InlineKeyboardButton(b["text"], url=b["url"])] for b in custom_buttons)
+        #self.rows += ([InlineKeyboardButton("কিভাবে ডাউনলোড করবেন", url=REQUEST_GROUP_URL)],)
+
+    def render_caption(self, source_caption: str, channel_title: str = "", when: datetime.datetime = None) -> str:
+        final_caption = ""
+        if source_caption:
+            final_caption += source_caption + "\n\n"
+        if self.has_placeholders:
+            when = when or utcnow()
+            values = {"channel": channel_title, "date": f"{when:%Y-%m-%d}", "time": f"{when:%H:%M}"}
+            final_caption += "".join(values[part] if i % 2 else part for i, part in enumerate(self.parts)) + "\n\n"
+        elif self.custom_caption:
+            final_caption += self.custom_caption + "\n\n"
+        #final_caption += "ʙʏ:<a href='https://t.me/PrimeXBots'>@ᴘʀɪᴍᴇXʙᴏᴛꜱ</a>"
+        return final_caption
+
+    def markup(self, msg_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([build_reaction_row(msg_id), *self.rows])
+
+def get_post_template(user: dict) -> PostTemplate:
+    # Recompiled only after update_user_settings (/setcap, /delcap, the button commands) dropped it
+    template = post_templates.get(user.get("user_id"))
+    if template is _MISSING:
+        template = PostTemplate(user.get("custom_caption"), user.get("custom_buttons") or [])
+        if user.get("user_id") is not None:
+            post_templates.set(user["user_id"], template)
+    return template
+
+# 🔹 Posting & multi-channel fan-out
+def build_channel_picker(msg_id: int, channels: list, verdicts: list, selected: set, publish_at: int = None) -> list:
+    # verdicts: True / None (unverified, sendto_ re-checks) / False (hidden).
+    # With publish_at (unix time) the picker schedules single-channel posts and has no fan-out row.
+    buttons = []
+    for ch, allowed in zip(channels, verdicts):
+        if allowed is False:
+            continue
+        title = ch["title"] if allowed else f"⏳ {ch['title']} (unverified)"
+        if publish_at:
+            buttons.append([InlineKeyboardButton(f"🕒 {title}", callback_data=encode_callback(OP_SENDTO, msg_id, ch["id"], publish_at))])
+            continue
+        buttons.append([
+            InlineKeyboardButton(title, callback_data=encode_callback(OP_SENDTO, msg_id, ch["id"])),
+            InlineKeyboardButton("✅" if ch["id"] in selected else "☑️", callback_data=encode_callback(OP_SELCH, msg_id, ch["id"]))
+        ])
+    if buttons and not publish_at:
+        buttons.append([
+            InlineKeyboardButton("📢 Post to all", callback_data=encode_callback(OP_SENDALL, msg_id)),
+            InlineKeyboardButton(f"🚀 Post selected ({len(selected)})", callback_data=encode_callback(OP_SENDSEL, msg_id))
+        ])
+    return buttons
+
+def picker_selection(markup) -> set:
+    # The picker keyboard itself holds the selection, so toggles and the final post need no server-side state
+    # (and may be handled by different instances in cluster mode)
+    selected = set()
+    for row in (markup.inline_keyboard if markup else []):
+        for btn in row:
+            if btn.text == "✅":
+                op, args = parse_callback(btn.callback_data)
+                if op == OP_SELCH:
+                    selected.add(args[1])
+    return selected
+
+async def load_post_source(bot: Client, chat_id: int, msg_id: int):
+    # For an album, the source is its first item: that's where Telegram keeps the album caption
+    media_msg = await bot.get_messages(chat_id, msg_id)
+    if media_msg and not media_msg.empty and media_msg.media_group_id:
+        media_msg = (await bot.get_media_group(chat_id, msg_id))[0]
+    return media_msg
+
+async def copy_album(bot: Client, media_msg: Message, channel_id: int, caption: str, markup: InlineKeyboardMarkup):
+    # Albums can't carry a keyboard: the whole group goes over in one SendMultiMedia and the buttons ride on a
+    # companion message, which is what reactions are then keyed by. Other items keep their own captions.
+    album = await bot.copy_media_group(channel_id, media_msg.chat.id, media_msg.id, captions=[caption] if caption else None)
+    return await bot.send_message(channel_id, ALBUM_COMPANION_TEXT, reply_markup=markup, reply_to_message_id=album[0].id)
+
+async def copy_post(bot: Client, media_msg: Message, channel_id: int, caption: str, markup: InlineKeyboardMarkup):
+    # The outbound scheduler paces the copy against the bot-wide and the channel's budget and waits out short
+    # FloodWaits; longer ones are raised. Returns the channel message that carries the keyboard.
+    if media_msg.media_group_id:
+        return await copy_album(bot, media_msg, channel_id, caption, markup)
+    return await media_msg.copy(chat_id=channel_id, caption=caption, reply_markup=markup)
+
+async def fan_out_post(bot: Client, user: dict, source_chat_id: int, msg_id: int, channels: list) -> list:
+    # Posts one source message (or album) to many channels: one source lookup, one caption/keyboard build,
+    # concurrent copies, and one bulk write for all reaction records. Returns (channel, status) pairs.
+    media_msg = await load_post_source(bot, source_chat_id, msg_id)
+    if not media_msg or media_msg.empty:
+        return [(ch, "❌ media not found") for ch in channels]
+    # The keyboard is the same for every channel; only the caption's {channel} differs
+    template = get_post_template(user)
+    markup = template.markup(msg_id)
+    now = utcnow()
+    verdicts = await check_channels_admin_rights(bot, channels)
+
+    async def post_one(ch, allowed):
+        if not allowed:
+            return ch, None, "❌ bot is not admin" if allowed is False else "❌ admin rights unverified"
+        try:
+            caption = template.render_caption(media_msg.caption, ch["title"], now)
+            copied = await copy_post(bot, media_msg, ch["id"], caption, markup)
+            reaction_keyboard_tails.set((ch["id"], copied.id), template.rows)
+            return ch, copied, "✅ posted"
+        except FloodWait as e:
+            return ch, None, f"⏳ FloodWait {e.value}s, try again later"
+        except Exception as e:
+            logger.error(f"Fan-out post to {ch['id']} failed: {e}")
+            return ch, None, f"❌ {type(e).__name__}"
+
+    with outbound_class(PRIORITY_BULK):
+        results = await asyncio.gather(*(post_one(ch, allowed) for ch, allowed in zip(channels, verdicts)))
+
+    posted = [(ch["id"], copied.id) for ch, copied, _ in results if copied]
+    if posted:
+        await reactions_collection.bulk_write([
+            UpdateOne(
+                {"channel_id": channel_id, "message_id": post_id},
+                {"$setOnInsert": {"counts": {r_type: 0 for r_type in REACTION_TYPES}}},
+                upsert=True
+            )
+            for channel_id, post_id in posted
+        ], ordered=False)
+        stats_counters.bump(posts=len(posted))
+        for channel_id, post_id in posted:
+            channel_analytics.post(channel_id, post_id)
+    return [(ch, status) for ch, _, status in results]
+
+def format_fan_out_summary(results: list) -> str:
+    posted = sum(1 for _, status in results if status.startswith("✅"))
+    lines = [f"{status.split(' ', 1)[0]} **{ch['title']}** — {status.split(' ', 1)[1]}" for ch, status in results]
+    return f"📤 **Posted to {posted}/{len(results)} channels**\n\n" + "\n".join(lines)
+
+# 🔹 Post queue
+post_queue_wakeup = asyncio.Event()
+post_worker_tasks = []
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+async def enqueue_post(user_id: int, msg_id: int, channel: dict, publish_at: datetime.datetime = None):
+    now = utcnow()
+    result = await post_jobs.insert_one({
+        "user_id": user_id,
+        "source_chat_id": user_id,
+        "source_msg_id": msg_id,
+        "channel_id": channel["id"],
+        "channel_title": channel["title"],
+        "status": "pending",
+        "publish_at": publish_at,
+        "run_at": publish_at or now,
+        "attempts": 0,
+        "last_error": None,
+        "created_at": now,
+        "updated_at": now
+    })
+    post_queue_wakeup.set()
+    await publish_cluster_event("post_queue") # The workers may live on the leader instance
+    return result.inserted_id
+
+async def claim_post_job():
+    # Atomic claim: only one worker can flip a due job from pending to running. A job left running past
+    # POST_JOB_STALE lost its worker to an error it couldn't record, so it is claimed again.
+    now = utcnow()
+    return await post_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "run_at": {"$lte": now}},
+            {"status": "running", "claimed_at": {"$lt": now - datetime.timedelta(seconds=POST_JOB_STALE)}}
+        ]},
+        {"$set": {"status": "running", "claimed_at": now, "updated_at": now}, "$inc": {"attempts": 1}},
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
 
-    # Media Post
-    if data.startswith("sendto_"):
-        _, msg_id, channel_id = data.split("_")
-        msg_id = int(msg_id)
-        channel_id = int(channel_id)
+async def finish_post_job(job: dict, update: dict):
+    update.setdefault("$set", {})["updated_at"] = utcnow()
+    await post_jobs.update_one({"_id": job["_id"]}, update)
 
-        user = await users.find_one({"user_id": cq.from_user.id})
-        if not user or not user.get("last_media_id"):
-            return await cq.answer("⚠️ Media not found!", show_alert=True)
+async def notify_post_owner(bot: Client, job: dict, text: str):
+    try:
+        with outbound_class(PRIORITY_INTERACTIVE):
+            await bot.send_message(job["user_id"], text)
+    except Exception as e:
+        logger.warning(f"Could not notify user {job['user_id']} about post job {job['_id']}: {e}")
 
-        # Check bot rights
+async def process_post_job(bot: Client, job: dict):
+    channel_id = job["channel_id"]
+    try:
         if not await ensure_bot_admin_rights(bot, channel_id):
-            return await cq.answer("❌ Bot is not admin or missing 'Post Messages' rights!", show_alert=True)
+            raise RuntimeError("Bot is not admin or missing 'Post Messages' rights")
+        user = await get_user_settings(job["user_id"]) or {}
+        template = get_post_template(user) # Built from the settings just read, before any other await
+        media_msg = await load_post_source(bot, job["source_chat_id"], job["source_msg_id"])
+        if not media_msg or media_msg.empty:
+            # Source message was deleted; retrying can't help
+            await finish_post_job(job, {"$set": {"status": "failed", "last_error": "Source media not found"}})
+            return await notify_post_owner(bot, job, f"❌ Failed to post to **{job['channel_title']}**: media not found.")
+        caption = template.render_caption(media_msg.caption, job["channel_title"])
+        copied_msg = await copy_post(bot, media_msg, channel_id, caption, template.markup(job["source_msg_id"]))
+        reaction_keyboard_tails.set((channel_id, copied_msg.id), template.rows)
+    except FloodWait as e:
+        # Not the job's fault: push it back by the wait and don't count the attempt
+        logger.warning(f"Post job {job['_id']} hit FloodWait {e.value}s in {channel_id}")
+        await finish_post_job(job, {
+            "$set": {"status": "pending", "run_at": utcnow() + datetime.timedelta(seconds=e.value), "last_error": f"FloodWait {e.value}s"},
+            "$inc": {"attempts": -1}
+        })
+        return
+    except Exception as e:
+        logger.error(f"Post job {job['_id']} attempt {job['attempts']} failed: {e}")
+        if job["attempts"] >= POST_MAX_ATTEMPTS:
+            await finish_post_job(job, {"$set": {"status": "failed", "last_error": str(e)}})
+            return await notify_post_owner(bot, job, f"❌ Failed to post to **{job['channel_title']}** after {job['attempts']} attempts.")
+        delay = min(POST_RETRY_BASE * 2 ** (job["attempts"] - 1), POST_RETRY_MAX)
+        await finish_post_job(job, {"$set": {"status": "pending", "run_at": utcnow() + datetime.timedelta(seconds=delay), "last_error": str(e)}})
+        return
 
+    # Recorded as done before any other write, so a failure below can't get the job posted a second time
+    await finish_post_job(job, {"$set": {"status": "done", "posted_msg_id": copied_msg.id, "last_error": None}})
+    stats_counters.bump(posts=1)
+    channel_analytics.post(channel_id, copied_msg.id)
+    # Initialize reaction counters for the channel post
+    await init_post_reactions(channel_id, copied_msg.id)
+    if job.get("publish_at"):
+        await notify_post_owner(bot, job, f"✅ Scheduled post published to **{job['channel_title']}**.")
+
+async def post_worker(bot: Client, worker_id: int):
+    outbound_priority.set(PRIORITY_BULK)
+    while True:
         try:
-            media_msg = await bot.get_messages(cq.from_user.id, msg_id)
-            user_caption = user.get("custom_caption") or ""
-            fixed_caption = "ʙʏ:<a href='https://t.me/PrimeXBots'>@ᴘʀɪᴍᴇXʙᴏᴛꜱ</a>"
-
-            final_caption = ""
-            if media_msg.caption:
-                final_caption += media_msg.caption + "\n\n"
-            if user_caption:
-                final_caption += user_caption + "\n\n"
-            final_caption #+= fixed_caption
-
-            # Custom buttons
-            custom_btns = [[InlineKeyboardButton(b["text"], url=b["url"])] for b in user.get("custom_buttons", [])]
-
-            # Initial reaction row
-            reaction_row = [
-                InlineKeyboardButton("👍", callback_data=f"react_{msg_id}_like"),
-                InlineKeyboardButton("❤️", callback_data=f"react_{msg_id}_love")
-            ]
-
-            #fixed_row = [InlineKeyboardButton("কিভাবে ডাউনলোড করবেন", url=REQUEST_GROUP_URL)]
-            all_buttons = [reaction_row] + custom_btns# + [fixed_row]
-
-            copied_msg = await media_msg.copy(
-                chat_id=channel_id,
-                caption=final_caption,
-                reply_markup=InlineKeyboardMarkup(all_buttons)
-            )
-
-            # Initialize reactions in DB
-            await reactions_collection.update_one(
-                {"message_id": copied_msg.id},
-                {"$set": {"reactions": {"like": [], "love": []}}},
-                upsert=True
-            )
-
-            await cq.answer("✅ Posted successfully!", show_alert=True)
-
+            job = await claim_post_job()
         except Exception as e:
-            logger.error(f"Failed to post media: {e}")
-            await cq.answer("❌ Failed to post!", show_alert=True)
-        return
+            logger.error(f"Post worker {worker_id} could not claim a job: {e}")
+            job = None
+        if job is None:
+            # Sleep until something is enqueued or the next poll, whichever comes first (scheduled jobs become due by polling)
+            post_queue_wakeup.clear()
+            try:
+                await asyncio.wait_for(post_queue_wakeup.wait(), POST_QUEUE_POLL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await process_post_job(bot, job)
+        except Exception as e:
+            # Usually a Mongo write after the attempt; the job is claimed again once it goes stale
+            logger.error(f"Post worker {worker_id} failed on job {job['_id']}: {e}")
+
+async def start_post_workers(bot: Client):
+    # Jobs left running by a crash or restart were never finished; hand them back to the queue
+    result = await post_jobs.update_many({"status": "running"}, {"$set": {"status": "pending", "updated_at": utcnow()}})
+    if result.modified_count:
+        logger.info(f"Requeued {result.modified_count} interrupted post jobs")
+    for worker_id in range(POST_WORKERS):
+        post_worker_tasks.append(asyncio.create_task(post_worker(bot, worker_id)))
+
+async def stop_post_workers():
+    for task in post_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*post_worker_tasks, return_exceptions=True)
+    post_worker_tasks.clear()
+
+def parse_schedule_delay(text: str):
+    # "30m", "2h", "1d" or combinations like "1h30m" -> timedelta, or None if unparseable
+    parts = re.fullmatch(r"(?:(\d+)d)?(?:(\d+)h)?(?:(\d+)m)?", text.strip().lower())
+    if not parts or not any(parts.groups()):
+        return None
+    days, hours, minutes = (int(g or 0) for g in parts.groups())
+    return datetime.timedelta(days=days, hours=hours, minutes=minutes)
+
+# 🟢 Callback handlers (Channel Delete, Button Delete, Media Post, Reactions)
+async def noop_callback(bot, cq: CallbackQuery):
+    await cq.answer()
 
-    # Reactions
-    # Reactions
-    if data.startswith("react_"):
-        _, msg_id, reaction = data.split("_")
-        msg_id = int(msg_id)
-        user_id = cq.from_user.id
-
-        post = await reactions_collection.find_one({"message_id": msg_id})
-        if not post:
-            post = {"message_id": msg_id, "reactions": {"like": [], "love": []}}
-            await reactions_collection.insert_one(post)
-
-        # Remove previous reaction
-        for r_type in post["reactions"]:
-            if user_id in post["reactions"][r_type]:
-                post["reactions"][r_type].remove(user_id)
-
-        # Add new reaction
-        post["reactions"].setdefault(reaction, []).append(user_id)
-        await reactions_collection.update_one(
-            {"message_id": msg_id}, {"$set": {"reactions": post["reactions"]}}
-        )
+async def delete_channel_callback(bot, cq: CallbackQuery, ch_id: int):
+    removed = await update_user_settings(
+        cq.from_user.id,
+        {"$pull": {"channels": {"id": ch_id}}},
+        {"channels.id": ch_id}
+    )
+    if removed is not None:
+        stats_counters.bump(channels=-1)
+    await cq.answer("🗑 Channel deleted!", show_alert=True)
+
+async def delete_button_callback(bot, cq: CallbackQuery, index: int, checksum: int):
+    # index -1 comes from old callbacks that only carried the text; otherwise the checksum guards against a list that changed since
+    user = await get_user_settings(cq.from_user.id)
+    buttons = (user or {}).get("custom_buttons") or []
+    if 0 <= index < len(buttons) and button_checksum(buttons[index]["text"]) == checksum:
+        button = buttons[index]
+    else:
+        button = next((b for b in buttons if button_checksum(b["text"]) == checksum), None)
+    if button is None:
+        return await cq.answer("⚠️ Button not found, it may have been deleted already.", show_alert=True)
+    # Filtered on the button so a pull that removes nothing (a stale cache, a concurrent delete) matches no document
+    match = {"text": button["text"], "url": button["url"]}
+    user = await update_user_settings(cq.from_user.id, {"$pull": {"custom_buttons": match}}, {"custom_buttons": {"$elemMatch": match}})
+    if user:
+        await cq.answer(f"🗑 Button '{button['text']}' deleted!", show_alert=True)
+    else:
+        user_settings_cache.pop(cq.from_user.id) # The cached list still showed it
+        await cq.answer("⚠️ Button not found, it may have been deleted already.", show_alert=True)
+
+async def send_to_callback(bot, cq: CallbackQuery, msg_id: int, channel_id: int, publish_at: int = 0):
+    # Duplicate taps stop before any lookup; every early answer below forgets the key, so a retry still works
+    submit_key = ("sendto", cq.from_user.id, msg_id, channel_id, publish_at)
+    if is_duplicate_submit(submit_key):
+        return await cq.answer("📥 Already queued, see /queue for status.", show_alert=True)
+    publish_at = datetime.datetime.fromtimestamp(publish_at, datetime.timezone.utc) if publish_at else None
+
+    user = await get_user_settings(cq.from_user.id)
+    if not user or not await has_pending_media(bot, cq.from_user.id, msg_id):
+        submit_guard.forget(submit_key)
+        return await cq.answer("⚠️ Media not found!", show_alert=True)
+
+    # Callback data can be forged, so only the user's own channels are accepted
+    channel = next((ch for ch in user.get("channels", []) if ch["id"] == channel_id), None)
+    if channel is None:
+        submit_guard.forget(submit_key)
+        return await cq.answer("❌ Channel not in your list", show_alert=True)
+
+    # Check bot rights (cached) so the user hears about it now rather than from a failed job later
+    if not await ensure_bot_admin_rights(bot, channel_id):
+        submit_guard.forget(submit_key)
+        return await cq.answer("❌ Bot is not admin or missing 'Post Messages' rights!", show_alert=True)
 
-        like_count = len(post["reactions"].get("like", []))
-        love_count = len(post["reactions"].get("love", []))
+    try:
+        await enqueue_post(cq.from_user.id, msg_id, channel, publish_at)
+    except Exception as e:
+        logger.error(f"Failed to queue media {msg_id} for {channel_id}: {e}")
+        submit_guard.forget(submit_key) # Nothing was queued, so a retry is fine
+        return await cq.answer("❌ Failed to post!", show_alert=True)
 
-        # Preserve custom + fixed buttons without duplicating reaction row
-        current_buttons = cq.message.reply_markup.inline_keyboard if cq.message.reply_markup else []
+    if publish_at:
+        await cq.answer(f"🕒 Scheduled for {publish_at:%Y-%m-%d %H:%M} UTC. See /queue.", show_alert=True)
+    else:
+        await cq.answer("📥 Queued, posting now! See /queue for status.", show_alert=True)
 
-        # remove first row if it was reaction row
-        if current_buttons and all(
-            btn.callback_data and btn.callback_data.startswith("react_")
-            for btn in current_buttons[0]
-        ):
-            current_buttons = current_buttons[1:]
-
-        custom_buttons = current_buttons[:-1] if len(current_buttons) > 1 else []
-        fixed_row = current_buttons[-1] if current_buttons else []
-
-        # New reaction row
-        reaction_row = [
-            InlineKeyboardButton(f"👍 {like_count}", callback_data=f"react_{msg_id}_like"),
-            InlineKeyboardButton(f"❤️ {love_count}", callback_data=f"react_{msg_id}_love")
-        ]
+async def select_channel_callback(bot, cq: CallbackQuery, msg_id: int, channel_id: int):
+    # Channel selection toggle for multi-channel posting
+    user = await get_user_settings(cq.from_user.id)
+    if not user or not user.get("channels"):
+        return await cq.answer("⚠️ You have no channels set.", show_alert=True)
+    selected = picker_selection(cq.message.reply_markup) ^ {channel_id}
+    # Verdicts come from the admin cache; unknown channels stay listed as unverified
+    verdicts = [bot_admin_cache.get(ch["id"], None) for ch in user["channels"]]
+    await cq.message.edit_reply_markup(
+        reply_markup=InlineKeyboardMarkup(build_channel_picker(msg_id, user["channels"], verdicts, selected))
+    )
+    await cq.answer()
 
-        new_keyboard = [reaction_row] + custom_buttons + ([fixed_row] if fixed_row else [])
-        await cq.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(new_keyboard))
-        await cq.answer("✅ Your reaction updated!", show_alert=False)
-        return
+async def send_many_callback(bot, cq: CallbackQuery, msg_id: int, selected_only: bool):
+    # Multi-channel post (all channels / selected channels)
+    user = await get_user_settings(cq.from_user.id)
+    if not user or not user.get("channels"):
+        return await cq.answer("⚠️ You have no channels set.", show_alert=True)
+    channels = user["channels"]
+    if selected_only:
+        selected = picker_selection(cq.message.reply_markup)
+        channels = [ch for ch in channels if ch["id"] in selected]
+        if not channels:
+            return await cq.answer("☑️ Select at least one channel first.", show_alert=True)
+    # "Post all" and "Post selected" share the key: one picker posts once
+    submit_key = ("fanout", cq.from_user.id, cq.message.chat.id, cq.message.id)
+    if is_duplicate_submit(submit_key):
+        return await cq.answer("⏳ Already posting this one.")
+    await cq.answer(f"⏳ Posting to {len(channels)} channels...")
+    try:
+        results = await fan_out_post(bot, user, cq.from_user.id, msg_id, channels)
+    except Exception as e:
+        logger.error(f"Fan-out of {msg_id} for user {cq.from_user.id} failed: {e}")
+        submit_guard.forget(submit_key)
+        return await cq.message.edit_text("❌ Failed to post!")
+    await cq.message.edit_text(format_fan_out_summary(results))
+
+async def send_all_callback(bot, cq: CallbackQuery, msg_id: int):
+    await send_many_callback(bot, cq, msg_id, False)
+
+async def send_selected_callback(bot, cq: CallbackQuery, msg_id: int):
+    await send_many_callback(bot, cq, msg_id, True)
+
+async def react_callback(bot, cq: CallbackQuery, msg_id: int, reaction_index: int):
+    if not 0 <= reaction_index < len(REACTION_TYPES):
+        return await cq.answer()
+    reaction = REACTION_TYPES[reaction_index]
+
+    # Reactions are keyed by the channel post itself; message ids repeat across channels
+    channel_id, post_id = cq.message.chat.id, cq.message.id
+    await adopt_legacy_post(channel_id, post_id, msg_id)
+    if REACTION_WRITE_BEHIND:
+        like_count, love_count = await reaction_buffer.record(channel_id, post_id, cq.from_user.id, reaction)
+    else:
+        like_count, love_count = await record_reaction(channel_id, post_id, cq.from_user.id, reaction)
+
+    reaction_editor.submit(cq.message, msg_id, (like_count, love_count))
+    await cq.answer("✅ Your reaction updated!", show_alert=False)
+
+CALLBACK_ROUTES = {
+    # opcode -> (handler, min args, max args); a stale or forged button with the wrong arg count is just answered
+    OP_NOOP: (noop_callback, 0, 0),
+    OP_HELP: (help_callback, 0, 0),
+    OP_ABOUT: (about_callback, 0, 0),
+    OP_START_MENU: (back_to_start_menu, 0, 0),
+    OP_REFRESH: (refresh_callback, 0, 0),
+    OP_DELCH: (delete_channel_callback, 1, 1),
+    OP_DELBTN: (delete_button_callback, 2, 2),
+    OP_SENDTO: (send_to_callback, 2, 3),
+    OP_SELCH: (select_channel_callback, 2, 2),
+    OP_SENDALL: (send_all_callback, 1, 1),
+    OP_SENDSEL: (send_selected_callback, 1, 1),
+    OP_REACT: (react_callback, 2, 2),
+}
+# Each route is timed on its own, so /perf shows react, sendto and help apart instead of one callback_handler row
+CALLBACK_ROUTES = {op: (timed_handler(func), *arity) for op, (func, *arity) in CALLBACK_ROUTES.items()}
+
+# 🟢 Callback router: one handler for every callback query, dispatching on the opcode with a single dict lookup
+@app.on_callback_query()
+async def callback_handler(bot, cq: CallbackQuery):
+    op, args = parse_callback(cq.data)
+    route = CALLBACK_ROUTES.get(op)
+    if route is None or not route[1] <= len(args) <= route[2]:
+        return await cq.answer()
+    return await route[0](bot, cq, *args)
 
 
 # 🟢 Run
-app.run()
+async def main():
+    http_server = await start_http_server()
+    instrument_api_calls(app)
+    outbound.install(app)
+    await init_reaction_store()
+    await ensure_indexes()
+    await init_counters()
+    start_inbound_lanes()
+    # Before app.start(), so the first updates are already laned and claimed; the decorators' add_handler tasks ran
+    # during the awaits above
+    instrument_handlers(app)
+    await app.start()
+    me = await get_bot_me(app)
+    logger.info(f"Bot started as @{me.username} ({me.id})")
+    await warm_up_media_assets(app)
+    channel_analytics.start()
+    stats_counters.start()
+    if REACTION_WRITE_BEHIND:
+        if CLUSTER_MODE:
+            logger.warning("REACTION_WRITE_BEHIND with CLUSTER_MODE: concurrent flushes from several instances can skew counts")
+        reaction_buffer.start()
+    if CLUSTER_MODE:
+        await init_cluster()
+        cluster_tasks.append(asyncio.create_task(follow_cluster_events()))
+        cluster_tasks.append(asyncio.create_task(lead(app)))
+        logger.info(f"Cluster mode on as instance {INSTANCE_ID}")
+    else:
+        await start_singletons(app)
+    await idle()
+    for task in cluster_tasks:
+        task.cancel()
+    await asyncio.gather(*cluster_tasks, return_exceptions=True)
+    await stop_singletons()
+    await close_inbound_lanes()
+    if CLUSTER_MODE and is_leader:
+        await release_lease(LEADER_LEASE) # Lets another instance take over without waiting for LEASE_TTL
+    await reaction_buffer.close()
+    await channel_analytics.close()
+    await stats_counters.close()
+    await reaction_editor.close()
+    await app.stop()
+    await outbound.close()
+    http_server.close()
+
+if __name__ == "__main__":
+    app.run(main())